@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+'''Benchmark fork-to-exec latency of the agent at different nofile limits.
+
+Run from the top of the source tree::
+
+    PYTHONPATH=src python bench/fork_exec.py [runs]
+
+Raising the soft nofile limit above the hard limit needs root.'''
+
+from __future__ import division
+
+import os
+import resource
+import sys
+import time
+
+from proccer import agent
+
+
+def without_close_range(min):
+    # Only ever called in the forked child, so no need to restore it.
+    agent._close_range = None
+    agent._close_all_fds(min)
+
+
+def python_loop(min):
+    # How the agent used to do it.
+    for fd in range(min, os.sysconf('SC_OPEN_MAX')):
+        try:
+            os.close(fd)
+        except EnvironmentError:
+            pass
+
+strategies = [
+    ('close_range', agent._close_all_fds),
+    ('/proc/self/fd', without_close_range),
+    ('closerange loop', agent._close_fd_range),
+    ('python loop', python_loop),
+]
+
+limits = [1024, 16 * 1024, 64 * 1024, 1024 * 1024]
+
+
+def fork_exec(close):
+    pid = os.fork()
+    if not pid:
+        try:
+            close(3)
+            os.execvp('true', ['true'])
+        finally:
+            os._exit(117)
+    os.waitpid(pid, 0)
+
+
+def bench(close, runs):
+    before = time.time()
+    for _ in range(runs):
+        fork_exec(close)
+    return (time.time() - before) / runs
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+
+    print '%-10s %-16s %12s' % ('nofile', 'strategy', 'ms/exec')
+    for limit in limits:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE,
+                               (limit, max(hard, limit)))
+        except (ValueError, resource.error):
+            print '%-10d (cannot raise nofile limit)' % limit
+            continue
+
+        for name, close in strategies:
+            print '%-10d %-16s %12.3f' % (limit, name,
+                                          1000 * bench(close, runs))
+
+    resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+'''Benchmark the dashboard filter, with and without the proccer_job_search
+trigram index, over synthetic job tables of growing size.
+
+Needs a PostgreSQL database with the proccer schema, including the pg_trgm
+extension, run from the top of the source tree::
+
+    DATABASE_URL=postgresql://proccer@localhost/proccer \\
+        PYTHONPATH=src python bench/job_search.py [sizes]
+
+The synthetic jobs are removed again afterwards.  "scan" drops the index
+inside a transaction, which is then rolled back.  Without the index, e.g.
+where pg_trgm is not available, only "scan" is measured, and "index" shows
+as n/a.'''
+
+from __future__ import division
+
+import sys
+import time
+
+from sqlalchemy import func
+
+from proccer.app import filter_jobs
+from proccer.database import Session, Job
+
+searches = [
+    'bench-job-4242',
+    'bench-role-17 host-123',
+    'no-such-job',
+]
+runs = 20
+
+
+def has_search_index(session):
+    return session.execute(
+        "select to_regclass('proccer_job_search')").scalar() is not None
+
+
+def populate(session, size, indexed):
+    session.execute('''
+        insert into proccer_job (host, login, name, last_seen, last_stamp,
+                                 state)
+            select 'bench-host-' || n % 500 || '.example.com',
+                    'bench-role-' || n % 50, 'bench-job-' || n,
+                    now(), now(), 1
+                from generate_series(1, :size) as n
+    ''', {'size': size})
+    session.commit()
+    if indexed:
+        # Move new entries out of the index's pending list, as vacuum would.
+        session.execute(
+            "select gin_clean_pending_list('proccer_job_search')")
+    session.execute('analyze proccer_job')
+    session.commit()
+
+
+def cleanup(session):
+    session.rollback()
+    session.execute("delete from proccer_job where login like 'bench-role-%'")
+    session.commit()
+
+
+def search(session, q):
+    query = filter_jobs(session.query(func.count(Job.id)), q)
+    before = time.time()
+    for n in range(runs):
+        query.scalar()
+    return (time.time() - before) / runs
+
+
+def main():
+    sizes = map(int, sys.argv[1:]) or [1000, 10000, 100000]
+
+    session = Session()
+    has_index = has_search_index(session)
+    Session.remove()
+    if not has_index:
+        print 'No proccer_job_search index, only measuring scans.'
+
+    print '%8s %-24s %10s %10s' % ('jobs', 'search', 'scan ms', 'index ms')
+    for size in sizes:
+        session = Session()
+        try:
+            populate(session, size, has_index)
+            if has_index:
+                indexed = ['%10.2f' % (1000 * search(session, q))
+                           for q in searches]
+                session.execute('drop index proccer_job_search')
+            else:
+                indexed = ['%10s' % 'n/a'] * len(searches)
+            scanned = [search(session, q) for q in searches]
+        finally:
+            cleanup(session)
+            Session.remove()
+
+        for q, scan, index in zip(searches, scanned, indexed):
+            print '%8d %-24s %10.2f %s' % (size, q, 1000 * scan, index)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+'''Benchmark storing a report, old ORM path against record_report.
+
+Needs a PostgreSQL database with the proccer schema, run from the top of
+the source tree::
+
+    DATABASE_URL=postgresql://proccer@localhost/proccer \\
+        PYTHONPATH=src python bench/job_update.py [reports]
+
+Each report is stored in its own transaction, like the manager does.  Reports
+are either all ok, or alternate between ok and error so every report is a
+state change.  Notifications are turned off.'''
+
+from __future__ import division
+
+from datetime import datetime, timedelta
+import sys
+import time
+
+from sqlalchemy import event
+
+from proccer import database
+from proccer.database import session_manager, engine
+from proccer.database import update_proccer_job, add_proccer_result
+from proccer.database import record_report
+
+statements = [0]
+
+
+@event.listens_for(engine, 'before_cursor_execute')
+def count_statement(*args):
+    statements[0] += 1
+
+
+def old_path(session, result):
+    job = update_proccer_job(session, result)
+    add_proccer_result(session, job, result)
+
+strategies = [
+    ('orm', old_path),
+    ('record_report', record_report),
+]
+
+start = datetime(2000, 1, 1)
+
+
+def report(n, ok):
+    return {
+        'host': 'bench.example.com',
+        'login': 'bench',
+        'name': 'job-update',
+        'result': {'ok': ok(n)},
+        'clock': 0.1,
+        'rusage': {},
+        'stamp': (start + timedelta(seconds=n)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'config': {'command': 'true'},
+        'output': 'Report #%d' % n,
+    }
+
+
+def bench(store, reports, ok):
+    with session_manager() as session:
+        store(session, report(0, ok))  # Create the job.
+
+    statements[0] = 0
+    before = time.time()
+    for n in range(1, reports + 1):
+        with session_manager() as session:
+            store(session, report(n, ok))
+    return (time.time() - before) / reports, statements[0] / reports
+
+
+def cleanup():
+    with session_manager() as session:
+        cnx = session.connection()
+        job_ids = '''(select id from proccer_job
+                      where host = 'bench.example.com' and login = 'bench')'''
+        for table in ('proccer_result', 'proccer_history'):
+            cnx.execute('delete from %s where job in %s' % (table, job_ids))
+        cnx.execute('''delete from proccer_job
+                       where host = 'bench.example.com' and login = 'bench' ''')
+    database.job_id_cache.clear()
+
+
+def main():
+    reports = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    database.job_state_changed = lambda job, result: None
+
+    print '%-16s %-14s %12s %12s' % ('reports', 'strategy', 'ms/report',
+                                     'statements')
+    for kind, ok in [('unchanged', lambda n: True),
+                     ('state changes', lambda n: n % 2 == 0)]:
+        for name, store in strategies:
+            try:
+                latency, count = bench(store, reports, ok)
+            finally:
+                cleanup()
+            print '%-16s %-14s %12.3f %12.1f' % (kind, name, 1000 * latency,
+                                                 count)
+
+if __name__ == '__main__':
+    main()
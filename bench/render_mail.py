@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+'''Benchmark rendering notification mail.
+
+Run from the top of the source tree::
+
+    PYTHONPATH=src python bench/render_mail.py [messages]'''
+
+from __future__ import division
+
+from datetime import datetime
+import sys
+import time
+
+from proccer.database import Job
+from proccer.notifications import mail_for_state
+
+result = {
+    'output': '\n'.join('line %d of output' % n for n in range(50)),
+    'config': {'command': '/usr/local/bin/backup --all'},
+}
+
+
+def bench(messages):
+    job = Job(id=117, host='snafu.example.com', login='foo', name='bar',
+              last_seen=datetime(1979, 7, 7, 11, 22, 33),
+              notify=['devops@example.com'])
+    states = ['ok', 'error', 'late', 'still error']
+
+    before = time.time()
+    for n in range(messages):
+        mail_for_state(job, states[n % len(states)], result)
+    return (time.time() - before) / messages
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    print '%.1f us/message' % (1e6 * bench(messages))
+
+if __name__ == '__main__':
+    main()
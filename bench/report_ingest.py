@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+'''Benchmark report ingestion through the manager's HTTP API.
+
+Needs a PostgreSQL database with the proccer schema, run from the top of
+the source tree::
+
+    DATABASE_URL=postgresql://proccer@localhost/proccer \\
+        PYTHONPATH=src python bench/report_ingest.py [reports]
+
+The benchmark is run with and without connection pooling, each in its own
+process since the engine is configured on import.'''
+
+from __future__ import division
+
+from datetime import datetime
+import jsonlib as json
+import os
+import subprocess
+import sys
+import time
+
+configurations = [
+    ('no pool', {'PROCCER_DB_POOL_SIZE': '0'}),
+    ('pool', {'PROCCER_DB_POOL_SIZE': '5'}),
+    ('pool, no pre-ping', {'PROCCER_DB_POOL_SIZE': '5',
+                           'PROCCER_DB_PRE_PING': '0'}),
+]
+
+
+def report(n):
+    return {
+        'host': 'bench.example.com',
+        'login': 'bench',
+        'name': 'report-ingest',
+        'result': {'ok': True},
+        'clock': 0.1,
+        'rusage': {},
+        'stamp': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'config': {'command': 'true'},
+        'output': 'Report #%d' % n,
+    }
+
+
+def bench(reports):
+    from werkzeug.test import Client
+    from werkzeug.wrappers import BaseResponse
+    from proccer.app import app
+
+    client = Client(app, BaseResponse)
+    post = lambda n: client.post('/api/1.0/report',
+                                 data=json.dumps(report(n)),
+                                 headers={'Content-Type': 'application/json'})
+    post(0)  # Create the job.
+
+    before = time.time()
+    for n in range(reports):
+        resp = post(n)
+        assert resp.status_code == 200, resp.data
+    return reports / (time.time() - before)
+
+
+def cleanup():
+    from proccer.database import session_manager
+    with session_manager() as session:
+        cnx = session.connection()
+        job_ids = '''(select id from proccer_job
+                      where host = 'bench.example.com' and login = 'bench')'''
+        for table in ('proccer_result', 'proccer_history'):
+            cnx.execute('delete from %s where job in %s' % (table, job_ids))
+        cnx.execute('''delete from proccer_job
+                       where host = 'bench.example.com' and login = 'bench' ''')
+
+
+def main():
+    reports = sys.argv[1] if len(sys.argv) > 1 else '500'
+    if os.environ.get('BENCH_CHILD'):
+        try:
+            print '%.1f' % bench(int(reports))
+        finally:
+            cleanup()
+        return
+
+    print '%-20s %12s' % ('configuration', 'reports/sec')
+    for name, environ in configurations:
+        env = dict(os.environ, BENCH_CHILD='1', **environ)
+        output = subprocess.Popen([sys.executable, __file__, reports],
+                                  env=env, stdout=subprocess.PIPE)
+        print '%-20s %12s' % (name, output.communicate()[0].strip())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+'''Benchmark sending notification mail, a connection per message against
+the SMTP connection pool.
+
+Mail is sent to a stand-in SMTP server on localhost, which throws the
+messages away.  Run from the top of the source tree::
+
+    PYTHONPATH=src python bench/smtp_send.py [messages]
+
+A real mail-server is further away, and does more work on connect (DNS
+lookups, TLS, greeting delays), so this is the best case for a connection
+per message.'''
+
+from __future__ import division, with_statement
+
+import asyncore
+from contextlib import closing
+from multiprocessing.pool import ThreadPool
+import smtpd
+import smtplib
+import sys
+from threading import Thread
+import time
+
+from proccer.notifications import SMTPPool
+
+message = '''\
+From: proccer@localhost
+To: devops@example.com
+Subject: [foo@snafu/bar] error
+
+Job failed.
+'''
+
+
+class DiscardingServer(smtpd.SMTPServer):
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        pass
+
+
+def start_server():
+    server = DiscardingServer(('127.0.0.1', 0), None)
+    thread = Thread(target=asyncore.loop, kwargs={'timeout': 0.1})
+    thread.daemon = True
+    thread.start()
+    return '%s:%d' % server.socket.getsockname()
+
+
+def connection_per_message(host):
+    def send(n):
+        with closing(smtplib.SMTP(host)) as smtp:
+            smtp.sendmail('proccer@localhost', ['devops@example.com'],
+                          message)
+    return send
+
+
+def pooled(host):
+    pool = SMTPPool(host)
+
+    def send(n):
+        pool.sendmail('proccer@localhost', ['devops@example.com'], message)
+    return send
+
+strategies = [
+    ('per message', connection_per_message),
+    ('pool', pooled),
+]
+
+
+def bench(send, messages, threads):
+    pool = ThreadPool(threads)
+    before = time.time()
+    pool.map(send, range(messages))
+    elapsed = time.time() - before
+    pool.close()
+    return messages / elapsed
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    host = start_server()
+
+    print '%-12s %8s %14s' % ('strategy', 'threads', 'messages/sec')
+    for threads in (1, 4):
+        for name, strategy in strategies:
+            print '%-12s %8d %14.1f' % (name, threads,
+                                        bench(strategy(host), messages,
+                                              threads))
+
+if __name__ == '__main__':
+    main()
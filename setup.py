@@ -22,5 +22,8 @@ setup(
     entry_points='''
         [console_scripts]
         proccer = proccer.console_scripts:run_processes
+        proccer-flush = proccer.console_scripts:flush_reports
+        proccer-periodic = proccer.console_scripts:run_periodic
+        proccer-outbox = proccer.console_scripts:run_outbox
     ''',
 )
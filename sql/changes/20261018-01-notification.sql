@@ -0,0 +1,18 @@
+create table proccer_notification(
+    id bigserial primary key,
+    created timestamp not null,
+    channel varchar not null,
+    dedupe_key varchar not null,
+    job integer references proccer_job,
+    payload text not null,
+    attempts integer not null default 0,
+    next_attempt timestamp,
+    delivered timestamp,
+    last_error text
+);
+
+create unique index proccer_notification_dedupe
+    on proccer_notification(channel, dedupe_key);
+
+create index proccer_notification_due
+    on proccer_notification(next_attempt) where next_attempt is not null;
@@ -0,0 +1,13 @@
+alter table proccer_job
+    add column due_at timestamp;
+
+update proccer_job
+    set due_at = last_seen + warn_after
+    where warn_after is not null;
+
+create index proccer_job_due
+    on proccer_job(due_at) where deleted is null and state = 1;
+
+create index proccer_job_still_bad
+    on proccer_job(last_stamp)
+    where deleted is null and state <> 1 and warn_after is not null;
@@ -0,0 +1,6 @@
+-- no transaction
+-- proccer_result is large, so build the index without blocking reports.
+-- If this fails, drop the invalid proccer_result_stamp index it leaves
+-- behind, and run it again.
+create index concurrently if not exists proccer_result_stamp
+    on proccer_result(stamp);
@@ -0,0 +1,8 @@
+alter table proccer_job
+    add column changed timestamp;
+
+update proccer_job
+    set changed = coalesce(deleted, last_stamp);
+
+create index proccer_job_changed
+    on proccer_job(changed);
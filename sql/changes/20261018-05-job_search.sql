@@ -0,0 +1,5 @@
+create extension if not exists pg_trgm;
+
+create index proccer_job_search
+    on proccer_job
+    using gin ((login || ' ' || host || ' ' || name) gin_trgm_ops);
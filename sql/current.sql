@@ -29,12 +29,29 @@ create table proccer_job(
     -- how long should we wait from last_stamp before considering this job
     -- late
     warn_after interval,
+    -- when this job is late if not seen again, i.e. last_seen + warn_after
+    due_at timestamp,
     -- optional list of where to mail state-change notifications
-    notify varchar -- really json.
+    notify varchar, -- really json.
+    -- when this row was last changed, for clients polling for changes
+    changed timestamp
 );
 -- host/login/name uniquely identifies a job.
 create unique index proccer_job_id
     on proccer_job(host, login, name);
+-- for finding jobs which have become late, and jobs which are still bad
+create index proccer_job_due
+    on proccer_job(due_at) where deleted is null and state = 1;
+create index proccer_job_still_bad
+    on proccer_job(last_stamp)
+    where deleted is null and state <> 1 and warn_after is not null;
+create index proccer_job_changed
+    on proccer_job(changed);
+-- for the dashboard filter, see database.job_search_text
+create extension if not exists pg_trgm;
+create index proccer_job_search
+    on proccer_job
+    using gin ((login || ' ' || host || ' ' || name) gin_trgm_ops);
 
 create table proccer_result(
     id bigserial primary key,
@@ -48,6 +65,9 @@ create table proccer_result(
 );
 create index proccer_result_job_stamp
     on proccer_result(job, stamp);
+-- for expiring old results
+create index proccer_result_stamp
+    on proccer_result(stamp);
 
 create table proccer_history(
     id bigserial primary key,
@@ -59,3 +79,23 @@ create table proccer_history(
 -- there can be only one "current" state per cronjob
 create unique index proccer_history_curr
     on proccer_history(job) where ended is null;
+
+create table proccer_notification(
+    id bigserial primary key,
+    created timestamp not null,
+    -- 'mail' or 'slack'
+    channel varchar not null,
+    -- what the notification is about, so it is only queued once
+    dedupe_key varchar not null,
+    job integer references proccer_job,
+    payload text not null, -- really json
+    attempts integer not null default 0,
+    -- when to try delivering next, null once delivered or given up on
+    next_attempt timestamp,
+    delivered timestamp,
+    last_error text
+);
+create unique index proccer_notification_dedupe
+    on proccer_notification(channel, dedupe_key);
+create index proccer_notification_due
+    on proccer_notification(next_attempt) where next_attempt is not null;
@@ -10,7 +10,7 @@ import sys
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, String, DateTime
 
-from proccer.database import session_manager
+from proccer.database import autocommit_connection, session_manager
 
 here = os.path.dirname(__file__)
 
@@ -27,17 +27,33 @@ class AppliedChanges(Base):
 def parse_sql_script(f):
     return filter(None, [s.strip() for s in f.read().strip().split('\n\n')])
 
+# .sql scripts starting with this line are run outside of a transaction,
+# which statements like "create index concurrently" need.
+no_transaction = '-- no transaction'
+
 def apply_script(session, script):
     with open(script) as file:
         cnx = session.connection()
         if script.endswith('.sql'):
-            for statement in parse_sql_script(file):
+            statements = parse_sql_script(file)
+            if statements and statements[0].startswith(no_transaction):
+                apply_without_transaction(session, statements)
+                return
+            for statement in statements:
                 cnx.execute(statement)
 
         elif script.endswith('.py'):
             code = compile(file.read(), script, 'exec')
             eval(code, {'session': session, 'cnx': cnx})
 
+def apply_without_transaction(session, statements):
+    # Commit first, since "create index concurrently" waits for all open
+    # transactions, ours too.
+    session.commit()
+    with autocommit_connection(session.bind) as connection:
+        for statement in statements:
+            connection.execute(statement)
+
 def main(changes):
     really = '-n' not in sys.argv
 
@@ -0,0 +1,66 @@
+-- Optionally range-partition proccer_result by day, so proccer-periodic
+-- expires old results by dropping whole days instead of deleting rows.
+--
+-- Run once, with the manager stopped, after the changes scripts:
+--
+--     psql -f sql/partition-result.sql proccer
+--
+-- The existing results become a single partition, which is dropped when
+-- they have all expired.  proccer-periodic keeps a week of partitions made
+-- ahead of time, so it must run at least that often.  Results which fit no
+-- other partition, e.g. from agents with skewed clocks, go in the default
+-- partition; to add it where this was run before it was part of the script:
+--
+--     create table proccer_result_default partition of proccer_result default;
+\set QUIET on
+\set ON_ERROR_STOP
+
+SET client_encoding = 'UTF-8';
+SET client_min_messages = warning;
+
+begin;
+
+alter table proccer_result rename to proccer_result_legacy;
+-- Partitioned tables need the partition key in the primary key, so that
+-- becomes (id, stamp).
+alter table proccer_result_legacy drop constraint proccer_result_pkey;
+alter index proccer_result_job_stamp rename to proccer_result_legacy_job_stamp;
+alter index proccer_result_stamp rename to proccer_result_legacy_stamp;
+
+create table proccer_result(
+    id bigint not null default nextval('proccer_result_id_seq'),
+    stamp timestamp not null,
+    state integer not null references proccer_state,
+    job integer not null references proccer_job,
+    clock_ms integer not null, -- i.e. wall-clock
+    output text not null,
+    result varchar not null, -- really json
+    rusage varchar not null, -- really json
+    primary key (id, stamp)
+) partition by range (stamp);
+alter sequence proccer_result_id_seq owned by proccer_result.id;
+create index proccer_result_job_stamp
+    on proccer_result(job, stamp);
+
+-- Results up to the end of today go in the legacy partition, the days after
+-- get a partition each.
+do $$
+declare
+    today timestamp := date_trunc('day', now() at time zone 'utc');
+    day timestamp;
+begin
+    execute format('alter table proccer_result attach partition '
+                   'proccer_result_legacy for values from (minvalue) to (%L)',
+                   today + interval '1 day');
+    for n in 1..7 loop
+        day := today + n * interval '1 day';
+        execute format('create table %I partition of proccer_result '
+                       'for values from (%L) to (%L)',
+                       'proccer_result_p' || to_char(day, 'YYYYMMDD'),
+                       day, day + interval '1 day');
+    end loop;
+end
+$$;
+create table proccer_result_default partition of proccer_result default;
+
+commit;
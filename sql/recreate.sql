@@ -9,5 +9,6 @@ drop table if exists proccer_job cascade;
 drop table if exists proccer_state cascade;
 drop table if exists proccer_result cascade;
 drop table if exists proccer_history cascade;
+drop table if exists proccer_notification cascade;
 
 \i current.sql
@@ -1,32 +1,46 @@
 from __future__ import with_statement
 
-from contextlib import closing, contextmanager
+from contextlib import closing
 from datetime import datetime
 import errno
+import fcntl
 import jsonlib as json
 from lockfile import FileLock, LockError
 import logging
-from math import pow
+from math import ceil, pow
 import os
 import re
 import requests
 import resource
+import select
 import signal
 from socket import gethostname
-from tempfile import NamedTemporaryFile
+import sys
+import threading
 import time
 import traceback
 import yaml
+import zlib
 
+from proccer import spool
 from proccer.common import parse_interval
 
 
 default_memory_limit = 1 * 1024 * 1024 * 1024  # 1GB memory limit
-max_output = 128 * 1024  # Truncate output at 128KB
+max_output_head = 32 * 1024  # Keep the first 32KB of output,
+max_output_tail = 96 * 1024  # and the last 96KB.
+read_size = 64 * 1024
+# How often to check for exited children while waiting for output.  A
+# child closing its output is usually about to exit, so check more often.
+poll_interval = 1.0
+closed_poll_interval = 0.01
 
 log = logging.getLogger('proccer')
 
 API_URL = os.environ.get('PROCCER_API_URL', '').rstrip('/')
+report_timeout = 10  # seconds
+report_batch_size = 100
+compress_min_size = 1024  # Smaller reports are not worth compressing.
 
 signal_name = dict((k, v)
                    for v, k in signal.__dict__.iteritems()
@@ -66,78 +80,292 @@ def load_configuration(path):
 
 
 def run_process(conf, name):
+    for _, result, error in run_processes(conf, [name]):
+        if error:
+            raise error
+        return result
+
+
+def run_processes(conf, names, jobs=1):
+    '''Run the named processes, with at most `jobs` of them running at once.
+
+    Yields a (name, result, error) tuple as each process completes, where
+    error is a ProcessError if the process could not be started.  Like when
+    running them one after the other, no new processes are started once one
+    has failed.'''
+
     commands = conf.get('commands', {})
+    pending = list(names)
+    running = {}
+    failed = False
+
+    _install_signal_handlers(running)
+
+    while running or (pending and not failed):
+        while pending and not failed and len(running) < jobs:
+            name = pending.pop(0)
+            try:
+                child = _start_process(commands, name)
+            except ProcessError, e:
+                failed = True
+                yield name, None, e
+                continue
+
+            if child:
+                running[child.pid] = child
+                _schedule_alarm(running)
+            else:
+                yield name, None, None
+
+        if not running:
+            continue
+
+        child = _reap(running)
+        _schedule_alarm(running)
+        child.lock.release()
+
+        result = _result_for(child)
+        if not result['result']['ok']:
+            failed = True
+        yield child.name, result, None
+
+
+class _Child(object):
+    'Book-keeping for a forked child-process.'
+
+    def __init__(self, name, desc, pid, output_fd):
+        self.name = name
+        self.desc = desc
+        self.pid = pid
+        self.output_fd = output_fd
+        self.output = OutputBuffer(max_output_head, max_output_tail)
+        self.lock = None
+
+        self.started = time.time()
+        timeout = desc.get('timeout')
+        self.deadline = self.started + timeout if timeout else None
+
+        self.ended = self.status = self.rusage = None
+
+
+def _start_process(commands, name):
     desc = commands.get(name)
     if not desc:
         raise ProcessError('No such process: %s' % name)
 
     try:
-        with _grab_lock(name, desc):
-            with closing(NamedTemporaryFile()) as logfile:
-                pid = os.fork()
-                if pid:
-                    return _in_parent(name, desc, pid, logfile)
-                else:
-                    _in_child(name, desc, logfile)
-
+        lock = _acquire_lock(name, desc)
     except LockError:
         if desc.get('lockfile', {}).get('silent'):
             log.debug('[%s] silently ignoring lock-file timeout', name)
-            return
+            return None
         raise ProcessError('lock-file timeout')
 
+    log.debug('[%s] starting', name)
+    try:
+        child = _fork_child(name, desc)
+    except:
+        lock.release()
+        raise
+    child.lock = lock
+    return child
+
 
-def _in_parent(name, desc, pid, logfile):
-    # Install signal handlers
+class OutputBuffer(object):
+    '''Fixed-size buffer keeping the head and tail of a stream of output.
+
+    >>> output = OutputBuffer(4, 4)
+    >>> output.write('Hello, World!')
+    >>> output.total, output.truncated
+    (13, True)
+    >>> output.getvalue()
+    u'Hell\\n[... 5 bytes skipped ...]\\nrld!'
+    '''
+
+    def __init__(self, head_size, tail_size):
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+
+    def write(self, data):
+        self.total += len(data)
+
+        missing = self.head_size - len(self.head)
+        if missing > 0:
+            self.head += data[:missing]
+            data = data[missing:]
+
+        self.tail += data
+        if len(self.tail) > self.tail_size:
+            del self.tail[:len(self.tail) - self.tail_size]
+
+    @property
+    def truncated(self):
+        return self.total > len(self.head) + len(self.tail)
+
+    def getvalue(self):
+        head = bytes(self.head).decode('utf-8', 'replace')
+        tail = bytes(self.tail).decode('utf-8', 'replace')
+        if self.truncated:
+            skipped = self.total - len(self.head) - len(self.tail)
+            head += u'\n[... %d bytes skipped ...]\n' % skipped
+        return head + tail
+
+
+def _fork_child(name, desc):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid:
+        os.close(write_fd)
+        fcntl.fcntl(read_fd, fcntl.F_SETFL,
+                    fcntl.fcntl(read_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        return _Child(name, desc, pid, read_fd)
+    else:
+        _in_child(name, desc, write_fd)
+
+
+def _install_signal_handlers(running):
     def _signalled(signo, frames):
-        log.debug('received signal %s, passing it on to child',
+        log.debug('received signal %s, passing it on to children',
                   signal_name.get(signo, str(signo)))
-        os.killpg(pid, signal.SIGTERM)
-
-    signal.signal(signal.SIGALRM, _signalled)
+        for child in running.values():
+            _terminate(child)
+
+    def _alarmed(signo, frames):
+        now = time.time()
+        for child in running.values():
+            if child.deadline and child.deadline <= now:
+                log.debug('[%s] timed out', child.name)
+                child.deadline = None
+                _terminate(child)
+        _schedule_alarm(running)
+
+    signal.signal(signal.SIGALRM, _alarmed)
     signal.signal(signal.SIGINT, _signalled)
     signal.signal(signal.SIGTERM, _signalled)
 
-    # Setup timeout (via SIGALRM)
-    timeout = desc.get('timeout')
-    if timeout:
-        signal.alarm(timeout)
-
-    before = time.time()
-    _, status, rusage = _wait_for(pid)
-    after = time.time()
 
-    # Clear timeout
-    if timeout:
+def _schedule_alarm(running):
+    'Setup timeout (via SIGALRM) for the child with the nearest deadline.'
+    deadlines = [c.deadline for c in running.values() if c.deadline]
+    if deadlines:
+        seconds = int(ceil(min(deadlines) - time.time()))
+        signal.alarm(max(seconds, 1))  # alarm only uses ints
+    else:
         signal.alarm(0)
 
-    # Read stdout/stderr log and return result
-    logfile.seek(0, 0)
-    output_length = logfile.tell()
-    output = logfile.read(max_output).decode('utf-8', 'replace')
 
-    return {
-        'stamp': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
-        'name': name,
-        'host': gethostname(),
-        'login': os.environ.get('LOGNAME', ''),
-        'config': desc,
-        'result': _get_result(status),
-        'rusage': dictify_rusage(rusage),
-        'clock': after - before,
-        'output': output,
-        'output_truncated': len(output) < output_length,
-    }
+def _terminate(child):
+    try:
+        os.killpg(child.pid, signal.SIGTERM)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
 
 
-def _wait_for(pid):
-    # Keep retrying os.wait4 until it does not get interrupted.
+def _reap(running):
+    '''Collect output from the running children until one of them exits.
+
+    The child is removed from running, and returned with status, rusage and
+    end-time filled in.'''
+
     while True:
+        child = _wait_for_any(running, os.WNOHANG)
+        if child:
+            _read_output(child, until_eof=True)
+            return child
+
+        fds = dict((c.output_fd, c) for c in running.values()
+                   if c.output_fd is not None)
+        if not fds:
+            # Nothing more to read, so just wait for a child to exit.
+            child = _wait_for_any(running, 0)
+            if child:
+                return child
+            continue
+
+        if len(fds) < len(running):
+            timeout = closed_poll_interval
+        else:
+            timeout = poll_interval
+
         try:
-            return os.wait4(pid, 0)
+            readable, _, _ = select.select(list(fds), [], [], timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            continue
+
+        for fd in readable:
+            _read_output(fds[fd])
+
+
+def _wait_for_any(running, options):
+    while True:
+        try:
+            pid, status, rusage = os.wait4(-1, options)
         except OSError as e:
+            # Keep retrying os.wait4 until it does not get interrupted.
             if e.errno != errno.EINTR:
                 raise
+            continue
+
+        if not pid:
+            return None
+
+        child = running.pop(pid, None)
+        if child:
+            child.ended = time.time()
+            child.status, child.rusage = status, rusage
+            return child
+
+
+def _read_output(child, until_eof=False):
+    '''Read available output from child into its OutputBuffer.
+
+    If the child has exited we read until end-of-file, but stop if nothing
+    more is available, since background processes might still be holding
+    on to the pipe.'''
+
+    while child.output_fd is not None:
+        try:
+            data = os.read(child.output_fd, read_size)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno != errno.EAGAIN:
+                raise
+            if until_eof:
+                os.close(child.output_fd)
+                child.output_fd = None
+            return
+
+        if not data:
+            os.close(child.output_fd)
+            child.output_fd = None
+            return
+
+        child.output.write(data)
+        if not until_eof:
+            return
+
+
+def _result_for(child):
+    return {
+        'stamp': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'name': child.name,
+        'host': gethostname(),
+        'login': os.environ.get('LOGNAME', ''),
+        'config': child.desc,
+        'result': _get_result(child.status),
+        'rusage': dictify_rusage(child.rusage),
+        'clock': child.ended - child.started,
+        'output': child.output.getvalue(),
+        'output_truncated': child.output.truncated,
+        'output_length': child.output.total,
+    }
 
 
 def memory_size_human_to_bytes(s):
@@ -198,7 +426,7 @@ def set_memory_limit(desc):
     resource.setrlimit(resource.RLIMIT_AS, (memory_limit_bytes, -1))
 
 
-def _in_child(name, desc, logfile):
+def _in_child(name, desc, output_fd):
     try:
         # We want our own process-group.
         os.setsid()
@@ -210,7 +438,7 @@ def _in_child(name, desc, logfile):
         if fd != 0:
             os.dup2(fd, 0)
 
-        os.dup2(logfile.fileno(), 1)
+        os.dup2(output_fd, 1)
         os.dup2(1, 2)
 
         _close_all_fds(min=3)
@@ -234,35 +462,84 @@ def _in_child(name, desc, logfile):
 
 
 def _close_all_fds(min=0):
+    '''Close all file descriptors from min and up.
+
+    With a high nofile limit, blindly closing every possible descriptor
+    means a lot of system-calls, so prefer closing only the open ones.'''
+
+    if _close_range and _close_range(min) == 0:
+        return
+
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except (OSError, ValueError):
+        _close_fd_range(min)
+    else:
+        for fd in fds:
+            if fd >= min:
+                try:
+                    os.close(fd)
+                except EnvironmentError:
+                    pass
+
+
+def _close_fd_range(min):
     try:
         maxfd = os.sysconf("SC_OPEN_MAX")
     except (AttributeError, ValueError):
         log.warn('SC_OPEN_MAX not defined')
         maxfd = 1024
 
-    for fd in range(min, maxfd):
-        try:
-            os.close(fd)
-        except EnvironmentError:
-            pass
+    os.closerange(min, maxfd)
 
 
-@contextmanager
-def _grab_lock(name, desc):
+def _find_close_range():
+    '''Return a function calling close_range(2), if it might be available.
+
+    This is looked up up-front, so the forked child does not have to import
+    anything.  The function returns non-zero if close_range failed, e.g. with
+    ENOSYS on kernels older than 5.9.'''
+
+    if not sys.platform.startswith('linux'):
+        return None
+
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+    except (ImportError, OSError):
+        return None
+
+    all_fds = ctypes.c_uint(0xffffffff)
+    no_flags = ctypes.c_uint(0)
+    if hasattr(libc, 'close_range'):
+        return lambda min: libc.close_range(ctypes.c_uint(min),
+                                            all_fds, no_flags)
+    elif os.uname()[4] in generic_syscall_machines:
+        return lambda min: libc.syscall(ctypes.c_long(SYS_close_range),
+                                        ctypes.c_uint(min),
+                                        all_fds, no_flags)
+    else:
+        return None
+
+# Architectures where close_range has the common system-call number.
+SYS_close_range = 436
+generic_syscall_machines = set('''x86_64 i386 i686 aarch64 armv7l armv6l
+                                  ppc64 ppc64le s390x riscv64'''.split())
+_close_range = _find_close_range()
+
+
+def _acquire_lock(name, desc):
     lck_desc = desc.get('lockfile', {})
     path = lck_desc.get('path', os.path.join('~', name))
     timeout = lck_desc.get('timeout', 0)
 
-    locked = False
-    try:
-        lockfile = FileLock(os.path.expanduser(path))
-        lockfile.acquire(timeout=timeout)
-        locked = True
-        yield
-
-    finally:
-        if locked:
-            lockfile.release()
+    lockfile = FileLock(os.path.expanduser(path))
+    # FileLock uses the same per-process unique_name for all locks in a
+    # directory, so releasing one of several locks held at once would break
+    # the others.
+    lockfile.unique_name += '.' + os.path.basename(lockfile.path)
+    lockfile.acquire(timeout=timeout)
+    return lockfile
 
 
 def log_for(result):
@@ -272,18 +549,198 @@ def log_for(result):
 
 
 def report(result):
+    '''Spool result and deliver it, along with any earlier undelivered
+    results, to the manager.'''
+
+    if spool_report(result):
+        flush_reports()
+    else:
+        flush_reports([result])
+
+
+def spool_report(result):
+    '''Spool result for delivery by flush_reports, without delivering it.
+
+    Returns False if result could not be spooled, and must be passed to
+    flush_reports to be delivered.'''
+
     if not API_URL:
-        return
+        return True
 
     try:
-        headers = {'Content-Type': 'application/json; charset=utf-8'}
-        report_url = API_URL + '/1.0/report'
-        r = requests.post(report_url,
-                          data=json.dumps(result),
-                          headers=headers)
-    except Exception:
-        log.error('error delivering job-status %r',
+        spool.add(result)
+    except EnvironmentError:
+        log.error('error spooling job-status %r, delivering it directly',
                   result, exc_info=True)
+        return False
+    return True
+
+
+def flush_reports(unspooled=()):
+    '''Deliver the unspooled results, and then the spooled results, to the
+    manager over one connection.
+
+    Returns the number of results still waiting for delivery, or None if
+    they are not known.'''
+
+    if not API_URL:
+        return None
+
+    with closing(requests.Session()) as session:
+        if unspooled:
+            _deliver(session, list(unspooled))
+        try:
+            return spool.flush(lambda results: _deliver(session, results),
+                               report_batch_size)
+        except EnvironmentError:
+            log.error('error flushing job-status spool', exc_info=True)
+            return None
+
+
+class ReportFlusher(object):
+    '''Delivers results from a thread of its own, as the processes finish,
+    so a slow manager does not hold up reaping the processes still running.
+
+    Results are spooled by report, and the thread woken to flush the spool.
+    close delivers whatever is left and stops the thread.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wanted = threading.Event()
+        self.unspooled = []
+        self.closing = False
+        self.thread = threading.Thread(target=self._run,
+                                       name='proccer-flusher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def report(self, result):
+        if not spool_report(result):
+            with self.lock:
+                self.unspooled.append(result)
+        self.wanted.set()
+
+    def close(self):
+        self.closing = True
+        self.wanted.set()
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            self.wanted.wait()
+            self.wanted.clear()
+            closing = self.closing
+            with self.lock:
+                unspooled, self.unspooled = self.unspooled, []
+            try:
+                flush_reports(unspooled)
+            except Exception:
+                log.error('error flushing job-statuses', exc_info=True)
+            if closing:
+                return
+
+
+def _deliver(session, results):
+    '''POST a batch of results to the manager, returning whether each is
+    done with, or spool.FAILED for those the manager failed to store.
+
+    Results the manager rejects as bad are logged and done with, since
+    sending them again will not help.  Batches too large for the manager are
+    split in two, and results too large on their own are spool.REFUSED.'''
+
+    headers = {'Content-Type': 'application/x-ndjson; charset=utf-8'}
+    reports_url = API_URL + '/1.0/reports'
+
+    # Managers with the batch API also take compressed bodies, so only
+    # compress here, and not when falling back to _deliver_each.
+    data = '\n'.join(json.dumps(result) for result in results)
+    if len(data) >= compress_min_size:
+        data = gzip_compress(data)
+        headers['Content-Encoding'] = 'gzip'
+
+    try:
+        r = session.post(reports_url,
+                         data=data,
+                         headers=headers,
+                         timeout=report_timeout)
+    except Exception:
+        log.error('error delivering %d job-statuses',
+                  len(results), exc_info=True)
+        return [False] * len(results)
+
+    if r.status_code == 404:
+        # Manager without the batch API.
+        return _deliver_each(session, results)
+    elif r.status_code == 413:
+        if len(results) == 1:
+            log.error('manager refused job-status %r: too large', results[0])
+            return [spool.REFUSED]
+        half = len(results) // 2
+        done = _deliver(session, results[:half])
+        # Keep the order, so older results are not stored after newer.
+        if not all(ok and ok is not spool.FAILED for ok in done):
+            return done + [False] * (len(results) - half)
+        return done + _deliver(session, results[half:])
+    elif r.status_code != 200:
+        log.error('error delivering %d job-statuses: HTTP %d',
+                  len(results), r.status_code)
+        return [False] * len(results)
+
+    try:
+        statuses = json.loads(r.content)['results']
+        codes = [status['status'] for status in statuses]
+        if len(codes) != len(results):
+            raise ValueError('%d statuses for %d job-statuses'
+                             % (len(codes), len(results)))
+    except Exception:
+        log.error('error delivering %d job-statuses: bad response %r',
+                  len(results), r.content[:200], exc_info=True)
+        return [False] * len(results)
+
+    done = []
+    for result, status, code in zip(results, statuses, codes):
+        if code == 400:
+            log.error('manager rejected job-status %r: %s',
+                      result, status.get('error'))
+        elif code == 500:
+            log.error('manager failed to store job-status %r: %s',
+                      result, status.get('error'))
+            done.append(spool.FAILED)
+            continue
+        done.append(code in (200, 400))
+    return done
+
+
+def gzip_compress(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _deliver_each(session, results):
+    headers = {'Content-Type': 'application/json; charset=utf-8'}
+    report_url = API_URL + '/1.0/report'
+
+    done = []
+    for result in results:
+        try:
+            r = session.post(report_url,
+                             data=json.dumps(result),
+                             headers=headers,
+                             timeout=report_timeout)
+        except Exception:
+            log.error('error delivering job-status %r',
+                      result, exc_info=True)
+            break
+
+        if r.status_code == 400:
+            log.error('manager rejected job-status %r', result)
+        elif r.status_code != 200:
+            log.error('error delivering job-status %r: HTTP %d',
+                      result, r.status_code)
+            break
+        done.append(True)
+
+    return done + [False] * (len(results) - len(done))
 
 
 def raise_for(result):
@@ -1,16 +1,29 @@
 from __future__ import with_statement
 
-from datetime import datetime
+import atexit
+from datetime import datetime, timedelta
+from itertools import groupby
 from flask import Flask, json, jsonify, request, flash, url_for, redirect
+from flask import session as flask_session
+from functools import wraps
 from flask.ext.genshi import Genshi, render_response
 import imp
 import logging
 import os
-from werkzeug.exceptions import BadRequest
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.exceptions import UnsupportedMediaType
+from sqlalchemy import func
+import zlib
 
-from proccer.database import session_manager, Job
-from proccer.database import update_proccer_job, add_proccer_result
-from proccer.signals import report_received
+from proccer import events
+from proccer.database import engine, session_manager, Job, job_id_cache
+from proccer.database import job_search_text, job_state_id, job_state_name
+from proccer.database import emit_events, record_report
+from proccer.database import store_reports, validate_report
+from proccer.ingest import WriteBehindQueue
+from proccer.pagecache import page_cache
+from proccer.signals import report_received, reports_received, jobs_changed
 
 log = logging.getLogger('proccer.app')
 
@@ -47,21 +60,159 @@ if 'SENTRY_DSN' in os.environ:  # pragma: no-cover
     app.config['PROPAGATE_EXCEPTIONS'] = True
     app.wsgi_app = Sentry(app.wsgi_app, Client(os.environ['SENTRY_DSN']))
 
+def cached_page(view):
+    '''Serve the page from page_cache, rendering and keeping it if it is not
+    there.  Pages with flashed messages are neither served from nor kept in
+    the cache.'''
+
+    @wraps(view)
+    def cached_view(**kwargs):
+        if '_flashes' in flask_session:
+            return view(**kwargs)
+
+        # Hear about changes made by other processes, too.
+        events.broker.listen(engine)
+        key = (request.path, request.query_string)
+        page = page_cache.get(key)
+        if page is not None:
+            content, content_type = page
+            return app.response_class(content, content_type=content_type)
+
+        with page_cache.rendering(kwargs.get('job_id')) as rendering:
+            response = view(**kwargs)
+            if response.status_code == 200:
+                page_cache.put(key, rendering, response.data,
+                               response.headers['Content-Type'])
+        return response
+
+    return cached_view
+
 @app.route('/')
+@cached_page
 def index():
+    '''List the roles (logins) with how many jobs are in each state, and the
+    jobs which are not ok.  The ok jobs of a role are fetched via
+    /api/1.0/jobs when asked for.'''
+
+    cursor = jobs_cursor()
+    q = request.args.get('q', '')
+    with session_manager() as session:
+        summary = summarize_roles(session, q)
+        failing = (session
+                       .query(Job)
+                       .filter(Job.deleted == None)
+                       .filter(Job.state_id != job_state_id['ok'])
+                       .order_by(Job.login, Job.host, Job.name))
+        failing = dict((login, list(jobs)) for login, jobs
+                       in groupby(filter_jobs(failing, q),
+                                  lambda job: job.login))
+
+        roles = [(login, summary[login], failing.get(login, []))
+                 for login in sorted(summary)]
+        return render_response('index.html', {'roles': roles,
+                                              'states': state_order,
+                                              'cursor': cursor})
+
+def summarize_roles(session, q, logins=None):
+    '''Return {login: {state: number of jobs}} for the jobs matching q, for
+    all logins, or those in logins.'''
+
+    counts = (session
+                  .query(Job.login, Job.state_id, func.count(Job.id))
+                  .filter(Job.deleted == None)
+                  .group_by(Job.login, Job.state_id))
+    counts = filter_jobs(counts, q)
+    if logins is not None:
+        if not logins:
+            return {}
+        counts = counts.filter(Job.login.in_(logins))
+
+    summary = dict((login, {}) for login in logins or [])
+    for login, state_id, count in counts:
+        summary.setdefault(login, {})[job_state_name[state_id]] = count
+    return summary
+
+state_order = sorted(job_state_id, key=job_state_id.get)
+
+def filter_jobs(jobs, q):
+    'Filter the jobs query to the jobs matching all the words in q.'
+
+    for word in q.strip().split():
+        jobs = jobs.filter(job_search_text.contains(word))
+    return jobs
+
+@app.route('/api/1.0/jobs')
+def jobs():
+    '''List the jobs, or with ?since=cursor, the jobs changed since then.
+
+    The response has a cursor for asking for the next changes, the jobs as
+    compact objects, where deleted jobs are just {id, deleted}, and the
+    summarize_roles of the roles of the jobs.  Jobs changed shortly before
+    the cursor are listed again, so changes which were committed late are
+    not missed.  The jobs can be filtered by ?q=, ?login= and ?state=.'''
+
+    cursor = jobs_cursor()
     with session_manager() as session:
-        jobs = (session
-                    .query(Job)
-                    .filter(Job.deleted == None)
-                    .order_by(Job.login, Job.host, Job.name))
+        query = session.query(Job)
+        since = request.args.get('since')
+        if since:
+            try:
+                since = datetime.strptime(since, cursor_format)
+            except ValueError:
+                raise BadRequest()
+            query = query.filter(Job.changed >= since - JOBS_CURSOR_OVERLAP)
+        else:
+            query = query.filter(Job.deleted == None)
+        q = request.args.get('q', '')
+        query = filter_jobs(query, q)
+        if request.args.get('login'):
+            query = query.filter(Job.login == request.args['login'])
+        if request.args.get('state'):
+            if request.args['state'] not in job_state_id:
+                raise BadRequest()
+            query = query.filter(Job.state_id
+                                     == job_state_id[request.args['state']])
+        jobs = query.order_by(Job.host, Job.name).all()
+
+        return jsonify(
+            cursor=cursor,
+            jobs=[{'id': job.id, 'deleted': True} if job.deleted else
+                  events.job_data(job.id, job.login, job.host, job.name,
+                                  job.state, job.last_seen)
+                  for job in jobs],
+            roles=summarize_roles(session, q,
+                                  set(job.login for job in jobs)))
+
+JOBS_CURSOR_OVERLAP = timedelta(seconds=60)
+cursor_format = '%Y-%m-%dT%H:%M:%S.%f'
+
+def jobs_cursor():
+    return datetime.utcnow().strftime(cursor_format)
+
+@app.route('/api/1.0/events')
+def job_events():
+    '''Stream job events, see proccer.events, as server-sent events.
 
-        text = Job.login + ' ' + Job.host + ' ' + Job.name
-        for q in request.args.get('q', '').strip().split():
-            jobs = jobs.filter(text.contains(q))
+    Clients which fall too far behind are disconnected, and should catch up
+    via /api/1.0/jobs when they reconnect.'''
 
-        return render_response('index.html', {'jobs': jobs.all()})
+    events.broker.listen(engine)
+    subscriber = events.broker.subscribe(app.config['EVENTS_BUFFER_SIZE'])
+
+    def stream():
+        try:
+            yield 'retry: %d\n\n' % (1000 * app.config['EVENTS_RETRY'])
+            for message in subscriber.messages(app.config['EVENTS_KEEPALIVE']):
+                yield message
+        finally:
+            events.broker.unsubscribe(subscriber)
+
+    return app.response_class(stream(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache',
+                                       'X-Accel-Buffering': 'no'})
 
 @app.route('/job/<job_id>/')
+@cached_page
 def job(job_id):
     with session_manager() as session:
         job = Job.get(session, job_id)
@@ -74,26 +225,190 @@ def job(job_id):
 def delete_job(job_id):
     with session_manager() as session:
         job = Job.get(session, job_id)
-        job.deleted = datetime.utcnow()
+        job.deleted = job.changed = datetime.utcnow()
+        emit_events(session, [events.job_event('deleted', job)])
         flash('Job deleted')
+    # The event reaches this process's page cache too, but maybe only after
+    # the redirect, on PostgreSQL.
+    jobs_changed.send(app, job_ids=[job_id])
     return redirect(url_for('index'))
 
+def report_data():
+    '''Read the request body, decompressing it if needed.
+
+    Bodies larger than MAX_REPORT_SIZE, after decompression, are refused
+    without reading the rest, so a small zip-bomb cannot use up memory.'''
+
+    limit = app.config['MAX_REPORT_SIZE']
+    encoding = request.headers.get('Content-Encoding', 'identity')
+    if encoding == 'identity':
+        data = request.stream.read(limit + 1)
+        if len(data) > limit:
+            raise RequestEntityTooLarge()
+        return data
+    elif encoding not in zlib_wbits:
+        raise UnsupportedMediaType()
+
+    decompressor = zlib.decompressobj(zlib_wbits[encoding])
+    parts, size = [], 0
+    try:
+        while True:
+            compressed = request.stream.read(64 * 1024)
+            if not compressed:
+                parts.append(decompressor.flush())
+                break
+            while compressed:
+                part = decompressor.decompress(compressed, limit - size + 1)
+                parts.append(part)
+                size += len(part)
+                if size > limit:
+                    raise RequestEntityTooLarge()
+                compressed = decompressor.unconsumed_tail
+    except zlib.error:
+        log.info('Bad %s report', encoding, exc_info=True)
+        raise BadRequest()
+
+    data = ''.join(parts)
+    if len(data) > limit:
+        raise RequestEntityTooLarge()
+    return data
+
+zlib_wbits = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
 @app.route('/api/1.0/report', methods=['POST'])
 def report():
+    data = report_data()
     try:
-        result = json.loads(request.data, use_decimal=False)
+        result = json.loads(data, use_decimal=False)
     except Exception, e:
         log.info('Bad report', exc_info=True)
         raise BadRequest()
 
-    report_received.send(result)
+    try:
+        validate_report(result)
+    except ValueError, e:
+        log.info('Bad report: %s', e)
+        raise BadRequest()
+
+    queue = ingest_queue()
+    if queue:
+        if not queue.put(result):
+            raise ServiceUnavailable()
+    else:
+        report_received.send(result)
     return jsonify(ok=True)
 
+@app.route('/api/1.0/reports', methods=['POST'])
+def reports():
+    '''Receive many reports, either as a JSON array or as NDJSON.
+
+    The response has a status for each report: 200 if it was stored, 400
+    (and an error) if it was invalid, or 500 if it could not be stored.  The
+    valid reports are stored together, or if that fails, one by one, see
+    store_reports.  With the write-behind queue, 200 is for queued, and once
+    the queue is full the rest of the reports are 503, so the agent cannot
+    have newer reports stored before older ones it sends again.'''
+
+    data = report_data().strip()
+    try:
+        if data.startswith('['):
+            results = json.loads(data, use_decimal=False)
+        else:
+            results = [json.loads(line, use_decimal=False)
+                       for line in data.splitlines() if line.strip()]
+    except Exception, e:
+        log.info('Bad reports', exc_info=True)
+        raise BadRequest()
+
+    queue = ingest_queue()
+    full = False
+    valid, valid_statuses, statuses = [], [], []
+    for result in results:
+        try:
+            validate_report(result)
+        except ValueError, e:
+            statuses.append({'status': 400, 'error': str(e)})
+        else:
+            if queue and (full or not queue.put(result)):
+                full = True
+                statuses.append({'status': 503, 'error': 'Queue is full'})
+                continue
+            statuses.append({'status': 200})
+            valid.append(result)
+            valid_statuses.append(statuses[-1])
+
+    if valid and not queue:
+        errors = store_received(valid)
+        for status, error in zip(valid_statuses, errors or []):
+            if error is not None:
+                status.update(status=500, error='Could not store report')
+    ok = all(status['status'] == 200 for status in statuses)
+    return jsonify(ok=ok, results=statuses)
+
+@app.route('/api/1.0/status')
+def status():
+    queue = ingest_queue()
+    return jsonify(ingest=queue.status() if queue else None)
+
+_ingest_queue = None
+
+def ingest_queue():
+    '''Return the write-behind queue for reports, or None if reports are
+    stored before responding.
+
+    The queue is created on first use in each process, so forking WSGI
+    servers get a writer thread per worker.'''
+
+    global _ingest_queue
+    if not app.config['INGEST_QUEUE_SIZE']:
+        return None
+
+    if _ingest_queue is None or _ingest_queue.pid != os.getpid():
+        _ingest_queue = WriteBehindQueue(store_received,
+                                         app.config['INGEST_QUEUE_SIZE'],
+                                         app.config['INGEST_BATCH_SIZE'],
+                                         app.config['INGEST_MAX_DELAY'])
+        _ingest_queue.start()
+        atexit.register(_ingest_queue.close)
+    return _ingest_queue
+
+def store_received(results):
+    '''Send reports_received for results, returning the errors from
+    storing them, see store_reports.'''
+
+    return dict(reports_received.send(results)).get(many_to_database)
+
+# The pages of reporting jobs are invalidated here, after the reports are
+# committed, rather than by receivers of their own, which could run before
+# the reports are stored.  The listing pages are left to jobs_changed, sent
+# for the reports which change them, see proccer.events.
+
 @report_received.connect
 def to_database(result):
     with session_manager() as session:
-        job = update_proccer_job(session, result)
-        add_proccer_result(session, job, result)
+        record_report(session, result)
+    invalidate_pages([result])
+
+@reports_received.connect
+def many_to_database(results):
+    '''Store results, returning the errors from store_reports.'''
+    with session_manager() as session:
+        errors = store_reports(session, results)
+    invalidate_pages(results)
+    return errors
+
+def invalidate_pages(results):
+    job_ids = [job_id_cache.get((r['host'], r['login'], r['name']))
+               for r in results]
+    # Unknown ids are of new jobs, which have no pages yet.
+    page_cache.invalidate(filter(None, job_ids), listings=False)
+
+@jobs_changed.connect
+def jobs_changed_pages(sender, job_ids, listings=True):
+    page_cache.invalidate(job_ids, listings)
 
 if __name__ == '__main__':
     app.run(host=app.config['HOST'], port=app.config['PORT'])
@@ -1,6 +1,8 @@
-from __future__ import division, print_function
+from __future__ import division, print_function, with_statement
 
+from collections import OrderedDict
 from datetime import timedelta
+from threading import Lock
 
 
 def parse_interval(s):
@@ -23,3 +25,47 @@ intervals = {
     'hours': 60 * 60,
     'days': 24 * 60 * 60,
 }
+
+
+class LRUCache(object):
+    '''Thread-safe mapping of bounded size, which evicts the least recently
+    used entries first.'''
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                return default
+            self.entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.entries.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def evict(self, predicate):
+        'Remove the entries for which predicate(key, value) is true.'
+        with self.lock:
+            for key, value in self.entries.items():
+                if predicate(key, value):
+                    del self.entries[key]
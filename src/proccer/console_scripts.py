@@ -10,14 +10,32 @@ import sys
 default_log_file = os.path.expanduser(os.environ.get('PROCCER_LOG',
                                                      '~/proccer.log'))
 
+
+def add_logging_options(opts):
+    opts.add_option('-v', '--verbose',
+                    action='count', dest='verbosity', default=0)
+    opts.add_option('--logging-configuration',
+                    default=os.environ.get('PROCCER_LOG_CONFIG'))
+    opts.add_option('--log-file', default=default_log_file)
+
 run_processes_opts = OptionParser('Usage: %prog [options] proccess(es)')
 run_processes_opts.add_option('-c', '--configuration',
                               default='proccer.yaml')
-run_processes_opts.add_option('-v', '--verbose',
-                              action='count', dest='verbosity', default=0)
-run_processes_opts.add_option('--logging-configuration',
-                              default=os.environ.get('PROCCER_LOG_CONFIG'))
-run_processes_opts.add_option('--log-file', default=default_log_file)
+run_processes_opts.add_option('-j', '--jobs', type='int', default=1,
+                              help='run up to JOBS processes in parallel')
+add_logging_options(run_processes_opts)
+
+flush_reports_opts = OptionParser('Usage: %prog [options]')
+add_logging_options(flush_reports_opts)
+
+periodic_opts = OptionParser('Usage: %prog [options]')
+periodic_opts.add_option('--daemon', action='store_true', default=False,
+                         help='keep running, and mark jobs late as soon '
+                              'as they are due')
+add_logging_options(periodic_opts)
+
+outbox_opts = OptionParser('Usage: %prog [options]')
+add_logging_options(outbox_opts)
 
 
 log_file_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -96,16 +114,61 @@ def run_processes():
 
     from proccer import agent
     conf = agent.load_configuration(opts.configuration)
-    for name in args:
-        try:
-            log.debug('[%s] starting', name)
-            result = agent.run_process(conf, name)
-            if result:
-                agent.log_for(result)
-                agent.report(result)
-                agent.raise_for(result)
-            log.debug('[%s] done', name)
-
-        except agent.ProcessError, e:
-            log.error('[%s] %s', name, e.args[0])
-            sys.exit(1)
+    failed = False
+    flusher = agent.ReportFlusher()
+    try:
+        for name, result, error in agent.run_processes(conf, args,
+                                                       opts.jobs):
+            try:
+                if error:
+                    raise error
+                if result:
+                    agent.log_for(result)
+                    flusher.report(result)
+                    agent.raise_for(result)
+                log.debug('[%s] done', name)
+
+            except agent.ProcessError, e:
+                log.error('[%s] %s', name, e.args[0])
+                failed = True
+    finally:
+        flusher.close()
+
+    if failed:
+        sys.exit(1)
+
+
+def flush_reports():
+    '''Deliver job-reports left in the spool by earlier runs.'''
+
+    opts, args = flush_reports_opts.parse_args()
+    log = configure_logging(opts)
+
+    from proccer import agent
+    left = agent.flush_reports()
+    if left:
+        log.error('%d job-reports still waiting for delivery', left)
+        sys.exit(1)
+
+
+def run_periodic():
+    '''Check for late jobs and do the other periodic tasks of the manager.'''
+
+    opts, args = periodic_opts.parse_args()
+    configure_logging(opts)
+
+    from proccer import periodic
+    if opts.daemon:
+        periodic.daemon()
+    else:
+        periodic.main()
+
+
+def run_outbox():
+    '''Deliver queued notifications.'''
+
+    opts, args = outbox_opts.parse_args()
+    configure_logging(opts)
+
+    from proccer import outbox
+    outbox.main()
@@ -10,25 +10,101 @@ import logging
 import os
 import re
 from time import strptime
+from weakref import WeakKeyDictionary
 
-from sqlalchemy import create_engine
-from sqlalchemy import Column, ForeignKey
+from sqlalchemy import bindparam, create_engine, event, exc
+from sqlalchemy import Column, ForeignKey, Index, text
 from sqlalchemy import Integer, String, DateTime, Interval
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.orm import scoped_session, sessionmaker, relationship
-from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.pool import NullPool
 
-from proccer.common import parse_interval
+from proccer import events
+from proccer.common import parse_interval, LRUCache
 from proccer.db_types import JSON
-from proccer.notifications import state_change_notification
+from proccer.notifications import state_change_messages, first_attempt
 
 log = logging.getLogger(__name__)
 
+
+def pool_options(database_uri, environ):
+    '''Return connection-pool options for create_engine.
+
+    The pool is configured via environment variables, and setting
+    PROCCER_DB_POOL_SIZE=0 turns pooling off.  SQLite gets the pool
+    SQLAlchemy picks for it.'''
+
+    if make_url(database_uri).drivername.startswith('sqlite'):
+        return {}
+    size = int(environ.get('PROCCER_DB_POOL_SIZE', 5))
+    if not size:
+        return {'poolclass': NullPool}
+    return {
+        'pool_size': size,
+        'max_overflow': int(environ.get('PROCCER_DB_MAX_OVERFLOW', 10)),
+        'pool_recycle': int(environ.get('PROCCER_DB_POOL_RECYCLE', 3600)),
+    }
+
+
+def setup_pool_events(engine, pre_ping):
+    '''Make the pool safe across fork, and optionally ping connections.
+
+    Connections inherited from a parent process, e.g. from before a WSGI
+    server forked its workers, must not be used by the child, so they are
+    dropped without being closed.  With pre_ping, connections are checked
+    with a "SELECT 1" before use, so connections killed by a database restart
+    are replaced instead of failing a request.'''
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        pid = os.getpid()
+        if connection_record.info['pid'] != pid:
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError(
+                'Connection record belongs to pid %s, '
+                'attempting to check out in pid %s'
+                % (connection_record.info['pid'], pid))
+
+        if not pre_ping:
+            return
+        try:
+            cursor = dbapi_connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+        except Exception:
+            raise exc.DisconnectionError('Connection failed pre-ping')
+
+def setup_sqlite_events(engine):
+    '''Make pysqlite leave transactions to SQLAlchemy, so savepoints work.
+
+    pysqlite begins and commits transactions on its own, which breaks
+    SAVEPOINT, used by store_reports.'''
+
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin(connection):
+        connection.execute('BEGIN')
+
 # Configure engine and create session class.
 database_uri = os.environ.get('DATABASE_URL',
                               'postgresql://proccer@localhost/proccer')
-engine = create_engine(database_uri, poolclass=NullPool)
+engine = create_engine(database_uri,
+                       **pool_options(database_uri, os.environ))
+setup_pool_events(engine,
+                  pre_ping=(os.environ.get('PROCCER_DB_PRE_PING') != '0'
+                            and not isinstance(engine.pool, NullPool)))
+setup_sqlite_events(engine)
 Session = scoped_session(sessionmaker(bind=engine))
 
 # Create declarative mappings.
@@ -77,10 +153,21 @@ class Job(Base):
                       nullable=False)
 
     warn_after = Column(Interval, nullable=True)
+    # When the job is late, if it has not been seen again, i.e. last_seen +
+    # warn_after.  Kept up to date so lateness checks can use an index.
+    due_at = Column(DateTime, nullable=True)
     notify = Column(JSON, nullable=True)
+    # When the row was last changed, by the local clock, for clients polling
+    # for changes.
+    changed = Column(DateTime, nullable=True)
 
     state = state_property
 
+    # host/login/name uniquely identifies a job.
+    __table_args__ = (
+        Index('proccer_job_id', 'host', 'login', 'name', unique=True),
+    )
+
     def __unicode__(self):
         return u'%s @ %s / %s' % (self.login,
                                   self.host.split('.')[0],
@@ -98,14 +185,40 @@ class Job(Base):
         return job
 
     @classmethod
-    def get_or_create(cls, session, host, login, name):
-        try:
-            return (session
-                        .query(Job)
-                        .filter_by(host=host, login=login, name=name)
-                        .one())
-        except NoResultFound:
-            return Job.create(session, host, login, name)
+    def get_or_create(cls, session, host, login, name, **defaults):
+        '''Return (job, created) for the job identified by host/login/name.
+
+        Job-ids are cached, so known jobs are fetched by primary key rather
+        than searched for by name; the job is still loaded, since the caller
+        needs its state.  Only record_report, on PostgreSQL, does without
+        loading known jobs, see get_or_create_id.  New jobs are inserted with defaults for the not-null columns, using an
+        insert which does nothing if the job exists, so concurrent first
+        reports for a job cannot create duplicates.'''
+
+        key = (host, login, name)
+        job_id = job_id_cache.get(key)
+        if job_id is not None:
+            job = Job.get(session, job_id)
+            if job and (job.host, job.login, job.name) == key:
+                return job, False
+            job_id_cache.pop(key)  # From a rolled back transaction.
+
+        job = (session
+                   .query(Job)
+                   .filter_by(host=host, login=login, name=name)
+                   .first())
+        created = job is None
+        if created:
+            values = dict(defaults, host=host, login=login, name=name)
+            row = _first(session.execute(insert_job, values))
+            if row is None:
+                # Someone else got there first.
+                created = False
+                row = session.execute(select_job_id, values).first()
+            job = Job.get(session, row[0])
+
+        job_id_cache.put(key, job.id)
+        return job, created
 
     @property
     def results(self):
@@ -121,6 +234,63 @@ class Job(Base):
                     .filter(JobHistory.job_id == self.id)
                     .order_by(JobHistory.started.desc()))
 
+    @classmethod
+    def get_or_create_id(cls, session, host, login, name, **defaults):
+        '''Return (job-id, created) for the job identified by host/login/name.
+
+        Like get_or_create, but without loading the job.  Cached ids are
+        returned as-is, so the caller must check that the id still belongs
+        to the job, and evict it from job_id_cache if not.'''
+
+        key = (host, login, name)
+        job_id = job_id_cache.get(key)
+        if job_id is not None:
+            return job_id, False
+
+        values = dict(defaults, host=host, login=login, name=name)
+        row = session.execute(select_job_id, values).first()
+        created = row is None
+        if created:
+            row = _first(session.execute(insert_job, values))
+            if row is None:
+                created = False
+                row = session.execute(select_job_id, values).first()
+
+        job_id_cache.put(key, row[0])
+        return row[0], created
+
+# What the dashboard filter searches, with LIKE.  On PostgreSQL this exact
+# expression has a trigram index, proccer_job_search.
+job_search_text = Job.login + ' ' + Job.host + ' ' + Job.name
+
+job_id_cache = LRUCache(int(os.environ.get('PROCCER_JOB_CACHE_SIZE', 10000)))
+
+insert_job = text('''
+    insert into proccer_job
+            (host, login, name, last_seen, last_stamp, state, changed)
+        values (:host, :login, :name, :last_seen, :last_stamp, :state,
+                :last_stamp)
+        on conflict (host, login, name) do nothing
+        returning id
+''', bindparams=[bindparam('last_seen', type_=DateTime),
+                 bindparam('last_stamp', type_=DateTime)])
+
+select_job_id = text('''
+    select id from proccer_job
+        where host = :host and login = :login and name = :name
+''')
+
+
+def returned_rows(result):
+    'Return the rows of a statement with RETURNING, as a list.'
+    # SQLite does not describe the returned rows when there are none.
+    return result.fetchall() if result.returns_rows else []
+
+
+def _first(result):
+    rows = returned_rows(result)
+    return rows[0] if rows else None
+
 
 class JobResult(Base):
     __tablename__ = 'proccer_result'
@@ -165,11 +335,48 @@ class JobHistory(Base):
     state = state_property
 
     @classmethod
-    def create(cls, job):
-        history = JobHistory(job=job, started=job.last_seen, state=job.state)
+    def create(cls, job, started=None):
+        history = JobHistory(job=job, started=started or job.last_seen,
+                             state=job.state)
         Session.object_session(job).add(history)
         return history
 
+
+class Notification(Base):
+    __tablename__ = 'proccer_notification'
+
+    id = Column(Integer, primary_key=True)
+
+    created = Column(DateTime, nullable=False)
+    channel = Column(String, nullable=False)
+    # What the notification is about, so it is only queued once.
+    dedupe_key = Column(String, nullable=False)
+    job_id = Column('job', Integer, ForeignKey('proccer_job.id'),
+                    nullable=True)
+    payload = Column(JSON, nullable=False)
+
+    # next_attempt is null once delivered, or when we have given up.
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt = Column(DateTime, nullable=True)
+    delivered = Column(DateTime, nullable=True)
+    last_error = Column(String, nullable=True)
+
+    __table_args__ = (
+        Index('proccer_notification_dedupe', 'channel', 'dedupe_key',
+              unique=True),
+    )
+
+insert_notification = text('''
+    insert into proccer_notification
+            (created, channel, dedupe_key, job, payload, attempts,
+             next_attempt)
+        values (:created, :channel, :dedupe_key, :job, :payload, 0,
+                :next_attempt)
+        on conflict (channel, dedupe_key) do nothing
+''', bindparams=[bindparam('created', type_=DateTime),
+                 bindparam('next_attempt', type_=DateTime),
+                 bindparam('payload', type_=JSON)])
+
 ### FIXME - We're missing the indices.
 
 
@@ -185,26 +392,135 @@ def session_manager():
         Session.remove()
 
 
+@contextmanager
+def autocommit_connection(engine):
+    '''Context manager for a connection in autocommit mode, for statements
+    which cannot run in a transaction, and for holding session-level locks.
+
+    The connection is closed afterwards, rather than handed back to the
+    pool in autocommit mode.'''
+
+    connection = engine.connect()
+    try:
+        dbapi_connection = connection.connection.connection
+        dbapi_connection.rollback()  # From the pool's pre-ping.
+        dbapi_connection.autocommit = True
+        yield connection
+    finally:
+        connection.invalidate()
+
+
+@contextmanager
+def listen_connection(engine, channels):
+    '''Context manager for a DB-API connection LISTENing on channels.
+
+    Wait for it to become readable with select, then poll() it and take the
+    notifications from its notifies list.'''
+
+    with autocommit_connection(engine) as connection:
+        for channel in channels:
+            connection.execute('LISTEN %s' % channel)
+        yield connection.connection.connection
+
+
+def validate_report(result):
+    '''Check that result looks like a report from the agent.
+
+    Raises ValueError if not.'''
+
+    if not isinstance(result, dict):
+        raise ValueError('Report is not an object')
+    for key in ('host', 'login', 'name', 'stamp', 'result', 'clock',
+                'rusage', 'output'):
+        if key not in result:
+            raise ValueError('Missing key %r' % key)
+    if not isinstance(result['result'], dict) or 'ok' not in result['result']:
+        raise ValueError('Bad result %r' % result['result'])
+    if not isinstance(result['clock'], (int, long, float)):
+        raise ValueError('Bad clock %r' % result['clock'])
+    for key in ('host', 'login', 'name', 'output'):
+        if not isinstance(result[key], basestring):
+            raise ValueError('Bad %s %r' % (key, result[key]))
+    try:
+        parse_stamp(result['stamp'])
+    except TypeError:
+        raise ValueError('Bad stamp %r' % result['stamp'])
+
+    # Everything storing the report parses from the config.
+    config = result.get('config', {})
+    if not isinstance(config, dict):
+        raise ValueError('Bad config %r' % config)
+    try:
+        parse_interval(config.get('warn-after'))
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError('Bad warn-after %r' % config.get('warn-after'))
+    notify = config.get('notify')
+    if notify is not None and not (
+            isinstance(notify, list)
+            and all(isinstance(address, basestring) for address in notify)):
+        raise ValueError('Bad notify %r' % notify)
+
+
+def parse_stamp(stamp):
+    return datetime.utcfromtimestamp(timegm(strptime(stamp,
+                                                     '%Y-%m-%dT%H:%M:%SZ')))
+
+
 def update_proccer_job(session, result):
     'Create or update proccer_job row returning the updated row.'
 
-    stamp = datetime.utcfromtimestamp(timegm(strptime(result['stamp'],
-                                                      '%Y-%m-%dT%H:%M:%SZ')))
-    new_state = 'ok' if result['result']['ok'] else 'error'
+    job, created = get_or_create_job(session, result)
+    old_due_at = job.due_at
+    revived = job.deleted is not None
+    if apply_result(job, result, created):
+        update_job_history(job)
+        job_state_changed(job, result)
+        notify_scheduler(session, job.id)
+        emit_events(session, [events.job_event('state', job)])
+    else:
+        if revived or due_earlier(old_due_at, job.due_at):
+            notify_scheduler(session, job.id)
+        kind = 'state' if revived else 'result'
+        emit_events(session, [events.job_event(kind, job)])
+
+    return job
+
+
+def get_or_create_job(session, result):
+    'Find the proccer_job for result, creating it if needed.'
+
+    return Job.get_or_create(session,
+                             host=result['host'],
+                             login=result['login'],
+                             name=result['name'],
+                             last_seen=parse_stamp(result['stamp']),
+                             last_stamp=datetime.utcnow(),
+                             state=job_state_id[result_state(result)])
+
 
-    # Find existing proccer_job
-    job = Job.get_or_create(session,
-                            host=result['host'],
-                            login=result['login'],
-                            name=result['name'])
+def result_state(result):
+    return 'ok' if result['result']['ok'] else 'error'
+
+
+def apply_result(job, result, created=False):
+    '''Update job with the outcome of result.
+
+    Returns True if the job changed state, which new jobs always do.'''
+
+    new_state = result_state(result)
+
+    now = datetime.utcnow()
     if job.deleted:
         log.info('Reviving zombie-job %r', job.id)
         job.deleted = None
-    job.last_seen = stamp
-    old_state, job.state = job.state, new_state
+    job.changed = now
+    job.last_seen = parse_stamp(result['stamp'])
+    old_state = None if created else job.state
+    job.state = new_state
 
     config = result.get('config', {})
     job.warn_after = parse_interval(config.get('warn-after'))
+    job.due_at = due_at(job.last_seen, job.warn_after)
 
     job.notify = config.get('notify')
 
@@ -212,27 +528,125 @@ def update_proccer_job(session, result):
               job.id, old_state, new_state)
 
     if old_state != new_state:
-        job.last_stamp = datetime.utcnow()
-        update_job_history(job)
-        job_state_changed(job, result)
+        job.last_stamp = now
+        return True
+    return False
 
-    return job
 
+def due_at(last_seen, warn_after):
+    'When a job last seen at last_seen is late.'
+    return last_seen + warn_after if warn_after is not None else None
+
+
+def due_earlier(old_due_at, new_due_at):
+    'Did a job become due earlier than it was, or become due at all?'
+    return new_due_at is not None and (old_due_at is None
+                                       or new_due_at < old_due_at)
+
+
+def notify_scheduler(session, job_id):
+    '''Tell the lateness scheduler to look at job_id again, at commit.
+
+    The scheduler, see proccer.periodic, checks jobs again when they come
+    due, so it only needs telling about jobs which change state, or become
+    due earlier.  Only done on PostgreSQL.'''
+
+    if session.bind.dialect.name == 'postgresql':
+        session.execute(notify_job, {'job': str(job_id)})
+
+scheduler_channel = 'proccer_job'
+notify_job = text("select pg_notify('%s', :job)" % scheduler_channel)
+
+
+def emit_events(session, payloads):
+    '''Send events, see events.job_event, to the clients of /api/1.0/events.
+
+    They are only sent if the transaction commits: on PostgreSQL they are
+    NOTIFYd, and elsewhere kept until the commit, see publish_events.'''
 
-def update_job_history(job):
-    if job.history.count():
-        previous = job.history.filter(JobHistory.ended == None).one()
-        previous.ended = job.last_seen
-    JobHistory.create(job)
+    if not payloads:
+        return
+    if session.bind.dialect.name == 'postgresql':
+        session.execute(notify_events, {'payloads': payloads})
+    else:
+        transaction = _savepoint(session.transaction)
+        pending_events.setdefault(transaction, []).extend(payloads)
+
+notify_events = text("select pg_notify('%s', payload) from unnest(:payloads) "
+                     "as payload" % events.channel)
+
+# Events waiting for the transaction, or savepoint, they were emitted in to
+# commit, see emit_events.
+pending_events = WeakKeyDictionary()
+
+def _savepoint(transaction):
+    'Return the savepoint, or outermost transaction, transaction is part of.'
+    while transaction._parent is not None and not transaction.nested:
+        transaction = transaction._parent
+    return transaction
+
+@event.listens_for(Session, 'after_commit')
+def publish_events(session):
+    '''Publish the events of a committed transaction, or hand those of a
+    released savepoint to the transaction around it.'''
+
+    transaction = session.transaction
+    payloads = pending_events.pop(transaction, None)
+    if not payloads:
+        return
+    if transaction._parent is not None:
+        parent = _savepoint(transaction._parent)
+        pending_events.setdefault(parent, []).extend(payloads)
+        return
+    for payload in payloads:
+        events.broker.publish(payload)
+
+@event.listens_for(Session, 'after_soft_rollback')
+def drop_events(session, previous_transaction):
+    pending_events.pop(previous_transaction, None)
+
+
+def update_job_history(job, stamp=None):
+    '''Close the current history row for job, if there is one, and add a new,
+    changing over at stamp, by default job.last_seen.'''
+
+    stamp = stamp or job.last_seen
+    session = Session.object_session(job)
+    session.flush()  # The current row may not have been inserted yet.
+    history = JobHistory.__table__
+    session.execute(history.update()
+                        .where(history.c.job == job.id)
+                        .where(history.c.ended == None)
+                        .values(ended=stamp))
+    JobHistory.create(job, stamp)
 
 
 def job_state_changed(job, result):
-    # FIXME - Background job!
+    'Queue notifications about job changing state.'
+
     try:
-        state_change_notification(job, result)
-    except Exception, ex:
-        log.error('Could not send state-change notification mail',
+        messages = state_change_messages(job, result)
+    except Exception:
+        log.error('Could not make state-change notification',
                   exc_info=True)
+        return
+    queue_notifications(Session.object_session(job), job, messages)
+
+
+def queue_notifications(session, job, messages):
+    '''Queue (channel, dedupe-key, payload) messages about job, for delivery
+    by proccer.outbox.  Messages already queued are ignored.'''
+
+    now = datetime.utcnow()
+    rows = [{'created': now, 'channel': channel, 'dedupe_key': key,
+             'job': job.id, 'payload': payload,
+             'next_attempt': first_attempt(channel, now)}
+            for channel, key, payload in messages]
+    for row in rows:
+        log.info('queueing %s notification %s for job %r', row['channel'],
+                 row['dedupe_key'], job.id)
+    if rows:
+        session.execute(insert_notification, rows)
 
 
 def add_proccer_result(session, job, result):
@@ -243,3 +657,251 @@ def add_proccer_result(session, job, result):
                      result=result['result'],
                      rusage=result['rusage'],
                      output=result['output'])
+
+
+def record_report(session, result):
+    '''Update the job for result, and insert result in proccer_result.
+
+    On PostgreSQL this is a single statement for known jobs which stay in
+    the same state.  State changes take another to update the history, and
+    the job is only loaded then, to notify about it.  Other databases go via
+    update_proccer_job and add_proccer_result.'''
+
+    if session.bind.dialect.name != 'postgresql':
+        job = update_proccer_job(session, result)
+        add_proccer_result(session, job, result)
+        return
+
+    config = result.get('config', {})
+    values = {
+        'host': result['host'],
+        'login': result['login'],
+        'name': result['name'],
+        'state': job_state_id[result_state(result)],
+        'last_seen': parse_stamp(result['stamp']),
+        'last_stamp': datetime.utcnow(),
+        'warn_after': parse_interval(config.get('warn-after')),
+        'notify': config.get('notify'),
+        'clock_ms': int(result['clock'] * 1000),
+        'result': result['result'],
+        'rusage': result['rusage'],
+        'output': result['output'],
+    }
+    values['due_at'] = due_at(values['last_seen'], values['warn_after'])
+
+    key = (values['host'], values['login'], values['name'])
+    row = None
+    job_id = job_id_cache.get(key)
+    if job_id is not None:
+        values.update(job=job_id, created=False)
+        row = _record_result(session, values)
+        if row is None:
+            job_id_cache.pop(key)  # From a rolled back transaction.
+    if row is None:
+        values['job'], values['created'] = Job.get_or_create_id(session,
+                                                                **values)
+        row = _record_result(session, values)
+
+    if row.old_deleted:
+        log.info('Reviving zombie-job %r', row.id)
+    log.debug('old/new state for job %r: %s/%s', row.id,
+              None if values['created'] else job_state_name[row.old_state],
+              job_state_name[values['state']])
+
+    if values['created'] or row.old_state != values['state']:
+        session.execute(record_history, dict(values, job=row.id))
+        job = session.query(Job).populate_existing().get(row.id)
+        job_state_changed(job, result)
+
+def _record_result(session, values):
+    values['event'] = json.dumps(events.job_data(
+        values['job'], values['login'], values['host'], values['name'],
+        job_state_name[values['state']], values['last_seen']))
+    return session.execute(record_result, values).first()
+
+# "notified" does the same as notify_scheduler, and "evented" as
+# emit_events.  The history is updated by record_history, see below.
+record_result = text('''
+    with old as (
+        select id, state, deleted, due_at from proccer_job
+            where id = :job and host = :host and login = :login
+                and name = :name
+            for update
+    ), job as (
+        update proccer_job
+            set deleted = null,
+                last_seen = :last_seen,
+                last_stamp = case when old.state = :state
+                                  then proccer_job.last_stamp
+                                  else :last_stamp end,
+                state = :state,
+                warn_after = :warn_after,
+                due_at = :due_at,
+                notify = :notify,
+                changed = :last_stamp
+            from old
+            where proccer_job.id = old.id
+            returning proccer_job.id, old.state as old_state,
+                old.deleted as old_deleted, old.due_at as old_due_at
+    ), inserted as (
+        insert into proccer_result
+                (job, state, stamp, clock_ms, result, rusage, output)
+            select id, :state, :last_seen, :clock_ms, :result, :rusage,
+                    :output
+                from job
+    ), notified as (
+        select pg_notify('proccer_job', id::text) from job
+            where job.old_state <> :state or :created
+                or job.old_deleted is not null
+                or (:due_at is not null and (job.old_due_at is null
+                                             or :due_at < job.old_due_at))
+    ), evented as (
+        select pg_notify('proccer_event',
+                         case when job.old_state <> :state or :created
+                                   or job.old_deleted is not null
+                              then 'state ' else 'result ' end || :event)
+            from job
+    )
+    select id, old_state, old_deleted
+        from job left join notified on true left join evented on true
+''', bindparams=[bindparam('last_seen', type_=DateTime),
+                 bindparam('last_stamp', type_=DateTime),
+                 bindparam('warn_after', type_=Interval),
+                 bindparam('due_at', type_=DateTime),
+                 bindparam('notify', type_=JSON),
+                 bindparam('result', type_=JSON),
+                 bindparam('rusage', type_=JSON)])
+
+
+# Run after record_result when the job changed state.  This must be a
+# statement of its own: record_result waits for the lock on the job row, but
+# reads the history as of when it started, so it would miss the current row
+# of a concurrent report which changed the state while it waited.  The
+# current row must be closed before the new one is inserted, because of the
+# proccer_history_curr index, so the insert waits for "closed".
+record_history = text('''
+    with closed as (
+        update proccer_history
+            set ended = :last_seen
+            where job = :job and ended is null
+            returning id
+    )
+    insert into proccer_history (job, state, started)
+        select :job, :state, :last_seen
+            where (select count(*) from closed) >= 0
+''', bindparams=[bindparam('last_seen', type_=DateTime)])
+
+
+def add_proccer_results(session, results):
+    '''Update jobs and insert results for many reports in one go.
+
+    This does the same as update_proccer_job and add_proccer_result for each
+    result in turn, but all the proccer_result and proccer_history rows are
+    inserted with one statement each.  On PostgreSQL each result is stored by
+    record_report, which takes a single statement for most.'''
+
+    if session.bind.dialect.name == 'postgresql':
+        for result in results:
+            record_report(session, result)
+        return
+
+    jobs = {}
+    first_due_at = {}
+    changed = set()
+    event_payloads = []
+    open_history = {}
+    closed_history = []
+    history_rows = []
+    result_rows = []
+
+    for result in results:
+        key = (result['host'], result['login'], result['name'])
+        created = False
+        job = jobs.get(key)
+        if job is None:
+            job, created = get_or_create_job(session, result)
+            jobs[key] = job
+            first_due_at[key] = job.due_at
+
+        revived = job.deleted is not None
+        if revived:
+            changed.add(job.id)
+        if apply_result(job, result, created):
+            changed.add(job.id)
+            previous = open_history.get(job.id)
+            if previous:
+                previous['ended'] = job.last_seen
+            else:
+                closed_history.append({'b_job': job.id,
+                                       'b_ended': job.last_seen})
+
+            row = open_history[job.id] = {
+                'job': job.id,
+                'state': job.state_id,
+                'started': job.last_seen,
+                'ended': None,
+            }
+            history_rows.append(row)
+            job_state_changed(job, result)
+            event_payloads.append(events.job_event('state', job))
+        else:
+            kind = 'state' if revived else 'result'
+            event_payloads.append(events.job_event(kind, job))
+
+        result_rows.append({
+            'job': job.id,
+            'state': job.state_id,
+            'stamp': job.last_seen,
+            'clock_ms': int(result['clock'] * 1000),
+            'result': result['result'],
+            'rusage': result['rusage'],
+            'output': result['output'],
+        })
+
+    session.flush()
+
+    history = JobHistory.__table__
+    if closed_history:
+        session.execute(history.update()
+                            .where(history.c.job == bindparam('b_job'))
+                            .where(history.c.ended == None)
+                            .values(ended=bindparam('b_ended')),
+                        closed_history)
+    if history_rows:
+        session.execute(history.insert(), history_rows)
+    if result_rows:
+        session.execute(JobResult.__table__.insert(), result_rows)
+
+    for key, job in jobs.items():
+        if job.id in changed or due_earlier(first_due_at[key], job.due_at):
+            notify_scheduler(session, job.id)
+    emit_events(session, event_payloads)
+
+
+def store_reports(session, results):
+    '''Store many reports, see add_proccer_results, or if that fails, each
+    report under a savepoint of its own, so one bad report cannot keep the
+    others from being stored.
+
+    Returns a list with None for each report stored, and the exception for
+    each report which could not be.'''
+
+    try:
+        with session.begin_nested():
+            add_proccer_results(session, results)
+        return [None] * len(results)
+    except Exception:
+        log.error('Could not store %d reports together, storing them one '
+                  'by one', len(results), exc_info=True)
+
+    errors = []
+    for result in results:
+        try:
+            with session.begin_nested():
+                record_report(session, result)
+        except Exception, e:
+            log.error('Could not store report %r', result, exc_info=True)
+            errors.append(e)
+        else:
+            errors.append(None)
+    return errors
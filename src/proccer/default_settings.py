@@ -7,3 +7,22 @@ DEBUG = True
 RELOAD = True
 
 SECRET_KEY = os.environ.get('SECRET_KEY', 'This is a bad secret.')
+
+# Largest report body accepted, after decompression.
+MAX_REPORT_SIZE = 32 * 1024 * 1024
+
+# With INGEST_QUEUE_SIZE > 0, reports are acknowledged once queued, and
+# stored by a background thread in batches of up to INGEST_BATCH_SIZE,
+# waiting at most INGEST_MAX_DELAY seconds for a batch to fill up.  Queued
+# reports are lost if the manager dies, so this is off by default.
+INGEST_QUEUE_SIZE = 0
+INGEST_BATCH_SIZE = 100
+INGEST_MAX_DELAY = 0.05
+
+# Each client of /api/1.0/events is sent up to EVENTS_BUFFER_SIZE events
+# ahead of what it has read, and disconnected if it falls further behind.
+# Idle streams get a comment every EVENTS_KEEPALIVE seconds, and clients are
+# asked to reconnect after EVENTS_RETRY seconds.
+EVENTS_BUFFER_SIZE = 100
+EVENTS_KEEPALIVE = 15
+EVENTS_RETRY = 5
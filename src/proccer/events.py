@@ -0,0 +1,153 @@
+'''Live job events, for the /api/1.0/events server-sent events stream.
+
+Events are "state" when a job changes state, or is created or revived,
+"result" when a job reports without changing state, and "deleted" when a job
+is deleted, with the job as data.  On PostgreSQL the database layer NOTIFYs them at commit, and a thread in
+each manager process passes them on to its clients, so all clients see the
+events from all processes, including proccer-periodic.  Elsewhere events
+only reach the clients of the process they happen in, at commit.
+
+Each event also sends the jobs_changed signal, for the page cache.'''
+
+from __future__ import with_statement
+
+import jsonlib as json
+import logging
+import os
+from Queue import Queue, Empty, Full
+import select
+from threading import Lock, Thread
+import time
+
+from proccer.signals import jobs_changed
+
+log = logging.getLogger(__name__)
+
+channel = 'proccer_event'
+RESTART_DELAY = 10
+
+
+def job_data(id, login, host, name, state, last_seen):
+    'Return the compact form of a job, used by the API and for events.'
+    return {'id': id, 'login': login, 'host': host, 'name': name,
+            'state': state, 'seen': last_seen.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def job_event(kind, job):
+    'Return the event kind about job as "kind data", as NOTIFY payload.'
+    data = job_data(job.id, job.login, job.host, job.name, job.state,
+                    job.last_seen)
+    if job.deleted:
+        data['deleted'] = True
+    return '%s %s' % (kind, json.dumps(data))
+
+
+class Subscriber(object):
+    'A client of the event stream, with its own bounded buffer.'
+
+    def __init__(self, buffer_size):
+        self.queue = Queue(buffer_size)
+        self.dropped = False
+
+    def messages(self, keepalive):
+        '''Yield the events as server-sent event messages, and comments to
+        keep the connection alive, until dropped.'''
+
+        while not self.dropped:
+            try:
+                message = self.queue.get(timeout=keepalive)
+            except Empty:
+                yield ': keep-alive\n\n'
+                continue
+            if not self.dropped:
+                yield message
+
+
+class EventBroker(object):
+    '''Pass events on to subscribers.
+
+    Subscribers who fall buffer_size events behind are dropped, so one slow
+    client cannot hold up the others or use up memory.  Dropped clients
+    reconnect, and must catch up via /api/1.0/jobs.'''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.subscribers = set()
+        self.listener = None
+
+    def subscribe(self, buffer_size):
+        subscriber = Subscriber(buffer_size)
+        with self.lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, payload):
+        'Pass on the event payload, see job_event, to all the subscribers.'
+
+        kind, data = payload.split(' ', 1)
+        message = 'event: %s\ndata: %s\n\n' % (kind, data)
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.queue.put_nowait(message)
+            except Full:
+                log.info('dropping slow events client')
+                self.drop(subscriber)
+        jobs_changed.send(self, job_ids=[json.loads(data)['id']],
+                          listings=kind != 'result')
+
+    def drop(self, subscriber):
+        subscriber.dropped = True
+        self.unsubscribe(subscriber)
+
+    def drop_all(self):
+        'Drop all the subscribers, as they may have missed events.'
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            self.drop(subscriber)
+
+    def listen(self, engine):
+        '''Start passing on events NOTIFYd on PostgreSQL, if not already
+        doing so in this process.'''
+
+        if engine.dialect.name != 'postgresql':
+            return
+        with self.lock:
+            if self.listener and self.listener[0] == os.getpid():
+                return
+            thread = Thread(target=self._listen_forever, args=(engine,),
+                            name='proccer-events')
+            thread.daemon = True
+            self.listener = (os.getpid(), thread)
+        thread.start()
+
+    def _listen_forever(self, engine):
+        while True:
+            try:
+                self._listen(engine)
+            except Exception:
+                log.error('listening for events failed, restarting',
+                          exc_info=True)
+            self.drop_all()
+            jobs_changed.send(self, job_ids=None)  # Unknown, so all of them.
+            time.sleep(RESTART_DELAY)
+
+    def _listen(self, engine):
+        # Not imported at the top, since proccer.database imports us.
+        from proccer.database import listen_connection
+
+        with listen_connection(engine, [channel]) as listener:
+            while True:
+                select.select([listener], [], [])
+                listener.poll()
+                for notify in listener.notifies:
+                    self.publish(notify.payload)
+                del listener.notifies[:]
+
+broker = EventBroker()
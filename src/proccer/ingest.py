@@ -0,0 +1,131 @@
+'Write-behind queue for storing reports in the background.'
+
+from __future__ import with_statement, division
+
+import logging
+import os
+from Queue import Queue, Empty, Full
+from threading import Lock, Thread
+import time
+
+log = logging.getLogger(__name__)
+
+_stop = object()
+
+
+class WriteBehindQueue(object):
+    '''Bounded queue of reports, written by a background thread.
+
+    The thread takes reports off the queue in micro-batches of up to
+    batch_size reports, waiting at most max_delay seconds for a batch to
+    fill up, and calls write with the list of reports.  Reports for the same
+    job are kept together and in the order they were queued.  write returns
+    a list with None for each report written, and the exception for each
+    report which could not be, like proccer.database.store_reports, or None
+    if all were written.  If writing a batch raises, its reports are written
+    one at a time, so one bad report does not take the others with it.'''
+
+    def __init__(self, write, maxsize, batch_size, max_delay):
+        self.write = write
+        self.queue = Queue(maxsize)
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+
+        self.pid = os.getpid()
+        self.thread = Thread(target=self.run, name='proccer-ingest')
+        self.thread.daemon = True
+
+        self.lock = Lock()
+        self.stats = {
+            'written': 0,
+            'failed': 0,
+            'batches': 0,
+            'last_batch_size': 0,
+            'last_latency': 0.0,
+            'max_latency': 0.0,
+        }
+
+    def start(self):
+        self.thread.start()
+
+    def put(self, result):
+        'Queue result for writing, returning False if the queue is full.'
+        try:
+            self.queue.put_nowait((time.time(), result))
+            return True
+        except Full:
+            return False
+
+    def close(self, timeout=None):
+        'Write what is still queued, and stop the thread.'
+        if self.thread.is_alive():
+            self.queue.put((None, _stop))
+            self.thread.join(timeout)
+
+    def status(self):
+        with self.lock:
+            status = dict(self.stats)
+        status['queued'] = self.queue.qsize()
+        status['max_queued'] = self.queue.maxsize
+        return status
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            stopping = self._fill(batch)
+            if batch:
+                self._write(batch)
+
+    def _fill(self, batch):
+        'Fill batch from the queue, returning True if asked to stop.'
+        deadline = None
+        while len(batch) < self.batch_size:
+            try:
+                if deadline is None:
+                    item = self.queue.get()
+                    deadline = time.time() + self.max_delay
+                else:
+                    item = self.queue.get(timeout=max(deadline - time.time(),
+                                                      0))
+            except Empty:
+                return False
+
+            if item[1] is _stop:
+                return True
+            batch.append(item)
+        return False
+
+    def _write(self, batch):
+        # A stable sort keeps each job's reports in order.
+        batch.sort(key=lambda (queued, r): (r['host'], r['login'], r['name']))
+        results = [result for _, result in batch]
+
+        try:
+            errors = self.write(results)
+        except Exception:
+            log.error('error writing %d reports, writing one at a time',
+                      len(results), exc_info=True)
+            errors = [self._write_one(result) for result in results]
+        failed = len([error for error in errors or [] if error is not None])
+
+        latency = time.time() - min(queued for queued, _ in batch)
+        log.debug('wrote %d reports, %.3fs after the first was queued',
+                  len(batch), latency)
+        with self.lock:
+            self.stats['written'] += len(batch) - failed
+            self.stats['failed'] += failed
+            self.stats['batches'] += 1
+            self.stats['last_batch_size'] = len(batch)
+            self.stats['last_latency'] = latency
+            self.stats['max_latency'] = max(self.stats['max_latency'],
+                                            latency)
+
+    def _write_one(self, result):
+        'Write result on its own, returning the error if it fails.'
+        try:
+            errors = self.write([result])
+        except Exception, e:
+            log.error('error writing report %r', result, exc_info=True)
+            return e
+        return errors[0] if errors else None
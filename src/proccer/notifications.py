@@ -1,22 +1,29 @@
 from __future__ import with_statement
 
-from commands import getoutput
-from contextlib import closing
+from calendar import timegm
+from datetime import datetime, timedelta
 from email.mime.text import MIMEText
-from email.utils import make_msgid
+from email.utils import make_msgid, mktime_tz, parsedate_tz
 from genshi.template import NewTextTemplate as TextTemplate
 import json
 import logging
 import os
 import requests
 import smtplib
+import socket
 from socket import gethostname
+from threading import Lock
+from textwrap import wrap
+import time
 
 log = logging.getLogger(__name__)
 
 # 64K should be enough for anyone.
 MAX_OUTPUT_SIZE = 64 * 1024
 
+# Seconds to wait for the mail-server or Slack.
+delivery_timeout = 30
+
 default_recipient = os.environ.get('PROCCER_DEFAULT_NOTIFY')
 mail_from = os.environ.get('PROCCER_MAIL_FROM', 'proccer@localhost')
 mail_reply_to = os.environ.get('PROCCER_REPLY_TO')
@@ -28,37 +35,141 @@ default_api_url = 'https://slack.com/services/hooks/incoming-webhook'
 slack_api_url = os.environ.get('SLACK_API_URL', default_api_url)
 slack_api_token = os.environ.get('SLACK_API_TOKEN')
 slack_channel = os.environ.get('SLACK_CHANNEL', '#general')
+# Slack notifications queued within this many seconds of each other are
+# sent as one message, with up to slack_max_attachments attachments.
+slack_coalesce_window = timedelta(
+    seconds=int(os.environ.get('SLACK_COALESCE_SECONDS', 10)))
+slack_max_attachments = 20
 
+slack_session = requests.Session()
 
-def state_change_notification(job, result):
-    msg, rcpt = mail_for_state(job, job.state, result)
-    if msg:
-        send_mail(msg, rcpt)
+# Recipients who get a digest of the state changes every digest_window
+# instead of a mail per state change.  Jobs can also ask for digests with
+# "digest:address" in their notify list.
+digest_recipients = set(filter(None, [
+    address.strip()
+    for address in os.environ.get('PROCCER_DIGEST_RECIPIENTS', '').split(',')
+]))
+digest_window = timedelta(
+    seconds=int(os.environ.get('PROCCER_DIGEST_SECONDS', 5 * 60)))
+_slack_blocked_until = 0  # From the Retry-After of the last 429 response.
+
+
+class RetryLater(Exception):
+    'Delivery was refused for now, and should be tried after retry_after.'
+
+    def __init__(self, message, retry_after):
+        Exception.__init__(self, message)
+        self.retry_after = retry_after
 
-    notify_slack(job, job.state)
 
+def state_change_messages(job, result):
+    '''Return a list of (channel, dedupe-key, payload) notifications about
+    job changing state.'''
+
+    key = '%d:%s:%s' % (job.id, job.state, job.last_seen.isoformat())
+    return _messages(job, job.state, result, key)
+
+
+def repeat_messages(job):
+    '''Return a list of (channel, dedupe-key, payload) reminders about job
+    still being in a bad state.'''
 
-def repeat_notification(job):
     job_result = job.results.first()
     result = {
         'output': job_result.output if job_result else '',
         'config': {},
     }
-    msg, rcpt = mail_for_state(job, 'still ' + job.state, result)
+    key = '%d:still %s:%s' % (job.id, job.state, job.last_stamp.isoformat())
+    return _messages(job, 'still ' + job.state, result, key)
+
+
+def _messages(job, state, result, key):
+    messages = []
+    msg, rcpt = mail_for_state(job, state, result)
     if msg:
-        send_mail(msg, rcpt)
+        messages.append(('mail', key, {'rcpt': rcpt,
+                                       'message': msg.as_string()}))
+    for address in recipients(job)[1]:
+        messages.append(('digest', '%s:%s' % (key, address),
+                         digest_payload(job, state, address)))
+    if slack_api_token:
+        messages.append(('slack', key, slack_payload(job, state)))
+    return messages
+
+
+def first_attempt(channel, now):
+    '''When to first try delivering a notification for channel queued now.
+
+    Slack notifications are held back a little, and digests until the end
+    of the current digest window, so they can be merged.'''
+
+    if channel == 'slack':
+        return now + slack_coalesce_window
+    window = int(digest_window.total_seconds())
+    if channel == 'digest' and window > 0:
+        since_epoch = timegm(now.utctimetuple())
+        return datetime.utcfromtimestamp(since_epoch - since_epoch % window
+                                         + window)
+    return now
+
+
+def merge_key(channel, payload):
+    '''Notifications with the same merge-key are delivered as one message,
+    see merge.  None means the notification is delivered on its own.'''
+
+    if channel == 'slack':
+        return payload['channel']
+    if channel == 'digest':
+        return payload['rcpt']
+    return None
+
+
+def max_merged(channel):
+    'The most notifications for channel to merge into one message.'
+    return slack_max_attachments if channel == 'slack' else None
+
 
-    notify_slack(job, 'still ' + job.state)
+def merge(channel, payloads):
+    '''Merge payloads for channel into one payload, to be delivered as
+    one message.  Only Slack payloads for the same Slack channel, and
+    digests for the same recipient, can be merged.'''
 
+    if len(payloads) == 1:
+        return payloads[0]
 
-def notify_slack(job, state):
-    if not slack_api_token:
-        return
+    merged = dict(payloads[0])
+    if channel == 'slack':
+        merged['attachments'] = [attachment for payload in payloads
+                                 for attachment in payload['attachments']]
+    elif channel == 'digest':
+        merged['entries'] = [entry for payload in payloads
+                             for entry in payload['entries']]
+    else:
+        raise ValueError('Cannot merge %s notifications' % channel)
+    return merged
 
+
+def deliver(channel, payload):
+    '''Deliver a notification made by state_change_messages or
+    repeat_messages.  Raises an exception if delivery failed.'''
+
+    if channel == 'mail':
+        send_mail_string(payload['message'], payload['rcpt'])
+    elif channel == 'digest':
+        msg = mail_for_digest(payload['entries'])
+        send_mail_string(msg.as_string(), [payload['rcpt']])
+    elif channel == 'slack':
+        post_slack(payload)
+    else:
+        raise ValueError('Unknown notification channel %r' % channel)
+
+
+def slack_payload(job, state):
     url = '%s/job/%d/' % (web_url, job.id)
     color = slack_colors.get(state.replace('still ', ''), 'warning')
     text = '<%s|%s> %s' % (url, unicode(job), state)
-    payload = {
+    return {
         'channel': slack_channel,
         'username': 'proccer',
         'icon_emoji': ':penguin:',
@@ -70,11 +181,41 @@ def notify_slack(job, state):
             },
         ],
     }
-    response = requests.post(slack_api_url,
-                             params={'token': slack_api_token},
-                             data={'payload': json.dumps(payload)})
+
+
+def post_slack(payload):
+    '''Post payload to Slack, over a kept-alive connection.
+
+    Raises RetryLater when Slack asks us to slow down, and without posting
+    until Slack said we could try again.'''
+
+    global _slack_blocked_until
+    wait = _slack_blocked_until - time.time()
+    if wait > 0:
+        raise RetryLater('Slack rate-limit, %ds left' % wait, wait)
+
+    response = slack_session.post(slack_api_url,
+                                  params={'token': slack_api_token},
+                                  data={'payload': json.dumps(payload)},
+                                  timeout=delivery_timeout)
+    if response.status_code == 429:
+        wait = parse_retry_after(response.headers.get('Retry-After'))
+        _slack_blocked_until = time.time() + wait
+        raise RetryLater('Slack rate-limit, retry after %ds' % wait, wait)
     response.raise_for_status()
 
+
+def parse_retry_after(value, default=60):
+    'Seconds to wait according to a Retry-After header.'
+
+    if value:
+        if value.strip().isdigit():
+            return int(value)
+        date = parsedate_tz(value)
+        if date:
+            return max(mktime_tz(date) - time.time(), 0)
+    return default
+
 slack_colors = {
     'ok': 'good',
     'late': 'warning',
@@ -82,18 +223,32 @@ slack_colors = {
 }
 
 
+def recipients(job):
+    '''Return (immediate, digest) lists of addresses to notify about job.'''
+
+    immediate, digest = [], []
+    for address in job.notify or filter(None, [default_recipient]):
+        if address.startswith('digest:'):
+            digest.append(address[len('digest:'):].strip())
+        elif address in digest_recipients:
+            digest.append(address)
+        else:
+            immediate.append(address)
+    return immediate, digest
+
+
 def mail_for_state(job, state, result):
-    if not (job.notify or default_recipient):
+    rcpt = recipients(job)[0]
+    if not rcpt:
         log.debug('nobody to notify for job %r state-change', job.id)
         return None, None
-    rcpt = job.notify or [default_recipient]
 
     tag = '[%s]' % unicode(job).replace(' ', '')
     subject = '%s %s' % (tag, state)
 
     values = {
         'url': web_url,
-        'getoutput': getoutput,
+        'banner': banner(state),
         'job': job,
         'state': state,
     }
@@ -115,24 +270,174 @@ def mail_for_state(job, state, result):
         msg['Reply-To'] = mail_reply_to
     msg['To'] = ', '.join(rcpt)
 
-    log.info('sending %s notification for job %r to %r message-id %s',
-             state, job.id, rcpt, msg['Message-ID'])
-
     return msg, rcpt
 
 
+def digest_payload(job, state, address):
+    return {
+        'rcpt': address,
+        'entries': [{
+            'job': unicode(job),
+            'job_id': job.id,
+            'state': state,
+            'last_seen': unicode(job.last_seen),
+        }],
+    }
+
+
+def mail_for_digest(entries):
+    '''Return a summary mail of the state changes in entries, made by
+    digest_payload.'''
+
+    states = sorted(set(entry['state'] for entry in entries))
+    subject = '[proccer] %d state changes: %s' % (len(entries),
+                                                  ', '.join(states))
+    body = digest_template.generate(url=web_url,
+                                    entries=entries).render('text')
+
+    msg = MIMEText(body)
+    msg['Message-ID'] = make_msgid(gethostname())
+    msg['Subject'] = subject
+    msg['From'] = mail_from
+    if mail_reply_to:
+        msg['Reply-To'] = mail_reply_to
+
+    log.debug('made digest of %d state changes, message-id %s',
+             len(entries), msg['Message-ID'])
+
+    return msg
+
+
 def send_mail(msg, rcpt):
+    send_mail_string(msg.as_string(), rcpt)
+
+
+def send_mail_string(msg, rcpt):
     env_rcpt = rcpt
     env_from = 'proccer@' + gethostname()
-    with closing(smtplib.SMTP(smtp_host)) as smtp:
-        smtp.sendmail(env_from, env_rcpt, msg.as_string())
+    smtp_pool.sendmail(env_from, env_rcpt, msg)
+
+
+class SMTPPool(object):
+    '''Open SMTP connections to host, kept for sending more messages.
+
+    Each connection is used by one thread at a time, and up to size idle
+    connections are kept.  Connections idle for idle_timeout seconds are
+    closed instead of reused, since the server has likely given up on them.
+    If a reused connection turns out to be dead anyway, the message is sent
+    again on a new connection.'''
+
+    def __init__(self, host, size=4, idle_timeout=60, timeout=None):
+        self.host = host
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.lock = Lock()
+        self.idle = []  # (last used, connection), most recently used last.
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        smtp, reused = self._get()
+        try:
+            try:
+                smtp.sendmail(from_addr, to_addrs, msg)
+            except (smtplib.SMTPServerDisconnected, socket.error):
+                if not reused:
+                    raise
+                log.debug('SMTP connection to %s went away, reconnecting',
+                          self.host)
+                _quit(smtp)
+                smtp = self._connect()
+                smtp.sendmail(from_addr, to_addrs, msg)
+        except:
+            _quit(smtp)
+            raise
+        self._put(smtp)
+
+    def close(self):
+        'Close the idle connections.'
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for _, smtp in idle:
+            _quit(smtp)
+
+    def _get(self):
+        now = time.time()
+        with self.lock:
+            stale = [smtp for last_used, smtp in self.idle
+                     if now - last_used >= self.idle_timeout]
+            self.idle = [(last_used, smtp) for last_used, smtp in self.idle
+                         if now - last_used < self.idle_timeout]
+            smtp = self.idle.pop()[1] if self.idle else None
+
+        for connection in stale:
+            _quit(connection)
+        if smtp is not None:
+            return smtp, True
+        return self._connect(), False
+
+    def _put(self, smtp):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((time.time(), smtp))
+                return
+        _quit(smtp)
+
+    def _connect(self):
+        return smtplib.SMTP(self.host, timeout=self.timeout)
+
+
+def _quit(smtp):
+    try:
+        smtp.quit()
+    except (smtplib.SMTPException, socket.error):
+        smtp.close()
+
+smtp_pool = SMTPPool(smtp_host, timeout=delivery_timeout)
+
+def banner(state):
+    'The cow at the top of mail about state, only rendered once per state.'
+
+    try:
+        return _banners[state]
+    except KeyError:
+        if state == 'ok':
+            text = cowsay('Job okay.')
+        elif state == 'error':
+            text = cowsay('JOB FAILED!', eyes='OO')
+        else:
+            text = cowsay('Job %s' % state, eyes='Oo')
+        _banners[state] = text
+        return text
+
+_banners = {}
+
+
+def cowsay(text, eyes='oo'):
+    'Render text as said by the default cowsay(1) cow.'
+
+    lines = wrap(text, 39) or ['']
+    width = max(len(line) for line in lines)
+    if len(lines) == 1:
+        borders = [('<', '>')]
+    else:
+        borders = ([('/', '\\')] + [('|', '|')] * (len(lines) - 2)
+                   + [('\\', '/')])
+
+    balloon = [' ' + '_' * (width + 2)]
+    balloon.extend('%s %s %s' % (left, line.ljust(width), right)
+                   for line, (left, right) in zip(lines, borders))
+    balloon.append(' ' + '-' * (width + 2))
+    return '\n'.join(balloon) + cow % {'eyes': eyes}
+
+cow = r'''
+        \   ^__^
+         \  (%(eyes)s)\_______
+            (__)\       )\/\
+                ||----w |
+                ||     ||'''
 
 body_template = TextTemplate('''\
-{% if state == 'ok' %}${getoutput('cowsay "Job okay."')}{% end %}\
-{% if state == 'error' %}${getoutput('cowsay -e OO "JOB FAILED!"')}{% end %}\
-{% if state not in ['ok', 'error'] %}\
-${getoutput('cowsay -e Oo "Job %s"' % state)}\
-{% end %}
+${banner}
 
 Job:       ${job}
 {% if url %}
@@ -150,3 +455,14 @@ Output truncated.
 {% end %}\
 {% end %}\
 ''')
+
+digest_template = TextTemplate('''\
+${len(entries)} jobs changed state:
+
+{% for entry in entries %}\
+${entry.state.ljust(12)} ${entry.job}, last seen ${entry.last_seen}
+{% if url %}\
+             ${url}/job/${entry.job_id}/
+{% end %}\
+{% end %}\
+''')
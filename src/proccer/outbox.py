@@ -0,0 +1,195 @@
+'''Deliver notifications queued in proccer_notification.
+
+Run as ``proccer-outbox`` next to the manager.  Notifications are
+queued in the same transaction as the state change they are about, and
+delivered here, so neither report ingestion nor the periodic checks wait on
+the mail-server or Slack.'''
+
+from __future__ import with_statement
+
+from datetime import datetime, timedelta
+import logging
+import logging.config
+from multiprocessing.pool import ThreadPool
+import os
+import time
+
+from sqlalchemy import bindparam, text
+from sqlalchemy import DateTime
+
+from proccer import notifications
+from proccer.database import Notification, returned_rows, session_manager
+from proccer.db_types import JSON
+
+log = logging.getLogger('proccer')
+
+workers = int(os.environ.get('PROCCER_NOTIFY_WORKERS', 4))
+max_attempts = int(os.environ.get('PROCCER_NOTIFY_MAX_ATTEMPTS', 10))
+batch_size = 100
+poll_interval = 5
+
+# Claimed notifications are not tried again by others until the lease runs
+# out.  The lease is renewed while the batch is being delivered, which can
+# take much longer, so it only runs out if the worker died.
+lease_time = timedelta(minutes=5)
+renew_interval = lease_time // 3
+retry_delay = timedelta(seconds=30)
+max_retry_delay = timedelta(hours=1)
+
+
+def backoff(attempts):
+    'How long to wait before trying again after attempts failed attempts.'
+    return min(retry_delay * 2 ** min(attempts - 1, 16), max_retry_delay)
+
+
+def deliver_due(pool, limit=batch_size):
+    '''Claim and deliver notifications which are due, using pool.
+
+    Returns the number of notifications tried.'''
+
+    now = datetime.utcnow()
+    lease = now + lease_time
+    with session_manager() as session:
+        claimed = returned_rows(session.execute(
+            claim_notifications,
+            {'now': now, 'lease': lease, 'limit': limit}))
+    if not claimed:
+        return 0
+
+    groups = _groups(claimed)
+    delivering = pool.map_async(_deliver, groups)
+    while not delivering.ready():
+        delivering.wait(renew_interval.total_seconds())
+        if not delivering.ready():
+            lease = _renew_lease(claimed, lease)
+    outcomes = delivering.get()
+
+    now = datetime.utcnow()
+    with session_manager() as session:
+        for group, (error, retry_after) in zip(groups, outcomes):
+            for notification in group:
+                _record_outcome(session, notification, error, retry_after,
+                                now)
+    return len(claimed)
+
+# Updating next_attempt again makes sure concurrent workers do not both
+# claim a notification.
+claim_notifications = text('''
+    update proccer_notification
+        set next_attempt = :lease, attempts = attempts + 1
+        where id in (select id from proccer_notification
+                         where next_attempt <= :now
+                         order by next_attempt, id
+                         limit :limit)
+            and next_attempt <= :now
+        returning id, channel, payload, attempts
+''', bindparams=[bindparam('now', type_=DateTime),
+                 bindparam('lease', type_=DateTime)],
+     typemap={'payload': JSON})
+
+
+def _renew_lease(claimed, lease):
+    '''Extend the lease on the claimed notifications, returning the new
+    lease.  Notifications whose lease has already run out, and may have been
+    claimed by someone else, are left alone.'''
+
+    renewed = datetime.utcnow() + lease_time
+    notification = Notification.__table__
+    with session_manager() as session:
+        session.execute(notification.update()
+                            .where(notification.c.id.in_(
+                                [row.id for row in claimed]))
+                            .where(notification.c.next_attempt == lease)
+                            .values(next_attempt=renewed))
+    return renewed
+
+
+def _groups(claimed):
+    '''Split claimed notifications into groups which are delivered as one
+    message, see notifications.merge.'''
+
+    groups = []
+    merged = {}
+    for notification in claimed:
+        channel = notification.channel
+        key = notifications.merge_key(channel, notification.payload)
+        if key is None:
+            groups.append([notification])
+            continue
+
+        group = merged.get((channel, key))
+        limit = notifications.max_merged(channel)
+        if group is None or (limit and len(group) >= limit):
+            group = merged[channel, key] = []
+            groups.append(group)
+        group.append(notification)
+    return groups
+
+
+def _deliver(group):
+    '''Deliver group of notifications, returning (error, retry-after),
+    which are None on success.'''
+
+    channel = group[0].channel
+    log.info('sending %s notifications %r', channel,
+             [notification.id for notification in group])
+    try:
+        notifications.deliver(channel, notifications.merge(
+            channel, [notification.payload for notification in group]))
+    except notifications.RetryLater, e:
+        log.info('delaying %d %s notifications: %s', len(group), channel, e)
+        return str(e), e.retry_after
+    except Exception, e:
+        log.warning('could not deliver %s notifications %r: %s', channel,
+                    [notification.id for notification in group], e,
+                    exc_info=True)
+        return str(e) or e.__class__.__name__, None
+    return None, None
+
+
+def _record_outcome(session, notification, error, retry_after, now):
+    values = {'id': notification.id, 'now': now, 'error': error,
+              'attempts': notification.attempts,
+              'delivered': None, 'next_attempt': None}
+    if error is None:
+        values['delivered'] = now
+    elif retry_after is not None:
+        # Being told to wait does not count as a failed attempt.
+        values['attempts'] -= 1
+        values['next_attempt'] = now + timedelta(seconds=retry_after)
+    elif notification.attempts >= max_attempts:
+        log.error('giving up on %s notification %r after %d attempts: %s',
+                  notification.channel, notification.id,
+                  notification.attempts, error)
+    else:
+        values['next_attempt'] = now + backoff(notification.attempts)
+    session.execute(update_notification, values)
+
+update_notification = text('''
+    update proccer_notification
+        set next_attempt = :next_attempt, delivered = :delivered,
+            last_error = :error, attempts = :attempts
+        where id = :id
+''', bindparams=[bindparam('next_attempt', type_=DateTime),
+                 bindparam('delivered', type_=DateTime)])
+
+
+def main():
+    log.debug('delivering notifications with %d workers', workers)
+    pool = ThreadPool(workers)
+    notifications.smtp_pool.size = workers
+    while True:
+        try:
+            if deliver_due(pool) == batch_size:
+                continue  # There may be more waiting.
+        except Exception:
+            log.error('error delivering notifications', exc_info=True)
+        time.sleep(poll_interval)
+
+if __name__ == '__main__':
+    log_conf = os.environ.get('LOGGING_CONFIGURATION')
+    if log_conf:
+        logging.config.fileConfig(log_conf, disable_existing_loggers=0)
+    else:
+        logging.basicConfig(level=logging.DEBUG, disable_existing_loggers=0)
+    main()
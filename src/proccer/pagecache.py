@@ -0,0 +1,96 @@
+'''Rendered dashboard pages, kept until the jobs they show change.
+
+Pages are kept by path and query string, tagged with the id of the job they
+show, or None for pages listing all the jobs, like the index.  When a job
+reports, its page is dropped; the listing pages are only dropped when jobs
+change state, appear or disappear, since the dashboard patches in the rest
+itself.  Changes which send no signal, like results expiring, show after at
+most max_age seconds.'''
+
+from __future__ import with_statement
+
+from contextlib import contextmanager
+import os
+from threading import Lock
+import time
+
+from proccer.common import LRUCache
+
+
+class PageCache(object):
+    'Up to size rendered pages, each kept for at most max_age seconds.'
+
+    def __init__(self, size, max_age):
+        self.pages = LRUCache(size)
+        self.max_age = max_age
+        self.lock = Lock()
+        # The pages being rendered, see rendering.
+        self.renderings = set()
+
+    def get(self, key):
+        'Return the (content, content-type) of the page at key, or None.'
+        page = self.pages.get(key)
+        if page is None:
+            return None
+        expires, job_id, content, content_type = page
+        if expires < time.time():
+            self.pages.pop(key)
+            return None
+        return content, content_type
+
+    @contextmanager
+    def rendering(self, job_id):
+        '''Context manager for rendering a page showing job_id, giving the
+        Rendering to put it with.
+
+        Pages whose jobs are invalidated while they are being rendered may
+        show the old state, so they are not kept.'''
+
+        rendering = Rendering(job_id)
+        with self.lock:
+            self.renderings.add(rendering)
+        try:
+            yield rendering
+        finally:
+            with self.lock:
+                self.renderings.discard(rendering)
+
+    def put(self, key, rendering, content, content_type):
+        page = (time.time() + self.max_age, rendering.job_id, content,
+                content_type)
+        with self.lock:
+            if not rendering.stale:
+                self.pages.put(key, page)
+
+    def invalidate(self, job_ids=None, listings=True):
+        '''Drop the pages of job_ids, and if listings the listing pages, or
+        all pages if job_ids is None.'''
+
+        if job_ids is not None:
+            job_ids = set(str(job_id) for job_id in job_ids)
+
+        def dropped(job_id):
+            if job_ids is None:
+                return True
+            return listings if job_id is None else job_id in job_ids
+
+        with self.lock:
+            for rendering in self.renderings:
+                if dropped(rendering.job_id):
+                    rendering.stale = True
+            self.pages.evict(lambda key, page: dropped(page[1]))
+
+    def clear(self):
+        self.invalidate()
+
+
+class Rendering(object):
+    'A page showing job_id, or a listing page if None, being rendered.'
+
+    def __init__(self, job_id):
+        self.job_id = str(job_id) if job_id is not None else None
+        self.stale = False
+
+
+page_cache = PageCache(int(os.environ.get('PROCCER_PAGE_CACHE_SIZE', 100)),
+                       int(os.environ.get('PROCCER_PAGE_CACHE_MAX_AGE', 60)))
@@ -3,71 +3,456 @@
 from __future__ import with_statement
 
 from datetime import datetime, timedelta
+from heapq import heapify, heappop, heappush
 import logging
 import logging.config
 import os
+import re
+import select
+import time
+from zlib import crc32
 
-from proccer.database import session_manager
-from proccer.database import Job, JobResult, job_state_id
-from proccer.notifications import (state_change_notification,
-                                   repeat_notification)
+from sqlalchemy import bindparam, text
+from sqlalchemy import DateTime
+
+from proccer.database import engine, session_manager
+from proccer.database import autocommit_connection, listen_connection
+from proccer.database import Job, Notification, job_state_id
+from proccer.database import job_state_changed, queue_notifications
+from proccer.database import update_job_history, emit_events, Session
+from proccer.database import scheduler_channel
+from proccer.db_types import JSON
+from proccer.events import job_event
+from proccer.notifications import repeat_messages
 
 log = logging.getLogger('proccer')
 
 STILL_BAD_INTERVAL = timedelta(seconds=6 * 60 * 60)
 OLD_RESULT_INTERVAL = timedelta(days=7)
+RESULT_DELETE_BATCH = 5000
+RESULT_DELETE_BUDGET = timedelta(minutes=2)
+RESULT_PARTITIONS_AHEAD = 7
+
+# How often the daemon does the periodic tasks other than lateness checks.
+HOUSEKEEPING_INTERVAL = timedelta(minutes=10)
+RESTART_DELAY = 10
+# How often a standby daemon checks whether the leader is gone.
+STANDBY_INTERVAL = 10
 
 
 def send_lateness_notifications(session):
-    'Send warnings about any jobs that are late.'
+    '''Send warnings about any jobs that are late.
+
+    On PostgreSQL the jobs are marked late with a single statement, which
+    skips jobs locked by report ingestion; they are looked at again on the
+    next run.'''
 
     now = datetime.utcnow()
+    if session.bind.dialect.name != 'postgresql':
+        late = (session
+                    .query(Job)
+                    .filter(Job.deleted == None)
+                    .filter(Job.due_at < now)
+                    .filter(Job.state_id == job_state_id['ok']))
+        for job in late:
+            mark_late(job, now)
+        return
+
     late = (session
                 .query(Job)
-                .filter(Job.deleted == None)
-                .filter(Job.last_seen + Job.warn_after < now)
-                .filter(Job.state_id == job_state_id['ok']))
-
+                .from_statement(mark_late_jobs)
+                .params(now=now, ok=job_state_id['ok'],
+                        late=job_state_id['late'])
+                .all())
     for job in late:
         log.debug('late: %r', job)
-        job.last_stamp = now
-        job.state = 'late'
-        state_change_notification(job, None)
+        job_state_changed(job, None)
+    emit_events(session, [job_event('state', job) for job in late])
+
+
+def mark_late(job, now):
+    log.debug('late: %r', job)
+    job.last_stamp = job.changed = now
+    job.state = 'late'
+    update_job_history(job, job.due_at)
+    job_state_changed(job, None)
+    emit_events(Session.object_session(job), [job_event('state', job)])
+
+# Jobs are late from when they were due, so that is when the history rows
+# change; "opened" waits for "closed" as in database.record_result.
+mark_late_jobs = text('''
+    with due as (
+        select id from proccer_job
+            where deleted is null and state = :ok and due_at < :now
+            for update skip locked
+    ), job as (
+        update proccer_job
+            set state = :late, last_stamp = :now, changed = :now
+            from due
+            where proccer_job.id = due.id
+            returning proccer_job.*
+    ), closed as (
+        update proccer_history
+            set ended = job.due_at
+            from job
+            where proccer_history.job = job.id and ended is null
+            returning proccer_history.id
+    ), opened as (
+        insert into proccer_history (job, state, started)
+            select id, :late, due_at from job
+                where (select count(*) from closed) >= 0
+    )
+    select * from job
+''', bindparams=[bindparam('now', type_=DateTime)],
+     typemap={'notify': JSON})
 
 
 def send_still_bad_notifications(session):
-    'Send warnings about any jobs that have been not-ok for > 6 hours.'
+    '''Send warnings about any jobs that have been not-ok for > 6 hours.
+
+    Like send_lateness_notifications, a single statement on PostgreSQL.'''
 
     now = datetime.utcnow()
-    still_bad = (session
-                    .query(Job)
-                    .filter(Job.deleted == None)
-                    .filter(Job.last_stamp + STILL_BAD_INTERVAL < now)
-                    .filter(Job.state_id != job_state_id['ok'])
-                    .filter(Job.warn_after != None))
+    if session.bind.dialect.name != 'postgresql':
+        still_bad = (session
+                        .query(Job)
+                        .filter(Job.deleted == None)
+                        .filter(Job.last_stamp < now - STILL_BAD_INTERVAL)
+                        .filter(Job.state_id != job_state_id['ok'])
+                        .filter(Job.warn_after != None)
+                        .all())
+        for job in still_bad:
+            job.last_stamp = now
+    else:
+        still_bad = (session
+                        .query(Job)
+                        .from_statement(touch_still_bad_jobs)
+                        .params(now=now, before=now - STILL_BAD_INTERVAL,
+                                ok=job_state_id['ok'])
+                        .all())
 
     for job in still_bad:
         log.debug('still not-good: %r', job)
-        job.last_stamp = now
-        repeat_notification(job)
+        queue_notifications(session, job, repeat_messages(job))
+
+touch_still_bad_jobs = text('''
+    update proccer_job
+        set last_stamp = :now
+        where id in (select id from proccer_job
+                         where deleted is null and state <> :ok
+                             and warn_after is not null
+                             and last_stamp < :before
+                         for update skip locked)
+        returning *
+''', bindparams=[bindparam('now', type_=DateTime),
+                 bindparam('before', type_=DateTime)],
+     typemap={'notify': JSON})
 
 
 def delete_old_results(session):
-    'Delete proccer results older than one week.'
+    '''Delete proccer results older than one week.
+
+    Results are deleted RESULT_DELETE_BATCH at a time, each batch in a
+    transaction of its own, for at most RESULT_DELETE_BUDGET; the rest are
+    left for the next run.  When proccer_result is partitioned by day, see
+    sql/partition-result.sql, expired days are dropped instead.'''
+
+    cutoff = datetime.utcnow() - OLD_RESULT_INTERVAL
+    partitions = result_partitions(session)
+    if partitions is not None:
+        ranges, default = partitions
+        maintain_result_partitions(session, ranges, default, cutoff)
+        return
+
+    deadline = time.time() + RESULT_DELETE_BUDGET.total_seconds()
+    while True:
+        deleted = session.execute(delete_results_batch,
+                                  {'cutoff': cutoff,
+                                   'limit': RESULT_DELETE_BATCH}).rowcount
+        session.commit()
+        log.debug('deleted %d old results', deleted)
+        if deleted < RESULT_DELETE_BATCH:
+            break
+        if time.time() > deadline:
+            log.info('old results left for the next run')
+            break
+        # Committing let go of the lock taken by run_task.
+        if not try_task_lock(session, delete_old_results.__name__):
+            break
+
+delete_results_batch = text('''
+    delete from proccer_result
+        where id in (select id from proccer_result
+                         where stamp < :cutoff
+                         limit :limit)
+''', bindparams=[bindparam('cutoff', type_=DateTime)])
+
+
+def result_partitions(session):
+    '''Return ([(partition-name, end)], default-partition-name) for the
+    partitions of proccer_result, or None if it is not partitioned.  end is
+    None for no end, and the default partition, if any, is not in the list.'''
+
+    if session.bind.dialect.name != 'postgresql':
+        return None
+    if session.execute(select_result_kind).scalar() != 'p':
+        return None
+
+    partitions, default = [], None
+    for name, bound in session.execute(select_result_partitions):
+        if bound == 'DEFAULT':
+            default = name
+            continue
+        end = re.search(r"TO \('([^']+)'\)", bound)
+        if end:
+            end = datetime.strptime(end.group(1), '%Y-%m-%d %H:%M:%S')
+        partitions.append((name, end))
+    return partitions, default
+
+select_result_kind = text('''
+    select relkind from pg_class where oid = 'proccer_result'::regclass
+''')
+select_result_partitions = text('''
+    select c.relname, pg_get_expr(c.relpartbound, c.oid)
+        from pg_inherits i join pg_class c on c.oid = i.inhrelid
+        where i.inhparent = 'proccer_result'::regclass
+''')
+
+
+def maintain_result_partitions(session, partitions, default, cutoff):
+    '''Drop the partitions of proccer_result which hold only results from
+    before cutoff, and make daily partitions RESULT_PARTITIONS_AHEAD days
+    ahead.
+
+    Results which fit no other partition, like ones stamped by agents with
+    skewed clocks, go in the default partition, if there is one.  Its
+    expired results are deleted, and its results for a new partition are
+    moved there.'''
+
+    for name, end in partitions:
+        if end is not None and end <= cutoff:
+            log.info('dropping old results partition %s', name)
+            session.execute('drop table "%s"' % name)
+    if default:
+        session.execute(delete_default_results % {'default': default},
+                        {'cutoff': cutoff})
+
+    ends = [end for name, end in partitions]
+    if None in ends:
+        return  # A partition with no end leaves no room for more.
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0,
+                                      microsecond=0)
+    day = max(ends) if ends else today
+    while day <= today + timedelta(days=RESULT_PARTITIONS_AHEAD):
+        values = {'name': 'proccer_result_p%s' % day.strftime('%Y%m%d'),
+                  'start': day, 'end': day + timedelta(days=1),
+                  'default': default}
+        log.info('adding results partition %s', values['name'])
+        session.execute(create_result_partition % values)
+        if default:
+            session.execute(move_default_results % values)
+        session.execute(attach_result_partition % values)
+        day += timedelta(days=1)
+
+delete_default_results = '''
+    delete from "%(default)s" where stamp < :cutoff
+'''
+# Partitions are made as tables and attached, which unlike "create table
+# ... partition of" only takes a SHARE UPDATE EXCLUSIVE lock on
+# proccer_result, so reports are stored meanwhile.
+create_result_partition = '''
+    create table "%(name)s" (like proccer_result including defaults)
+'''
+# Attaching a partition fails if the default partition has rows for it.
+move_default_results = '''
+    with moved as (
+        delete from "%(default)s"
+            where stamp >= '%(start)s' and stamp < '%(end)s'
+            returning *
+    )
+    insert into "%(name)s" select * from moved
+'''
+attach_result_partition = '''
+    alter table proccer_result attach partition "%(name)s"
+        for values from ('%(start)s') to ('%(end)s')
+'''
+
+
+def delete_old_notifications(session):
+    'Delete notifications which were done with more than one week ago.'
 
     now = datetime.utcnow()
-    old_results = (session
-                    .query(JobResult)
-                    .filter(JobResult.stamp < now - OLD_RESULT_INTERVAL))
-    old_results.delete()
+    old_notifications = (session
+                            .query(Notification)
+                            .filter(Notification.next_attempt == None)
+                            .filter(Notification.created
+                                    < now - OLD_RESULT_INTERVAL))
+    old_notifications.delete()
+
+
+# The periodic tasks other than lateness checks.
+housekeeping_tasks = [
+    send_still_bad_notifications,
+    delete_old_results,
+    delete_old_notifications,
+]
+
+
+def run_task(task):
+    '''Run task in a transaction of its own, unless it is being run by
+    another manager node.'''
+
+    with session_manager() as session:
+        if not try_task_lock(session, task.__name__):
+            log.debug('%s is running elsewhere, skipping', task.__name__)
+            return
+        task(session)
+
+
+def try_task_lock(session, name):
+    '''Take the lock for the task called name until the end of the
+    transaction, returning False if someone else has it.
+
+    Uses PostgreSQL advisory locks, so any number of manager nodes can run
+    the periodic tasks; elsewhere there is only the one.'''
+
+    if session.bind.dialect.name != 'postgresql':
+        return True
+    return session.execute(try_xact_lock, lock_key(name)).scalar()
+
+
+def lock_key(name):
+    return {'namespace': lock_namespace, 'key': crc32(name)}
+
+# The first half of proccer's advisory lock keys, so they do not clash with
+# other users of the database.
+lock_namespace = crc32('proccer.periodic')
+try_xact_lock = text('select pg_try_advisory_xact_lock(:namespace, :key)')
+try_session_lock = text('select pg_try_advisory_lock(:namespace, :key)')
+
+
+class LatenessScheduler(object):
+    '''Min-heap of (due_at, job-id) for the jobs which can become late.
+
+    Entries are not updated when jobs report in.  Instead each job is looked
+    at again when its entry comes due, and put back if its due_at has moved.
+    So the scheduler only needs to be told about jobs which become due
+    earlier than they were, or become candidates at all, which is what
+    database.notify_scheduler does.'''
+
+    def __init__(self):
+        self.heap = []
+
+    def load(self, session):
+        self.heap = [(due_at, job_id)
+                     for job_id, due_at in self._candidates(session)]
+        heapify(self.heap)
+        log.debug('scheduling lateness checks for %d jobs', len(self.heap))
+
+    def update(self, session, job_ids):
+        for job_id, due_at in self._candidates(session, job_ids):
+            heappush(self.heap, (due_at, job_id))
+
+    def next_deadline(self):
+        return self.heap[0][0] if self.heap else None
+
+    def run_due(self, session, now):
+        'Mark the jobs which are due by now as late, and return them.'
+
+        due = set()
+        while self.heap and self.heap[0][0] <= now:
+            due.add(heappop(self.heap)[1])
+        if not due:
+            return []
+
+        late = []
+        jobs = (session
+                    .query(Job)
+                    .filter(Job.id.in_(due))
+                    .with_lockmode('update'))
+        for job in jobs:
+            if job.deleted or job.state != 'ok' or job.due_at is None:
+                continue
+            if job.due_at > now:
+                heappush(self.heap, (job.due_at, job.id))
+                continue
+            mark_late(job, now)
+            late.append(job)
+        return late
+
+    def _candidates(self, session, job_ids=None):
+        query = (session
+                    .query(Job.id, Job.due_at)
+                    .filter(Job.deleted == None)
+                    .filter(Job.due_at != None)
+                    .filter(Job.state_id == job_state_id['ok']))
+        if job_ids is not None:
+            if not job_ids:
+                return []
+            query = query.filter(Job.id.in_(job_ids))
+        return query.all()
+
+
+def daemon():
+    '''Mark jobs as late when they become due, and do the other periodic
+    tasks every HOUSEKEEPING_INTERVAL.  Needs PostgreSQL.
+
+    Only one daemon is active at a time; others wait on standby and take
+    over if the active one goes away.'''
+
+    while True:
+        try:
+            _run_daemon()
+        except Exception:
+            log.error('periodic daemon failed, restarting', exc_info=True)
+            time.sleep(RESTART_DELAY)
+
+
+def _run_daemon():
+    # The daemon lock is held until its connection goes, so also if we die.
+    with autocommit_connection(engine) as lock_connection:
+        if not lock_connection.execute(try_session_lock,
+                                       lock_key('daemon')).scalar():
+            log.info('another daemon is active, on standby')
+            while not lock_connection.execute(try_session_lock,
+                                              lock_key('daemon')).scalar():
+                time.sleep(STANDBY_INTERVAL)
+        log.info('active, scheduling lateness checks')
+
+        with listen_connection(engine, [scheduler_channel]) as listener:
+            _schedule(listener)
+
+
+def _schedule(listener):
+    scheduler = LatenessScheduler()
+    with session_manager() as session:
+        scheduler.load(session)
+
+    next_housekeeping = datetime.utcnow()
+    while True:
+        now = datetime.utcnow()
+        with session_manager() as session:
+            scheduler.run_due(session, now)
+        if now >= next_housekeeping:
+            for task in housekeeping_tasks:
+                run_task(task)
+            next_housekeeping = now + HOUSEKEEPING_INTERVAL
+
+        wake = min(filter(None, [scheduler.next_deadline(),
+                                 next_housekeeping]))
+        timeout = max((wake - datetime.utcnow()).total_seconds(), 0)
+        if select.select([listener], [], [], timeout)[0]:
+            listener.poll()
+            job_ids = set(int(n.payload) for n in listener.notifies)
+            del listener.notifies[:]
+            with session_manager() as session:
+                scheduler.update(session, job_ids)
 
 
 def main():
     log.debug('doing periodic tasks')
-    with session_manager() as session:
-        send_lateness_notifications(session)
-        send_still_bad_notifications(session)
-        delete_old_results(session)
+    for task in [send_lateness_notifications] + housekeeping_tasks:
+        run_task(task)
 
 if __name__ == '__main__':
     log_conf = os.environ.get('LOGGING_CONFIGURATION')
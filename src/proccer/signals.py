@@ -2,3 +2,9 @@ from blinker import Namespace
 
 proccer_signals = Namespace()
 report_received = proccer_signals.signal('report-received')
+reports_received = proccer_signals.signal('reports-received')
+
+# Sent with job_ids when jobs have changed, here or, via events, elsewhere.
+# job_ids is None when which jobs is not known.  listings is False when the
+# jobs only reported, without changing state, appearing or disappearing.
+jobs_changed = proccer_signals.signal('jobs-changed')
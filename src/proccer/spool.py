@@ -0,0 +1,202 @@
+'On-disk spool for job-reports waiting to be delivered to the manager.'
+
+from __future__ import with_statement
+
+import errno
+import fcntl
+import jsonlib as json
+import logging
+import os
+from tempfile import mkstemp
+import time
+
+log = logging.getLogger('proccer')
+
+default_spool_dir = os.path.expanduser(
+    os.environ.get('PROCCER_SPOOL_DIR', '~/.proccer/spool'))
+
+max_age = 7 * 24 * 60 * 60  # Give up on reports older than a week,
+max_bytes = 64 * 1024 * 1024  # or when the spool grows beyond 64MB.
+# Reports the manager failed to store this many times are moved to failed/,
+# so they do not hold up the ones after them.
+max_attempts = 5
+
+# Returned by deliver, see flush, for a report the manager failed to store,
+FAILED = 'failed'
+# and for a report the manager refuses, which is moved to failed/ at once.
+REFUSED = 'refused'
+
+
+def add(result, spool_dir=None):
+    '''Add result to the spool, returning the path of the spooled report.
+
+    The report is written to tmp/ and then renamed into new/, so a report in
+    new/ is always complete.'''
+
+    spool_dir = spool_dir or default_spool_dir
+    tmp_dir, new_dir = _make_dirs(spool_dir)
+
+    fd, tmp_path = mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(json.dumps(result))
+            f.flush()
+            os.fsync(f.fileno())
+
+        # Names start with the time, so they sort oldest first.
+        path = os.path.join(new_dir, '%.6f-%s' % (time.time(),
+                                                  os.path.basename(tmp_path)))
+        os.rename(tmp_path, path)
+        return path
+
+    except:
+        os.unlink(tmp_path)
+        raise
+
+
+def pending(spool_dir=None):
+    'Return paths of the spooled reports, oldest first.'
+
+    new_dir = os.path.join(spool_dir or default_spool_dir, 'new')
+    try:
+        names = os.listdir(new_dir)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return []
+    return [os.path.join(new_dir, name) for name in sorted(names)]
+
+
+def expire(spool_dir=None, now=None):
+    'Drop reports which are too old, or do not fit in the spool.'
+
+    spool_dir = spool_dir or default_spool_dir
+    now = now or time.time()
+
+    total = 0
+    for path in reversed(pending(spool_dir)):
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            continue  # Delivered by someone else.
+
+        total += st.st_size
+        if st.st_mtime + max_age < now:
+            log.error('dropping job-status %s, too old', path)
+        elif total > max_bytes:
+            log.error('dropping job-status %s, spool is full', path)
+        else:
+            continue
+        _unlink(path)
+
+    # Leftovers from being killed while adding reports, and failed reports
+    # which are too old.
+    for subdir, age in (('tmp', 60 * 60), ('failed', max_age)):
+        subdir = os.path.join(spool_dir, subdir)
+        if not os.path.isdir(subdir):
+            continue
+        for name in os.listdir(subdir):
+            path = os.path.join(subdir, name)
+            try:
+                st = os.stat(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue  # Renamed by add, or removed by someone else.
+            if st.st_mtime + age < now:
+                _unlink(path)
+
+
+def flush(deliver, batch_size, spool_dir=None):
+    '''Deliver spooled reports in batches, oldest first.
+
+    deliver is called with a list of reports, and must return a list telling
+    for each report whether it is done with, and can be removed, FAILED if
+    the manager failed to store it, or REFUSED.  Flushing stops at the first
+    report not done with, or if deliver raises.  Reports which have FAILED
+    max_attempts times, or are REFUSED, are moved to failed/.
+
+    Only one process flushes the spool at a time.  Returns the number of
+    reports still waiting, or None if someone else is flushing.'''
+
+    spool_dir = spool_dir or default_spool_dir
+    _make_dirs(spool_dir)
+
+    with open(os.path.join(spool_dir, 'flush.lock'), 'a') as lock:
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            log.debug('spool %s is being flushed by someone else', spool_dir)
+            return None
+
+        expire(spool_dir)
+        while True:
+            paths = pending(spool_dir)
+            if not paths:
+                return 0
+
+            batch = []
+            for path in paths[:batch_size]:
+                try:
+                    with open(path, 'rb') as f:
+                        batch.append((path, json.loads(f.read())))
+                except Exception:
+                    log.error('dropping unreadable job-status %s', path,
+                              exc_info=True)
+                    _unlink(path)
+
+            done = deliver([result for _, result in batch])
+            for (path, _), ok in zip(batch, done):
+                if ok is FAILED:
+                    _count_failure(spool_dir, path)
+                elif ok is REFUSED:
+                    _move_to_failed(spool_dir, path)
+                elif ok:
+                    _unlink(path)
+
+            if not all(ok and ok is not FAILED for ok in done):
+                return len(pending(spool_dir))
+
+
+def _count_failure(spool_dir, path):
+    '''Count a failed attempt at storing the report at path, in its name,
+    and move it to failed/ after max_attempts.'''
+
+    name, _, attempts = os.path.basename(path).partition('+')
+    attempts = int(attempts or 0) + 1
+    if attempts < max_attempts:
+        os.rename(path, os.path.join(spool_dir, 'new',
+                                     '%s+%d' % (name, attempts)))
+    else:
+        log.error('moving job-status %s to failed/, after %d attempts',
+                  path, attempts)
+        _move_to_failed(spool_dir, path)
+
+
+def _move_to_failed(spool_dir, path):
+    failed_dir, = _make_dirs(spool_dir, ['failed'])
+    name = os.path.basename(path).partition('+')[0]
+    os.rename(path, os.path.join(failed_dir, name))
+
+
+def _make_dirs(spool_dir, names=('tmp', 'new')):
+    dirs = [os.path.join(spool_dir, name) for name in names]
+    for path in dirs:
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    return dirs
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
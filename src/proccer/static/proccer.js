@@ -1,54 +1,233 @@
 (function() {
+    // How often to ask for changed jobs, in milliseconds, without
+    // EventSource.
+    var POLL_INTERVAL = 10 * 1000;
+
+    // How long to wait after events before asking for the role summaries.
+    var SUMMARY_DELAY = 1000;
+
+    // The columns of a job row, in order.
+    var FIELDS = ['seen', 'login', 'host', 'name', 'state'];
+
+    // The states, from best to worst.
+    var STATES = ['ok', 'error', 'late'];
+
     $(document).ready(function() {
+        var jobs = $('#jobs');
+        if (jobs.length == 0) {
+            return;
+        }
 
-        // Updates the text on the roll header.
-        // If there are hidden jobs -> '[show all X jobs]'
-        // otherwise -> '[hide]'
+        var find_role = function(login) {
+            return $('.role').filter(function() {
+                return String($(this).data('login')) == login;
+            });
+        }
+
+        // Updates the text on the role header, offering to show the ok
+        // jobs, if there are any, or to hide them.
         var update_text = function(role) {
-            if ($(role).find('.job:not(:visible)').length > 0) {
-                // if there are hidden objects,
-                // set the text to '[show all X jobs]'
-                var n_jobs = $(role).find('.job').length;
-                $(role).find('.toggle-text').text(
-                    '[show all ' + n_jobs +' jobs]');
+            var n_ok = role.data('ok');
+            var text = '';
+            if (role.hasClass('collapsed') && n_ok > 0) {
+                text = '[show ' + n_ok + ' ok jobs]';
+            } else if (n_ok > 0) {
+                text = '[hide ok jobs]';
+            }
+            role.find('.toggle-text').text(text).toggle(text != '');
+        }
+
+        // Sets the cells and state of a job row.
+        var fill_row = function(row, job) {
+            row.find('a').each(function(i) {
+                $(this).text(job[FIELDS[i]]);
+            });
+            row.removeClass(STATES.join(' ')).addClass(job.state);
+        }
+
+        var make_row = function(job) {
+            var row = $('<tr class="job"/>').attr('data-id', job.id);
+            $.each(FIELDS, function() {
+                row.append($('<td/>').append(
+                    $('<a/>').attr('href', '/job/' + job.id + '/')));
+            });
+            fill_row(row, job);
+            return row;
+        }
+
+        // Inserts a row for job in role, ordered by host and name.
+        var insert_row = function(role, job) {
+            var row = make_row(job);
+            var key = job.host + '\0' + job.name;
+            var before = role.find('tr.job').filter(function() {
+                var cells = $(this).find('td');
+                return key < ($.trim(cells.eq(2).text()) + '\0'
+                              + $.trim(cells.eq(3).text()));
+            }).first();
+            if (before.length) {
+                row.insertBefore(before);
             } else {
-                // if there are not hidden jobs
-                $(role).find('.toggle-text').text('[hide]');
+                role.find('tbody').append(row);
             }
         }
 
-        // Hides all jobs with status 'ok' and updates the header text
-        var hide_ok = function(role) {
-            if ($(role).find('.job:not(.ok)').length == 0) {
-                $(role).find('.role-details').hide();
+        // Restripes a role's rows, and hides its table if it has none.
+        var restripe = function(role) {
+            var rows = role.find('tr.job');
+            rows.each(function(i) {
+                $(this).removeClass('even odd')
+                       .addClass(['even', 'odd'][i % 2]);
+            });
+            role.find('.role-details').toggleClass('empty', rows.length == 0);
+        }
+
+        // Updates a role's header with its counts of jobs in each state,
+        // as from the server, removing it if it has no jobs.
+        var summarize = function(role, counts) {
+            if ($.isEmptyObject(counts)) {
+                role.remove();
+                return;
             }
-            $(role).find('.job.ok').hide();
+
+            var states = $.grep(STATES, function(state) {
+                return counts[state];
+            });
+            role.find('.role-header')
+                .attr('class', 'header role-header ' + states.join(' '));
+            role.find('.counts').text($.map(states, function(state) {
+                return counts[state] + ' ' + state;
+            }).join(', '));
+            role.data('ok', counts.ok || 0);
             update_text(role);
         }
 
-        // Shows all the jobs and updates the header thext
-        var show_ok = function(role) {
-            $(role).find('.role-details').show();
-            $(role).find('.role-details .job').show();
+        // Patches the table with changed jobs and role summaries, as from
+        // /api/1.0/jobs.  Collapsed roles only show the jobs which are not
+        // ok.
+        var apply_jobs = function(changed, roles) {
+            var touched = [];
+            var reload = false;
+            $.each(changed, function(i, job) {
+                var row = $('tr.job[data-id="' + job.id + '"]');
+                var role = job.deleted ? row.closest('.role')
+                                       : find_role(job.login);
+                if (!job.deleted && role.length == 0) {
+                    reload = true;  // A new role.
+                    return false;
+                }
+
+                if (job.deleted ||
+                        (job.state == 'ok' && role.hasClass('collapsed'))) {
+                    row.remove();
+                } else if (row.length) {
+                    fill_row(row, job);
+                } else {
+                    insert_row(role, job);
+                }
+                // Deleted jobs which were not shown have no role here.
+                if (role.length) {
+                    touched.push(role[0]);
+                }
+            });
+            if (reload) {
+                location.reload();
+                return;
+            }
+
+            $.each($.unique(touched), function() {
+                restripe($(this));
+            });
+            $.each(roles || {}, function(login, counts) {
+                summarize(find_role(login), counts);
+            });
+        }
+
+        // Does the job match the words of the filter?
+        var matches = function(job) {
+            var text = job.login + ' ' + job.host + ' ' + job.name;
+            var words = $.trim(String(jobs.data('q'))).split(/\s+/);
+            return $.grep(words, function(word) {
+                return text.indexOf(word) < 0;
+            }).length == 0;
+        }
+
+        // Asks for the jobs changed since the last time, and patches the
+        // table with them, then calls done.
+        var poll = function(done) {
+            $.getJSON('/api/1.0/jobs', {since: jobs.data('cursor'),
+                                        q: jobs.data('q')})
+                .done(function(data) {
+                    apply_jobs(data.jobs, data.roles);
+                    jobs.data('cursor', data.cursor);
+                })
+                .always(done || $.noop);
+        }
+
+        var poll_forever = function() {
+            poll(function() {
+                setTimeout(poll_forever, POLL_INTERVAL);
+            });
+        }
+
+        // Fetches the ok jobs of a role, and shows them.
+        var expand = function(role) {
+            $.getJSON('/api/1.0/jobs', {login: role.data('login'),
+                                        state: 'ok',
+                                        q: jobs.data('q')})
+                .done(function(data) {
+                    role.removeClass('collapsed');
+                    apply_jobs(data.jobs, data.roles);
+                });
+        }
+
+        // Hides the ok jobs of a role again.
+        var collapse = function(role) {
+            role.addClass('collapsed');
+            role.find('tr.job.ok').remove();
+            restripe(role);
             update_text(role);
         }
 
         // shows/hides jobs with status 'ok' with a click on the role header
-        $('.role:has(.job.ok) .role-header').click(function() {
+        $(document).on('click', '.role-header', function() {
             var role = $(this).closest('.role');
-            var is_hidden = role.find('.job:hidden').length > 0;
-
-            if (is_hidden) {
-                show_ok(role);
+            if (role.hasClass('collapsed')) {
+                if (role.data('ok') > 0) {
+                    expand(role);
+                }
             } else {
-                hide_ok(role);
+                collapse(role);
             }
         });
 
-        // hide all jobs with status 'ok' by default
-        $('.role:has(.job.ok)').each(function(){
-            hide_ok(this);
-        });
+        if (window.EventSource) {
+            // Live updates, catching up on what was missed whenever the
+            // stream is (re)connected.  Events do not have the role
+            // summaries, so those are fetched after a burst of events.
+            var source = new EventSource('/api/1.0/events');
+            var summary_timer = null;
+            var on_event = function(e) {
+                var job = JSON.parse(e.data);
+                if (!matches(job)) {
+                    return;
+                }
+                apply_jobs([job]);
+                if (e.type != 'result' && summary_timer === null) {
+                    summary_timer = setTimeout(function() {
+                        summary_timer = null;
+                        poll();
+                    }, SUMMARY_DELAY);
+                }
+            }
+            source.addEventListener('state', on_event);
+            source.addEventListener('result', on_event);
+            source.addEventListener('deleted', on_event);
+            source.addEventListener('open', function() {
+                poll();
+            });
+        } else {
+            setTimeout(poll_forever, POLL_INTERVAL);
+        }
 
     });
 })();
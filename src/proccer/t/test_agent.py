@@ -1,35 +1,269 @@
 from __future__ import with_statement
 
 from math import pow
-from mock import patch, call
+from mock import Mock, patch, call
 from nose.tools import eq_
+import jsonlib as json
 import os
 import resource
-from tempfile import NamedTemporaryFile
+import shutil
+from tempfile import mkdtemp
+import time
+import zlib
 
-from proccer.agent import (read_configuration,
+from proccer.agent import (ProcessError,
+                           read_configuration,
                            report,
+                           spool_report,
+                           flush_reports,
+                           ReportFlusher,
                            memory_size_human_to_bytes,
                            set_memory_limit,
                            default_memory_limit,
-                           _in_parent,
-                           _in_child)
+                           max_output_head,
+                           max_output_tail,
+                           run_processes,
+                           OutputBuffer,
+                           _close_all_fds,
+                           _close_fd_range,
+                           _fork_child,
+                           _reap,
+                           _result_for)
+from proccer.spool import pending
 from proccer.t.testing import assert_eq, assert_raises
 
 
-def test_report():
-    with patch('requests.post') as mock:
-        report({})
+def delivered(n):
+    return '{"ok":true,"results":[%s]}' % ','.join(['{"status":200}'] * n)
+
 
-    assert mock.called
-    args, kwargs = mock.call_args
-    assert_eq(args, ('http://proccer-test/api/1.0/report',))
+def test_report():
+    spool_dir = mkdtemp()
+    try:
+        with patch('proccer.spool.default_spool_dir', spool_dir):
+            with patch('requests.Session') as mock:
+                response = mock.return_value.post.return_value
+                response.status_code = 200
+                response.content = delivered(1)
+                report({})
+            left = pending(spool_dir)
+    finally:
+        shutil.rmtree(spool_dir)
+
+    post = mock.return_value.post
+    assert post.called
+    args, kwargs = post.call_args
+    assert_eq(args, ('http://proccer-test/api/1.0/reports',))
     assert_eq(kwargs['data'], '{}')
+    assert kwargs['timeout']
+    assert_eq(left, [])
+
+
+def test_report_undelivered():
+    spool_dir = mkdtemp()
+    try:
+        with patch('proccer.spool.default_spool_dir', spool_dir):
+            with patch('requests.Session') as mock:
+                mock.return_value.post.side_effect = IOError('No manager')
+                report({'n': 1})
+                report({'n': 2})
+            assert_eq(len(pending(spool_dir)), 2)
+
+            with patch('requests.Session') as mock:
+                response = mock.return_value.post.return_value
+                response.status_code = 200
+                response.content = delivered(2)
+                assert_eq(flush_reports(), 0)
+            left = pending(spool_dir)
+    finally:
+        shutil.rmtree(spool_dir)
+
+    assert_eq([kwargs['data'] for _, kwargs
+               in mock.return_value.post.call_args_list],
+              ['{"n":1}\n{"n":2}'])
+    assert_eq(left, [])
+
+
+def test_spool_report():
+    spool_dir = mkdtemp()
+    try:
+        with patch('proccer.spool.default_spool_dir', spool_dir):
+            with patch('requests.Session') as mock:
+                response = mock.return_value.post.return_value
+                response.status_code = 200
+                response.content = delivered(1)
+                assert spool_report({'n': 1})
+                assert not mock.return_value.post.called
+
+                with patch('proccer.spool.add') as add:
+                    add.side_effect = IOError('Disk full')
+                    assert not spool_report({'n': 2})
+                assert_eq(flush_reports([{'n': 2}]), 0)
+            left = pending(spool_dir)
+    finally:
+        shutil.rmtree(spool_dir)
+
+    assert_eq([kwargs['data'] for _, kwargs
+               in mock.return_value.post.call_args_list],
+              ['{"n":2}', '{"n":1}'])
+    assert_eq(left, [])
+
+
+def test_report_no_spool():
+    spool_parent = mkdtemp()
+    try:
+        # The spool cannot be created, since its parent is a file.
+        spool_dir = os.path.join(spool_parent, 'file', 'spool')
+        open(os.path.join(spool_parent, 'file'), 'w').close()
+        with patch('proccer.spool.default_spool_dir', spool_dir):
+            with patch('requests.Session') as mock:
+                response = mock.return_value.post.return_value
+                response.status_code = 200
+                response.content = delivered(1)
+                report({'n': 1})
+    finally:
+        shutil.rmtree(spool_parent)
+
+    assert_eq([kwargs['data'] for _, kwargs
+               in mock.return_value.post.call_args_list],
+              ['{"n":1}'])
+
+
+def test_report_flusher():
+    spool_dir = mkdtemp()
+    try:
+        with patch('proccer.spool.default_spool_dir', spool_dir):
+            with patch('requests.Session') as mock:
+                post = mock.return_value.post
+                post.return_value.status_code = 200
+                post.return_value.content = delivered(1)
+
+                flusher = ReportFlusher()
+                try:
+                    # Delivered as it is reported, not only at close.
+                    flusher.report({'n': 1})
+                    deadline = time.time() + 5
+                    while not post.called and time.time() < deadline:
+                        time.sleep(0.01)
+                    assert post.called
+
+                    with patch('proccer.spool.add') as add:
+                        add.side_effect = IOError('Disk full')
+                        flusher.report({'n': 2})
+                finally:
+                    flusher.close()
+                assert not flusher.thread.is_alive()
+            left = pending(spool_dir)
+    finally:
+        shutil.rmtree(spool_dir)
+
+    assert_eq([kwargs['data'] for _, kwargs in post.call_args_list],
+              ['{"n":1}', '{"n":2}'])
+    assert_eq(left, [])
+
+
+def test_report_compressed():
+    spool_dir = mkdtemp()
+    try:
+        with patch('proccer.spool.default_spool_dir', spool_dir):
+            with patch('requests.Session') as mock:
+                response = mock.return_value.post.return_value
+                response.status_code = 200
+                response.content = delivered(1)
+                report({'output': 'Hello, World!\n' * 1000})
+    finally:
+        shutil.rmtree(spool_dir)
+
+    _, kwargs = mock.return_value.post.call_args
+    assert_eq(kwargs['headers']['Content-Encoding'], 'gzip')
+    assert len(kwargs['data']) < 1000, len(kwargs['data'])
+    data = zlib.decompress(kwargs['data'], 16 + zlib.MAX_WBITS)
+    assert_eq(data, '{"output":"%s"}' % ('Hello, World!\\n' * 1000))
+
+
+def test_report_too_large():
+    spool_dir = mkdtemp()
+
+    batches = []
+    def post(url, data, headers, timeout):
+        if headers.get('Content-Encoding') == 'gzip':
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        batch = [json.loads(line)['n'] for line in data.split('\n')]
+        batches.append(batch)
+        if len(batch) > 2 or 2 in batch:
+            return Mock(status_code=413)
+        return Mock(status_code=200, content=delivered(len(batch)))
+
+    try:
+        with patch('proccer.spool.default_spool_dir', spool_dir):
+            for n in range(4):
+                assert spool_report({'n': n})
+            with patch('requests.Session') as mock:
+                mock.return_value.post.side_effect = post
+                assert_eq(flush_reports(), 0)
+            failed = os.listdir(os.path.join(spool_dir, 'failed'))
+    finally:
+        shutil.rmtree(spool_dir)
+
+    assert_eq(batches, [[0, 1, 2, 3], [0, 1], [2, 3], [2], [3]])
+    assert_eq(len(failed), 1)
+
+
+def test_report_old_manager():
+    spool_dir = mkdtemp()
+    try:
+        with patch('proccer.spool.default_spool_dir', spool_dir):
+            with patch('requests.Session') as mock:
+                mock.return_value.post.return_value.status_code = 404
+                report({})
+            left = pending(spool_dir)
+    finally:
+        shutil.rmtree(spool_dir)
+
+    urls = [args[0] for args, _ in mock.return_value.post.call_args_list]
+    assert_eq(urls, ['http://proccer-test/api/1.0/reports',
+                     'http://proccer-test/api/1.0/report'])
+    assert_eq(len(left), 1)
+
+
+def test_report_bad_response():
+    spool_dir = mkdtemp()
+    try:
+        with patch('proccer.spool.default_spool_dir', spool_dir):
+            for content in ('<html>Log in</html>', delivered(5)):
+                with patch('requests.Session') as mock:
+                    response = mock.return_value.post.return_value
+                    response.status_code = 200
+                    response.content = content
+                    report({})
+            left = pending(spool_dir)
+    finally:
+        shutil.rmtree(spool_dir)
+
+    assert_eq(len(left), 2)
+
+
+def test_report_failed():
+    spool_dir = mkdtemp()
+    try:
+        with patch('proccer.spool.default_spool_dir', spool_dir):
+            with patch('requests.Session') as mock:
+                response = mock.return_value.post.return_value
+                response.status_code = 200
+                response.content = ('{"ok":false,"results":[{"status":500,'
+                                    '"error":"Oops"}]}')
+                report({})
+            left = pending(spool_dir)
+    finally:
+        shutil.rmtree(spool_dir)
+
+    assert_eq(len(left), 1)
+    assert left[0].endswith('+1'), left
 
 
 def test_report_no_api():
     with patch('proccer.agent.API_URL', ''):
-        with patch('requests.post') as mock:
+        with patch('requests.Session') as mock:
             report({})
 
     assert not mock.called
@@ -234,12 +468,9 @@ def test_memory_invalid():
 
 
 def fork_and_wait(name, desc):
-    with NamedTemporaryFile() as logfile:
-        pid = os.fork()
-        if pid:
-            return _in_parent(name, desc, pid, logfile)
-        else:
-            _in_child(name, desc, logfile)
+    child = _fork_child(name, desc)
+    assert_eq(_reap({child.pid: child}), child)
+    return _result_for(child)
 
 
 def check_memlimit(memory_bytes):
@@ -259,3 +490,141 @@ def check_memlimit(memory_bytes):
 def test_memlimit_generator():
     for limit_m in (900, 1100):
         yield check_memlimit, limit_m * 1024 * 1024
+
+
+def test_output_buffer():
+    output = OutputBuffer(3, 5)
+    output.write('abc')
+    assert not output.truncated
+    eq_(output.getvalue(), 'abc')
+
+    output.write('defgh')
+    assert not output.truncated
+    eq_(output.getvalue(), 'abcdefgh')
+
+    output.write('ijk')
+    output.write('lm')
+    assert output.truncated
+    eq_(output.total, 13)
+    eq_(output.getvalue(), 'abc\n[... 5 bytes skipped ...]\nijklm')
+
+
+def test_output_capture():
+    r = fork_and_wait('jobname', {'command': 'echo foo; echo bar >&2'})
+    eq_(r['output'], 'foo\nbar\n')
+    eq_(r['output_length'], 8)
+    eq_(r['output_truncated'], False)
+
+
+def test_output_capture_truncated():
+    r = fork_and_wait('jobname', {'command': 'seq 1 100000; exit 1'})
+    eq_(r['result'], {'ok': False, 'reason': 'exit', 'code': 1})
+    eq_(r['output_length'], len(''.join('%d\n' % i
+                                        for i in range(1, 100001))))
+    eq_(r['output_truncated'], True)
+    assert r['output'].startswith('1\n2\n3\n'), r['output'][:10]
+    assert r['output'].endswith('\n99999\n100000\n'), r['output'][-20:]
+    assert len(r['output']) < max_output_head + max_output_tail + 100
+
+
+def closes_fds(close, min):
+    '''Check that close(min) closes open fds >= min in a forked child.'''
+    r, w = os.pipe()
+    os.dup2(w, 1000)
+    fds = [r, w, 1000]
+    pid = os.fork()
+    if not pid:
+        try:
+            close(min)
+            still_open = []
+            for fd in fds:
+                try:
+                    os.fstat(fd)
+                    still_open.append(fd)
+                except OSError:
+                    pass
+            os._exit(int(still_open != [fd for fd in fds if fd < min]))
+        finally:
+            os._exit(2)
+
+    for fd in fds:
+        os.close(fd)
+    _, status = os.waitpid(pid, 0)
+    return os.WEXITSTATUS(status) == 0
+
+
+def test_close_all_fds():
+    assert closes_fds(_close_all_fds, 3)
+    assert closes_fds(_close_all_fds, 1000)
+    assert closes_fds(_close_all_fds, 1001)
+
+
+def test_close_all_fds_without_close_range():
+    with patch('proccer.agent._close_range', None):
+        assert closes_fds(_close_all_fds, 3)
+        assert closes_fds(_close_all_fds, 1000)
+
+
+def test_close_all_fds_fallback():
+    assert closes_fds(_close_fd_range, 3)
+
+
+def run_in_tempdir(commands, jobs):
+    lockdir = mkdtemp()
+    try:
+        for name, desc in commands.items():
+            desc['lockfile'] = {'path': os.path.join(lockdir, name)}
+        return list(run_processes({'commands': commands},
+                                  sorted(commands), jobs))
+    finally:
+        shutil.rmtree(lockdir)
+
+
+def test_run_processes_in_parallel():
+    commands = {
+        'a': {'command': 'sleep 1'},
+        'b': {'command': 'sleep 1'},
+        'c': {'command': 'echo c'},
+    }
+    before = time.time()
+    completed = run_in_tempdir(commands, jobs=3)
+    took = time.time() - before
+
+    assert took < 2, took
+    assert_eq(completed[0][0], 'c')
+    assert_eq(sorted(name for name, _, _ in completed), ['a', 'b', 'c'])
+    for name, result, error in completed:
+        assert_eq(error, None)
+        assert_eq(result['result'], {'ok': True})
+
+
+def test_run_processes_timeouts():
+    commands = {
+        'a': {'command': 'sleep 10', 'timeout': 1},
+        'b': {'command': 'sleep 10', 'timeout': 2},
+        'c': {'command': 'true'},
+    }
+    before = time.time()
+    completed = run_in_tempdir(commands, jobs=3)
+    took = time.time() - before
+
+    assert took < 5, took
+    assert_eq([name for name, _, _ in completed], ['c', 'a', 'b'])
+    assert_eq(completed[1][1]['result']['reason'], 'signal')
+    assert_eq(completed[2][1]['result']['reason'], 'signal')
+
+
+def test_run_processes_stops_after_failure():
+    commands = {
+        'a': {'command': 'false'},
+        'b': {'command': 'true'},
+    }
+    completed = run_in_tempdir(commands, jobs=1)
+    assert_eq([name for name, _, _ in completed], ['a'])
+
+
+def test_run_processes_no_such_process():
+    completed = list(run_processes({'commands': {}}, ['nope']))
+    [(name, result, error)] = completed
+    assert_eq(name, 'nope')
+    assert isinstance(error, ProcessError), error
@@ -1,13 +1,18 @@
 from __future__ import with_statement
 
+from copy import deepcopy
+from datetime import datetime
 import jsonlib as json
+import zlib
 from mock import patch
 from werkzeug.test import Client
 from werkzeug.wrappers import BaseResponse
 
+from proccer.agent import gzip_compress
+from proccer import app as app_module
 from proccer.app import app
-from proccer.database import Job, JobResult
-from proccer.t.testing import setup_module
+from proccer.database import Job, JobResult, JobHistory
+from proccer.t.testing import setup_module, assert_eq
 from proccer.t.test_mail import ok_result
 
 
@@ -21,3 +26,238 @@ def test_post_new_event():
     assert resp.status_code == 200, repr(resp.status, resp.data)
     assert session.query(Job).count() == 1
     assert session.query(JobResult).count() == 1
+
+
+def test_post_many_events():
+    error_result = deepcopy(ok_result)
+    error_result['result']['ok'] = False
+    error_result['stamp'] = '1979-07-07T11:22:34Z'
+    bad_result = {'name': 'bar'}
+
+    client = Client(app, BaseResponse)
+    with patch('proccer.notifications.smtplib') as smtplib:
+        resp = client.post('/api/1.0/reports',
+                           data=json.dumps([ok_result, bad_result,
+                                            error_result]),
+                           headers={'Content-Type': 'application/json'})
+
+    assert resp.status_code == 200, repr(resp.status, resp.data)
+    body = json.loads(resp.data)
+    assert_eq(body['ok'], False)
+    assert_eq([r['status'] for r in body['results']], [200, 400, 200])
+    assert_eq(session.query(Job).count(), 1)
+    assert_eq(session.query(JobResult).count(), 2)
+    assert_eq(session.query(JobHistory).count(), 2)
+
+
+def test_post_many_events_bad_config():
+    bad_results = []
+    for config in ['/bin/true', {'warn-after': '1s'},
+                   {'notify': 'foo@example.com'}]:
+        bad_result = deepcopy(ok_result)
+        bad_result['config'] = config
+        bad_results.append(bad_result)
+
+    client = Client(app, BaseResponse)
+    with patch('proccer.notifications.smtplib') as smtplib:
+        resp = client.post('/api/1.0/reports',
+                           data=json.dumps(bad_results + [ok_result]),
+                           headers={'Content-Type': 'application/json'})
+
+    body = json.loads(resp.data)
+    assert_eq([r['status'] for r in body['results']], [400, 400, 400, 200])
+    assert_eq(session.query(JobResult).count(), 1)
+
+
+def test_post_many_events_store_fails():
+    other_result = deepcopy(ok_result)
+    other_result['name'] = 'baz'
+    record_report = app_module.store_reports.func_globals['record_report']
+
+    def fail_for_bar(session, result):
+        record_report(session, result)
+        if result['name'] == 'bar':
+            raise IOError('Disk full')
+
+    client = Client(app, BaseResponse)
+    with patch('proccer.notifications.smtplib') as smtplib:
+        with patch('proccer.database.add_proccer_results') as add, \
+                patch('proccer.database.record_report', fail_for_bar):
+            add.side_effect = IOError('Disk full')
+            resp = client.post('/api/1.0/reports',
+                               data=json.dumps([ok_result, other_result]),
+                               headers={'Content-Type': 'application/json'})
+
+    assert_eq(resp.status_code, 200)
+    body = json.loads(resp.data)
+    assert_eq(body['ok'], False)
+    assert_eq([r['status'] for r in body['results']], [500, 200])
+    assert_eq([job.name for job in session.query(Job)], ['baz'])
+    assert_eq(session.query(JobResult).count(), 1)
+
+
+def test_post_many_events_ndjson():
+    client = Client(app, BaseResponse)
+    with patch('proccer.notifications.smtplib') as smtplib:
+        resp = client.post('/api/1.0/reports',
+                           data='\n'.join([json.dumps(ok_result)] * 3),
+                           headers={'Content-Type': 'application/x-ndjson'})
+
+    assert resp.status_code == 200, repr(resp.status, resp.data)
+    body = json.loads(resp.data)
+    assert_eq(body['ok'], True)
+    assert_eq(session.query(JobResult).count(), 3)
+
+
+def test_post_many_events_garbage():
+    client = Client(app, BaseResponse)
+    resp = client.post('/api/1.0/reports', data='[{"garbage',
+                       headers={'Content-Type': 'application/json'})
+    assert_eq(resp.status_code, 400)
+
+
+def test_post_compressed_event():
+    client = Client(app, BaseResponse)
+    with patch('proccer.notifications.smtplib') as smtplib:
+        resp = client.post('/api/1.0/report',
+                           data=gzip_compress(json.dumps(ok_result)),
+                           headers={'Content-Type': 'application/json',
+                                    'Content-Encoding': 'gzip'})
+
+    assert resp.status_code == 200, repr(resp.status, resp.data)
+    assert_eq(session.query(JobResult).count(), 1)
+
+
+def test_post_many_deflated_events():
+    client = Client(app, BaseResponse)
+    with patch('proccer.notifications.smtplib') as smtplib:
+        resp = client.post('/api/1.0/reports',
+                           data=zlib.compress(json.dumps([ok_result] * 2)),
+                           headers={'Content-Type': 'application/json',
+                                    'Content-Encoding': 'deflate'})
+
+    assert resp.status_code == 200, repr(resp.status, resp.data)
+    assert_eq(session.query(JobResult).count(), 2)
+
+
+def test_post_compressed_too_large():
+    bomb = gzip_compress(' ' * (app.config['MAX_REPORT_SIZE'] + 1))
+
+    client = Client(app, BaseResponse)
+    resp = client.post('/api/1.0/report', data=bomb,
+                       headers={'Content-Type': 'application/json',
+                                'Content-Encoding': 'gzip'})
+    assert_eq(resp.status_code, 413)
+
+
+def test_post_compressed_garbage():
+    client = Client(app, BaseResponse)
+    resp = client.post('/api/1.0/report', data='not gzip',
+                       headers={'Content-Type': 'application/json',
+                                'Content-Encoding': 'gzip'})
+    assert_eq(resp.status_code, 400)
+
+
+def test_post_unsupported_encoding():
+    client = Client(app, BaseResponse)
+    resp = client.post('/api/1.0/report', data='{}',
+                       headers={'Content-Type': 'application/json',
+                                'Content-Encoding': 'br'})
+    assert_eq(resp.status_code, 415)
+
+
+def test_post_queued_event():
+    written = []
+    client = Client(app, BaseResponse)
+    with patch.dict(app.config, {'INGEST_QUEUE_SIZE': 10}):
+        with patch('proccer.app.store_received', written.append):
+            with patch('proccer.app._ingest_queue', None):
+                resp = client.post('/api/1.0/report',
+                                   data=json.dumps(ok_result),
+                                   headers={'Content-Type':
+                                            'application/json'})
+                assert_eq(resp.status_code, 200)
+
+                resp = client.get('/api/1.0/status')
+                assert_eq(json.loads(resp.data)['ingest']['max_queued'], 10)
+
+                app_module._ingest_queue.close()
+
+    assert_eq(written, [[ok_result]])
+
+
+def test_post_many_queued_full():
+    reports = [dict(ok_result, name=name) for name in ('a', 'b', 'c')]
+
+    client = Client(app, BaseResponse)
+    with patch.dict(app.config, {'INGEST_QUEUE_SIZE': 10}):
+        with patch('proccer.app._ingest_queue', None):
+            queue = app_module.ingest_queue()
+            queue.close()  # So nothing is taken off the queue.
+            with patch.object(queue, 'put') as put:
+                put.side_effect = [True, False, True]
+                resp = client.post('/api/1.0/reports',
+                                   data=json.dumps(reports),
+                                   headers={'Content-Type':
+                                            'application/json'})
+
+    # Once the queue is full, later reports are not queued either.
+    assert_eq([s['status'] for s in json.loads(resp.data)['results']],
+              [200, 503, 503])
+    assert_eq(put.call_count, 2)
+
+
+def test_get_jobs():
+    for name in ('foo', 'bar', 'baz'):
+        job = Job.create(session, 'snafu.example.com', 'me', name)
+        job.state = 'ok'
+        job.last_seen = job.last_stamp = datetime(1979, 7, 7, 11, 22, 33)
+        job.changed = datetime(1979, 7, 7)
+    session.flush()
+
+    client = Client(app, BaseResponse)
+    resp = json.loads(client.get('/api/1.0/jobs').data)
+    assert_eq(sorted(job['name'] for job in resp['jobs']),
+              ['bar', 'baz', 'foo'])
+    assert_eq(resp['jobs'][0]['seen'], '1979-07-07 11:22:33')
+
+    resp = json.loads(client.get('/api/1.0/jobs?q=ba').data)
+    assert_eq(len(resp['jobs']), 2)
+    cursor = resp['cursor']
+
+    foo, bar, baz = session.query(Job).order_by(Job.id)
+    resp = client.post('/job/%d/delete' % foo.id)
+    bar.changed = datetime.utcnow()
+    bar.state = 'error'
+    session.flush()
+
+    resp = json.loads(client.get('/api/1.0/jobs',
+                                 query_string={'since': cursor}).data)
+    assert_eq(sorted(resp['jobs']), [
+        {'id': foo.id, 'deleted': True},
+        {'id': bar.id, 'login': 'me', 'host': 'snafu.example.com',
+         'name': 'bar', 'state': 'error', 'seen': '1979-07-07 11:22:33'},
+    ])
+
+
+def test_get_jobs_of_role():
+    for login, name, state in [('me', 'foo', 'ok'), ('me', 'bar', 'error'),
+                               ('me', 'baz', 'ok'), ('you', 'foo', 'ok')]:
+        job = Job.create(session, 'snafu.example.com', login, name)
+        job.state = state
+        job.last_seen = job.last_stamp = datetime(1979, 7, 7, 11, 22, 33)
+    session.flush()
+
+    client = Client(app, BaseResponse)
+    resp = json.loads(client.get('/api/1.0/jobs?login=me&state=ok').data)
+    assert_eq([job['name'] for job in resp['jobs']], ['baz', 'foo'])
+    assert_eq(resp['roles'], {'me': {'ok': 2, 'error': 1}})
+
+    resp = client.get('/api/1.0/jobs?state=bad')
+    assert_eq(resp.status_code, 400)
+
+
+def test_get_jobs_bad_cursor():
+    client = Client(app, BaseResponse)
+    resp = client.get('/api/1.0/jobs?since=yesterday')
+    assert_eq(resp.status_code, 400)
@@ -1,7 +1,7 @@
 from __future__ import print_function, division
 from nose.tools import eq_, raises
 
-from proccer.common import parse_interval
+from proccer.common import parse_interval, LRUCache
 
 
 def test_int_interval():
@@ -17,3 +17,27 @@ def test_str_interval():
 @raises(ValueError)
 def test_bad_interval():
     parse_interval('1s')
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    eq_(cache.get('a'), 1)
+
+    cache.put('c', 3)
+    eq_(cache.get('b'), None)
+    eq_(cache.get('a'), 1)
+    eq_(cache.get('c'), 3)
+    eq_(len(cache), 2)
+
+    eq_(cache.pop('a'), 1)
+    eq_(cache.get('a', 'nope'), 'nope')
+
+
+def test_lru_cache_evict():
+    cache = LRUCache(4)
+    for n in range(4):
+        cache.put(n, n * n)
+    cache.evict(lambda key, value: value % 2 == 0)
+    eq_(cache.entries.items(), [(1, 1), (3, 9)])
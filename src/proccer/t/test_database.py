@@ -1,13 +1,19 @@
 from __future__ import with_statement
 
 from copy import deepcopy
-from datetime import timedelta
+from datetime import datetime, timedelta
+from email import message_from_string
 import jsonlib as json
-from mock import Mock, patch
+from mock import Mock, call, patch
+from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool, QueuePool
 
 from proccer.agent import _get_result, raise_for
-from proccer.database import Job
-from proccer.database import update_proccer_job
+from proccer.database import Job, JobHistory, JobResult, Notification
+from proccer.database import update_proccer_job, add_proccer_results
+from proccer.database import record_report
+from proccer.database import pool_options, setup_pool_events
+from proccer.database import insert_job, job_id_cache, _first
 from proccer.t.testing import setup_module, assert_eq
 from proccer.t.test_mail import ok_result
 
@@ -15,31 +21,32 @@ from proccer.t.test_mail import ok_result
 default_recipient_patch = patch('proccer.notifications.default_recipient',
                                 'devops@example.com')
 
-send_mail_patch = patch('proccer.notifications.send_mail')
+
+def queued_subjects():
+    notifications = (session.query(Notification)
+                         .filter_by(channel='mail')
+                         .order_by(Notification.id))
+    return [message_from_string(n.payload['message'])['Subject']
+            for n in notifications]
+
 
 def test_update_proccer_job_new_error():
     result = deepcopy(ok_result)
     result['result']['ok'] = False
 
     with default_recipient_patch:
-        with send_mail_patch as mock:
-            update_proccer_job(session, result)
+        update_proccer_job(session, result)
 
-    assert mock.call_count == 1, mock.call_count
-    msg, recipient = mock.call_args[0]
-    assert_eq(msg['Subject'], '[foo@snafu/bar] error')
+    assert_eq(queued_subjects(), ['[foo@snafu/bar] error'])
 
 
 def test_update_proccer_job():
     with default_recipient_patch:
-        with send_mail_patch as mock:
-            job = update_proccer_job(session, ok_result)
-            assert job
-            assert update_proccer_job(session, ok_result) is job
+        job = update_proccer_job(session, ok_result)
+        assert job
+        assert update_proccer_job(session, ok_result) is job
 
-    assert mock.call_count == 1, mock.call_count
-    msg, recipient = mock.call_args[0]
-    assert_eq(msg['Subject'], '[foo@snafu/bar] ok')
+    assert_eq(queued_subjects(), ['[foo@snafu/bar] ok'])
 
 
 def test_update_proccer_job_w_warn_after():
@@ -51,6 +58,7 @@ def test_update_proccer_job_w_warn_after():
 
     update_proccer_job(session, result)
     assert job.warn_after == timedelta(seconds=15), repr(job.warn_after)
+    assert_eq(job.due_at, job.last_seen + timedelta(seconds=15))
 
 
 def test_update_proccer_job_w_notify():
@@ -64,6 +72,180 @@ def test_update_proccer_job_w_notify():
     assert job.notify == ['foo@example.com', 'bar@example.com'], job.notify
 
 
+def test_update_proccer_job_history():
+    for second, ok in enumerate([True, False, False, True]):
+        result = deepcopy(ok_result)
+        result['result']['ok'] = ok
+        result['stamp'] = '1979-07-07T11:22:3%dZ' % second
+        job = update_proccer_job(session, result)
+
+    history = [(h.state, h.started.second, h.ended and h.ended.second)
+               for h in job.history]
+    assert_eq(history, [('ok', 33, None),
+                        ('error', 31, 33),
+                        ('ok', 30, 31)])
+
+
+def test_record_report():
+    error_result = deepcopy(ok_result)
+    error_result['result']['ok'] = False
+
+    with default_recipient_patch:
+        record_report(session, ok_result)
+        record_report(session, error_result)
+
+    assert_eq(queued_subjects(), ['[foo@snafu/bar] ok',
+                                  '[foo@snafu/bar] error'])
+    job = session.query(Job).one()
+    assert_eq(job.state, 'error')
+    assert_eq(job.results.count(), 2)
+
+
+def test_add_proccer_results():
+    results = []
+    for second, ok in enumerate([True, True, False, True]):
+        result = deepcopy(ok_result)
+        result['result']['ok'] = ok
+        result['stamp'] = '1979-07-07T11:22:3%dZ' % second
+        results.append(result)
+
+    later_error = deepcopy(results[2])
+    later_error['stamp'] = '1979-07-07T11:22:34Z'
+
+    with default_recipient_patch:
+        add_proccer_results(session, results)
+        add_proccer_results(session, [later_error])
+
+    assert_eq(len(queued_subjects()), 4)
+    job = session.query(Job).one()
+    assert_eq(job.state, 'error')
+    assert_eq([(r.state, r.stamp.second) for r in job.results],
+              [('error', 34), ('ok', 33), ('error', 32), ('ok', 31),
+               ('ok', 30)])
+
+    history = [(h.state, h.started.second, h.ended and h.ended.second)
+               for h in job.history]
+    assert_eq(history, [('error', 34, None),
+                        ('ok', 33, 34),
+                        ('error', 32, 33),
+                        ('ok', 30, 32)])
+
+
+def test_revived_job_notifies_scheduler():
+    for store in (update_proccer_job,
+                  lambda session, result: add_proccer_results(session,
+                                                              [result])):
+        with default_recipient_patch:
+            store(session, ok_result)
+        job = session.query(Job).one()
+        job.deleted = datetime.utcnow()
+        session.flush()
+
+        with patch('proccer.database.notify_scheduler') as notify_scheduler:
+            store(session, ok_result)
+        assert_eq(job.deleted, None)
+        assert_eq(notify_scheduler.call_args_list, [call(session, job.id)])
+
+
+def test_get_or_create():
+    defaults = {'last_seen': datetime(1979, 7, 7),
+                'last_stamp': datetime(1979, 7, 7),
+                'state': 1}
+
+    job, created = Job.get_or_create(session, 'snafu', 'foo', 'bar',
+                                     **defaults)
+    assert created
+    assert_eq(job_id_cache.get(('snafu', 'foo', 'bar')), job.id)
+    assert_eq(job.state, 'ok')
+
+    again, created = Job.get_or_create(session, 'snafu', 'foo', 'bar',
+                                       **defaults)
+    assert not created
+    assert again is job
+
+    job_id_cache.put(('snafu', 'foo', 'bar'), 117)
+    again, created = Job.get_or_create(session, 'snafu', 'foo', 'bar',
+                                       **defaults)
+    assert again is job
+    assert_eq(job_id_cache.get(('snafu', 'foo', 'bar')), job.id)
+
+
+def test_get_or_create_id():
+    defaults = {'last_seen': datetime(1979, 7, 7),
+                'last_stamp': datetime(1979, 7, 7),
+                'state': 1}
+
+    job_id, created = Job.get_or_create_id(session, 'snafu', 'foo', 'bar',
+                                           **defaults)
+    assert created
+    assert_eq(session.query(Job).get(job_id).name, 'bar')
+
+    job_id_cache.clear()
+    assert_eq(Job.get_or_create_id(session, 'snafu', 'foo', 'bar',
+                                   **defaults),
+              (job_id, False))
+    assert_eq(job_id_cache.get(('snafu', 'foo', 'bar')), job_id)
+
+
+def test_insert_job_conflict():
+    values = {'host': 'snafu', 'login': 'foo', 'name': 'bar',
+              'last_seen': datetime(1979, 7, 7),
+              'last_stamp': datetime(1979, 7, 7),
+              'state': 1}
+    assert _first(session.execute(insert_job, values))
+    assert_eq(_first(session.execute(insert_job, values)), None)
+    assert_eq(session.query(Job).count(), 1)
+
+
+def test_pool_options():
+    uri = 'postgresql://proccer@localhost/proccer'
+    assert_eq(pool_options(uri, {'PROCCER_DB_POOL_SIZE': '0'}),
+              {'poolclass': NullPool})
+    assert_eq(pool_options(uri, {'PROCCER_DB_POOL_SIZE': '3',
+                                 'PROCCER_DB_MAX_OVERFLOW': '7'}),
+              {'pool_size': 3, 'max_overflow': 7, 'pool_recycle': 3600})
+
+
+def test_pool_options_sqlite():
+    for uri in ['sqlite://', 'sqlite:///proccer.db']:
+        options = pool_options(uri, {'PROCCER_DB_POOL_SIZE': '3'})
+        assert_eq(options, {})
+        create_engine(uri, **options).dispose()
+
+
+def dbapi_connection(engine):
+    conn = engine.connect()
+    try:
+        return conn.connection.connection
+    finally:
+        conn.close()
+
+
+def test_pool_reuses_connections():
+    engine = create_engine('sqlite://', poolclass=QueuePool)
+    setup_pool_events(engine, pre_ping=True)
+    first = dbapi_connection(engine)
+    assert dbapi_connection(engine) is first
+
+
+def test_pool_drops_connections_across_fork():
+    engine = create_engine('sqlite://', poolclass=QueuePool)
+    setup_pool_events(engine, pre_ping=False)
+    first = dbapi_connection(engine)
+
+    with patch('os.getpid', return_value=-1):
+        assert dbapi_connection(engine) is not first
+
+
+def test_pool_pre_ping():
+    engine = create_engine('sqlite://', poolclass=QueuePool)
+    setup_pool_events(engine, pre_ping=True)
+    first = dbapi_connection(engine)
+    first.close()  # Like the database going away.
+
+    assert dbapi_connection(engine) is not first
+
+
 def test_update_job_state():
     from nose.plugins.skip import SkipTest
     raise SkipTest
@@ -0,0 +1,136 @@
+from __future__ import with_statement
+
+from copy import deepcopy
+from datetime import datetime
+import jsonlib as json
+from mock import patch
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from proccer import events
+from proccer.app import app
+from proccer.database import Job, record_report
+from proccer.events import EventBroker
+from proccer.t.testing import setup_module, assert_eq
+from proccer.t.test_mail import ok_result
+
+
+def parse(message):
+    fields = dict(line.split(': ', 1)
+                  for line in message.splitlines() if line)
+    return fields['event'], json.loads(fields['data'])
+
+
+def test_publish():
+    broker = EventBroker()
+    subscriber = broker.subscribe(10)
+    broker.publish('state {"id": 1}')
+
+    messages = subscriber.messages(keepalive=0.01)
+    assert_eq(parse(messages.next()), ('state', {'id': 1}))
+    assert_eq(messages.next(), ': keep-alive\n\n')
+
+
+def test_drop_slow_subscriber():
+    broker = EventBroker()
+    slow = broker.subscribe(2)
+    fast = broker.subscribe(10)
+    for n in range(3):
+        broker.publish('result {"id": %d}' % n)
+
+    assert slow.dropped
+    assert not fast.dropped
+    assert_eq(broker.subscribers, set([fast]))
+    assert_eq(list(slow.messages(keepalive=0.01)), [])
+
+
+def test_report_events():
+    error_result = deepcopy(ok_result)
+    error_result['result']['ok'] = False
+
+    client = Client(app, BaseResponse)
+    resp = client.get('/api/1.0/events')
+    assert resp.headers['Content-Type'].startswith('text/event-stream')
+    stream = iter(resp.response)
+    assert_eq(stream.next(), 'retry: 5000\n\n')
+
+    with patch('proccer.notifications.smtplib'):
+        record_report(session, ok_result)
+        record_report(session, ok_result)
+        record_report(session, error_result)
+        session.commit()
+
+    kinds = [parse(stream.next()) for n in range(3)]
+    assert_eq([(kind, job['state']) for kind, job in kinds],
+              [('state', 'ok'), ('result', 'ok'), ('state', 'error')])
+    assert_eq(kinds[0][1]['name'], 'bar')
+
+    resp.close()
+    assert_eq(events.broker.subscribers, set())
+
+
+def test_revived_job_events():
+    broker = events.broker
+    subscriber = broker.subscribe(10)
+    try:
+        with patch('proccer.notifications.smtplib'):
+            record_report(session, ok_result)
+            job = session.query(Job).one()
+            job.deleted = datetime.utcnow()
+            session.flush()
+            record_report(session, ok_result)
+            session.commit()
+        messages = subscriber.messages(keepalive=0.01)
+        assert_eq([parse(messages.next())[0] for n in range(2)],
+                  ['state', 'state'])
+    finally:
+        broker.unsubscribe(subscriber)
+
+
+def test_events_at_commit():
+    broker = events.broker
+    subscriber = broker.subscribe(10)
+    try:
+        with patch('proccer.notifications.smtplib'):
+            record_report(session, ok_result)
+            # Events of rolled back savepoints are dropped, and those of
+            # released ones wait for the transaction.
+            try:
+                with session.begin_nested():
+                    record_report(session, ok_result)
+                    raise ValueError('Rolled back')
+            except ValueError:
+                pass
+            with session.begin_nested():
+                record_report(session, ok_result)
+            assert_eq(subscriber.queue.qsize(), 0)
+
+            session.commit()
+        assert_eq([parse(subscriber.queue.get_nowait())[0]
+                   for n in range(subscriber.queue.qsize())],
+                  ['state', 'result'])
+
+        record_report(session, ok_result)
+        session.rollback()
+        assert_eq(subscriber.queue.qsize(), 0)
+    finally:
+        broker.unsubscribe(subscriber)
+
+
+def test_delete_events():
+    job = Job.create(session, 'foo', 'bar', 'baz')
+    job.state = 'ok'
+    job.last_stamp = job.last_seen = datetime(1979, 7, 9)
+    session.commit()
+
+    broker = events.broker
+    subscriber = broker.subscribe(10)
+    try:
+        client = Client(app, BaseResponse)
+        client.post('/job/%d/delete' % job.id)
+        kind, data = parse(subscriber.queue.get_nowait())
+    finally:
+        broker.unsubscribe(subscriber)
+
+    assert_eq(kind, 'deleted')
+    assert_eq((data['id'], data['deleted']), (job.id, True))
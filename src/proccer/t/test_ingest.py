@@ -0,0 +1,92 @@
+from __future__ import with_statement
+
+from threading import Event
+
+from proccer.ingest import WriteBehindQueue
+from proccer.t.testing import assert_eq
+
+
+def report(name, n):
+    return {'host': 'snafu', 'login': 'foo', 'name': name, 'n': n}
+
+
+def test_write_behind_in_batches():
+    batches = []
+    queue = WriteBehindQueue(batches.append, 100, 3, 10)
+    for n in range(5):
+        assert queue.put(report('bar', n))
+    queue.start()
+    queue.close()
+
+    assert_eq([[r['n'] for r in batch] for batch in batches],
+              [[0, 1, 2], [3, 4]])
+    status = queue.status()
+    assert_eq(status['written'], 5)
+    assert_eq(status['batches'], 2)
+    assert_eq(status['last_batch_size'], 2)
+    assert_eq(status['queued'], 0)
+
+
+def test_write_behind_grouped_by_job():
+    batches = []
+    queue = WriteBehindQueue(batches.append, 100, 10, 10)
+    for n, name in enumerate(['b', 'a', 'b', 'a']):
+        queue.put(report(name, n))
+    queue.start()
+    queue.close()
+
+    [batch] = batches
+    assert_eq([(r['name'], r['n']) for r in batch],
+              [('a', 1), ('a', 3), ('b', 0), ('b', 2)])
+
+
+def test_write_behind_max_delay():
+    written = Event()
+    queue = WriteBehindQueue(lambda results: written.set(), 100, 10, 0.01)
+    queue.start()
+    queue.put(report('bar', 1))
+
+    written.wait(5)
+    assert written.is_set()
+    queue.close()
+
+
+def test_write_behind_full():
+    queue = WriteBehindQueue(lambda results: None, 2, 10, 10)
+    assert queue.put(report('bar', 1))
+    assert queue.put(report('bar', 2))
+    assert not queue.put(report('bar', 3))
+    assert_eq(queue.status()['queued'], 2)
+
+
+def test_write_behind_failure():
+    written = []
+    def write(results):
+        if len(results) > 1 or results[0]['n'] == 1:
+            raise ValueError('Bad report')
+        written.extend(results)
+
+    queue = WriteBehindQueue(write, 100, 10, 10)
+    for n in range(3):
+        queue.put(report('bar', n))
+    queue.start()
+    queue.close()
+
+    assert_eq([r['n'] for r in written], [0, 2])
+    assert_eq(queue.status()['failed'], 1)
+    assert_eq(queue.status()['written'], 2)
+
+
+def test_write_behind_errors():
+    def write(results):
+        return [ValueError('Bad report') if r['n'] == 1 else None
+                for r in results]
+
+    queue = WriteBehindQueue(write, 100, 10, 10)
+    for n in range(3):
+        queue.put(report('bar', n))
+    queue.start()
+    queue.close()
+
+    assert_eq(queue.status()['failed'], 1)
+    assert_eq(queue.status()['written'], 2)
@@ -1,14 +1,17 @@
 from __future__ import with_statement
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from mock import Mock, patch
+import smtplib
 from socket import gethostname
 
 from proccer.database import Job
 from proccer.notifications import send_mail
 from proccer.notifications import mail_for_state
-from proccer.notifications import state_change_notification
-from proccer.t.testing import setup_module
+from proccer.notifications import state_change_messages, deliver
+from proccer.notifications import SMTPPool, smtp_pool, banner
+from proccer.notifications import recipients, first_attempt, mail_for_digest
+from proccer.t.testing import setup_module, assert_eq, assert_raises
 
 
 def setup_function():
@@ -20,6 +23,7 @@ def setup_function():
     job.rusage = {}
     session.add(job)
     session.flush()
+    smtp_pool.close()  # Do not reuse mock connections from other tests.
 
 env_from = 'proccer@' + gethostname()
 ok_result = {
@@ -41,12 +45,18 @@ devops_mail_patch = patch('proccer.notifications.default_recipient',
 
 
 
-def test_state_change_notification():
+def test_state_change_messages():
+    with devops_mail_patch:
+        messages = state_change_messages(job, ok_result)
+    assert_eq([(channel, key) for channel, key, payload in messages],
+              [('mail', '%d:ok:1979-07-07T11:22:33' % job.id)])
+
     with patch('proccer.notifications.smtplib') as smtplib:
         smtp = smtplib.SMTP.return_value = Mock()
-        with devops_mail_patch:
-            state_change_notification(job, ok_result)
-        assert smtplib.SMTP.call_args == (('no-such-host',), {}),\
+        channel, key, payload = messages[0]
+        deliver(channel, payload)
+        assert smtplib.SMTP.call_args == (('no-such-host',),
+                                          {'timeout': 30}),\
                smtplib.SMTP.call_args
         assert smtp.sendmail.called
 
@@ -71,6 +81,7 @@ def test_mail_for_state():
     txt = msg.as_string()
     assert rcpt == ['devops@example.com'], repr(rcpt)
     assert '\n  Hello, World!\n' in txt, txt
+    assert '< Job okay. >' in txt, txt
     assert msg['Subject'] == '[foo@snafu/bar] ok', msg['Subject']
 
 
@@ -81,3 +92,98 @@ def test_mail_for_state_w_notification():
     assert rcpt == ['foo@example.com'], repr(rcpt)
     assert '\n  Hello, World!\n' in txt, txt
     assert msg['Subject'] == '[foo@snafu/bar] ok', msg['Subject']
+
+
+def test_smtp_pool_reuses_connections():
+    pool = SMTPPool('no-such-host')
+    with patch('smtplib.SMTP') as smtp:
+        pool.sendmail(env_from, ['bar@example.com'], 'Hello')
+        pool.sendmail(env_from, ['bar@example.com'], 'World')
+    assert_eq(smtp.call_count, 1)
+    assert_eq(smtp.return_value.sendmail.call_count, 2)
+
+
+def test_smtp_pool_reconnects():
+    pool = SMTPPool('no-such-host')
+    with patch('smtplib.SMTP') as smtp:
+        pool.sendmail(env_from, ['bar@example.com'], 'Hello')
+        smtp.return_value.sendmail.side_effect = [
+            smtplib.SMTPServerDisconnected('Connection unexpectedly closed'),
+            {}]
+        pool.sendmail(env_from, ['bar@example.com'], 'World')
+    assert_eq(smtp.call_count, 2)
+    assert_eq(smtp.return_value.sendmail.call_count, 3)
+
+
+def test_smtp_pool_idle_timeout():
+    pool = SMTPPool('no-such-host', idle_timeout=0)
+    with patch('smtplib.SMTP') as smtp:
+        pool.sendmail(env_from, ['bar@example.com'], 'Hello')
+        pool.sendmail(env_from, ['bar@example.com'], 'World')
+    assert_eq(smtp.call_count, 2)
+    assert smtp.return_value.quit.called
+
+
+def test_smtp_pool_error():
+    pool = SMTPPool('no-such-host')
+    with patch('smtplib.SMTP') as smtp:
+        smtp.return_value.sendmail.side_effect = smtplib.SMTPDataError(
+            554, 'Transaction failed')
+        with assert_raises(smtplib.SMTPDataError):
+            pool.sendmail(env_from, ['bar@example.com'], 'Hello')
+    assert smtp.return_value.quit.called
+    assert_eq(pool.idle, [])
+
+
+def test_banner():
+    assert banner('ok') is banner('ok')
+    assert_eq(banner('still error'), '\n'.join([
+        ' _________________',
+        '< Job still error >',
+        ' -----------------',
+        '        \\   ^__^',
+        '         \\  (Oo)\\_______',
+        '            (__)\\       )\\/\\',
+        '                ||----w |',
+        '                ||     ||',
+    ]))
+
+
+def test_recipients():
+    job.notify = ['foo@example.com', 'digest: ops@example.com',
+                  'team@example.com']
+    with patch('proccer.notifications.digest_recipients',
+               set(['team@example.com'])):
+        assert_eq(recipients(job), (['foo@example.com'],
+                                    ['ops@example.com', 'team@example.com']))
+
+
+def test_state_change_messages_digest():
+    job.notify = ['digest:ops@example.com']
+    messages = state_change_messages(job, ok_result)
+    assert_eq([(channel, payload['rcpt']) for channel, key, payload
+               in messages],
+              [('digest', 'ops@example.com')])
+
+
+def test_first_attempt():
+    now = datetime(1979, 7, 7, 11, 22, 33)
+    with patch('proccer.notifications.digest_window', timedelta(minutes=5)):
+        assert_eq(first_attempt('digest', now),
+                  datetime(1979, 7, 7, 11, 25))
+    assert_eq(first_attempt('mail', now), now)
+
+
+def test_mail_for_digest():
+    entries = [
+        {'job': 'foo @ snafu / bar', 'job_id': 1, 'state': 'late',
+         'last_seen': '1979-07-07 11:22:33'},
+        {'job': 'foo @ snafu / baz', 'job_id': 2, 'state': 'error',
+         'last_seen': '1979-07-07 11:22:34'},
+    ]
+    with patch('proccer.notifications.web_url', 'http://proccer'):
+        msg = mail_for_digest(entries)
+    assert_eq(msg['Subject'], '[proccer] 2 state changes: error, late')
+    txt = msg.get_payload()
+    assert 'late         foo @ snafu / bar, last seen 1979-07-07' in txt, txt
+    assert 'http://proccer/job/2/' in txt, txt
@@ -0,0 +1,165 @@
+from __future__ import with_statement
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+from mock import patch
+from multiprocessing.pool import ThreadPool
+import time
+
+from proccer import notifications, outbox
+from proccer.database import Job, Notification, queue_notifications
+from proccer.t.testing import setup_module, assert_eq
+
+
+def setup_function():
+    global job, pool
+    job = Job.create(session, 'snafu.example.com', 'foo', 'bar')
+    job.last_seen = job.last_stamp = datetime(1979, 7, 7)
+    job.state = 'ok'
+    session.flush()
+    pool = ThreadPool(2)
+
+
+def teardown_function():
+    pool.close()
+
+messages = [
+    ('mail', 'key', {'rcpt': ['foo@example.com'], 'message': 'Hello'}),
+    ('slack', 'key', {'channel': '#general', 'attachments': [{}]}),
+]
+
+no_delay_patch = patch('proccer.notifications.slack_coalesce_window',
+                       timedelta(0))
+
+
+def test_queue_notifications():
+    queue_notifications(session, job, messages)
+    queue_notifications(session, job, messages)
+
+    notifications = session.query(Notification).order_by(Notification.id)
+    assert_eq([(n.channel, n.payload, n.attempts) for n in notifications],
+              [(channel, payload, 0) for channel, key, payload in messages])
+
+
+def test_deliver_due():
+    with no_delay_patch:
+        queue_notifications(session, job, messages)
+    with patch('proccer.notifications.deliver') as deliver:
+        assert_eq(outbox.deliver_due(pool), 2)
+        assert_eq(outbox.deliver_due(pool), 0)
+
+    assert_eq(sorted(args for args, kwargs in deliver.call_args_list),
+              sorted((channel, payload) for channel, key, payload
+                     in messages))
+    for notification in session.query(Notification):
+        assert notification.delivered
+        assert_eq(notification.next_attempt, None)
+
+
+def test_deliver_due_retry():
+    queue_notifications(session, job, messages[:1])
+    with patch('proccer.notifications.deliver') as deliver:
+        deliver.side_effect = IOError('Connection refused')
+        before = datetime.utcnow()
+        assert_eq(outbox.deliver_due(pool), 1)
+        assert_eq(outbox.deliver_due(pool), 0)
+
+    notification = session.query(Notification).one()
+    assert_eq(notification.attempts, 1)
+    assert_eq(notification.last_error, 'Connection refused')
+    assert notification.next_attempt >= before + outbox.retry_delay
+    assert_eq(notification.delivered, None)
+
+
+def test_deliver_due_give_up():
+    queue_notifications(session, job, messages[:1])
+    notification = session.query(Notification).one()
+    notification.attempts = outbox.max_attempts - 1
+    session.flush()
+
+    with patch('proccer.notifications.deliver') as deliver:
+        deliver.side_effect = IOError('Connection refused')
+        assert_eq(outbox.deliver_due(pool), 1)
+
+    session.refresh(notification)
+    assert_eq(notification.next_attempt, None)
+    assert_eq(notification.delivered, None)
+
+
+def test_deliver_due_renews_lease():
+    queue_notifications(session, job, messages[:1])
+    with patch('proccer.notifications.deliver') as deliver:
+        deliver.side_effect = lambda channel, payload: time.sleep(0.1)
+        with patch('proccer.outbox.renew_interval',
+                   timedelta(seconds=0.01)):
+            with patch('proccer.outbox._renew_lease',
+                       wraps=outbox._renew_lease) as renew_lease:
+                assert_eq(outbox.deliver_due(pool), 1)
+
+    assert renew_lease.called
+    notification = session.query(Notification).one()
+    assert notification.delivered
+    assert_eq(notification.next_attempt, None)
+
+
+def test_renew_lease():
+    with no_delay_patch:
+        queue_notifications(session, job, messages)
+    lease = datetime.utcnow()
+    ours, theirs = session.query(Notification).order_by(Notification.id)
+    ours.next_attempt = lease
+    theirs.next_attempt = lease + timedelta(seconds=1)
+    session.flush()
+
+    renewed = outbox._renew_lease([ours, theirs], lease)
+    session.refresh(ours)
+    session.refresh(theirs)
+    assert renewed >= lease + outbox.lease_time
+    assert_eq(ours.next_attempt, renewed)
+    assert_eq(theirs.next_attempt, lease + timedelta(seconds=1))
+
+
+def test_backoff():
+    assert_eq(outbox.backoff(1), outbox.retry_delay)
+    assert_eq(outbox.backoff(3), 4 * outbox.retry_delay)
+    assert_eq(outbox.backoff(100), outbox.max_retry_delay)
+
+
+def test_deliver_due_slack_delay():
+    queue_notifications(session, job, messages[1:])
+    with patch('proccer.notifications.deliver') as deliver:
+        assert_eq(outbox.deliver_due(pool), 0)
+    assert not deliver.called
+
+
+def test_groups():
+    Row = namedtuple('Row', 'channel payload')
+    mail = Row('mail', {})
+    general = Row('slack', {'channel': '#general'})
+    ops = Row('slack', {'channel': '#ops'})
+
+    with patch('proccer.notifications.slack_max_attachments', 2):
+        groups = outbox._groups([mail, general, ops, general, mail,
+                                 general])
+    assert_eq(groups, [[mail], [general, general], [ops], [mail],
+                       [general]])
+
+
+def test_deliver_due_digest():
+    for name in ('baz', 'qux', 'quux'):
+        other = Job.create(session, 'snafu.example.com', 'foo', name)
+        other.last_seen = other.last_stamp = datetime(1979, 7, 7)
+        other.state = 'late'
+        other.notify = ['digest:ops@example.com']
+        session.flush()
+        queue_notifications(session, other,
+                            notifications.state_change_messages(other, None))
+    session.query(Notification).update({'next_attempt': datetime.utcnow()})
+
+    with patch('proccer.notifications.send_mail_string') as send_mail:
+        assert_eq(outbox.deliver_due(pool), 3)
+
+    assert_eq(send_mail.call_count, 1)
+    msg, rcpt = send_mail.call_args[0]
+    assert_eq(rcpt, ['ops@example.com'])
+    assert '[proccer] 3 state changes: late' in msg, msg
@@ -3,9 +3,13 @@ from __future__ import with_statement
 from datetime import datetime, timedelta
 from mock import patch
 
-from proccer.database import Job
-from proccer.periodic import main
-from proccer.t.testing import setup_module
+from proccer.database import Job, JobResult, Notification, due_at
+from proccer.periodic import main, send_lateness_notifications
+from proccer.periodic import delete_old_results
+from proccer.periodic import send_still_bad_notifications
+from proccer.periodic import LatenessScheduler, run_task
+from proccer.t.testing import setup_module, assert_eq
+from proccer.t.test_database import default_recipient_patch
 
 def test_periodic():
     still_bad_job = Job.create(session, 'foo', 'bar', 'baz')
@@ -13,12 +17,12 @@ def test_periodic():
     still_bad_job.state = 'error'
     still_bad_job.warn_after = timedelta(seconds=1)
 
-    silent_bad_job = Job.create(session, 'foo', 'bar', 'baz')
+    silent_bad_job = Job.create(session, 'foo', 'bar', 'silent')
     silent_bad_job.last_seen = silent_bad_job.last_stamp = datetime(1979, 7, 7)
     silent_bad_job.state = 'error'
     silent_bad_job.warn_after = None
 
-    still_late_job = Job.create(session, 'foo', 'bar', 'baz')
+    still_late_job = Job.create(session, 'foo', 'bar', 'late')
     still_late_job.last_seen = still_late_job.last_stamp = datetime(1979, 7, 7)
     still_late_job.state = 'error'
     still_late_job.warn_after = timedelta(seconds=1)
@@ -28,3 +32,135 @@ def test_periodic():
     # FIXME - This needs real tests!
     with patch('proccer.notifications.smtplib'):
         main()
+
+
+def test_send_lateness_notifications():
+    now = datetime.utcnow()
+    late_job = Job.create(session, 'foo', 'bar', 'late')
+    late_job.last_seen = late_job.last_stamp = now - timedelta(hours=2)
+    late_job.warn_after = timedelta(hours=1)
+    late_job.due_at = due_at(late_job.last_seen, late_job.warn_after)
+    late_job.state = 'ok'
+
+    on_time_job = Job.create(session, 'foo', 'bar', 'on-time')
+    on_time_job.last_seen = on_time_job.last_stamp = now
+    on_time_job.warn_after = timedelta(hours=1)
+    on_time_job.due_at = due_at(on_time_job.last_seen,
+                                on_time_job.warn_after)
+    on_time_job.state = 'ok'
+    session.flush()
+
+    with default_recipient_patch:
+        send_lateness_notifications(session)
+
+    assert_eq(late_job.state, 'late')
+    assert_eq(on_time_job.state, 'ok')
+    assert_eq([n.job_id for n in session.query(Notification)],
+              [late_job.id])
+    assert_eq([(h.state, h.started, h.ended) for h in late_job.history],
+              [('late', late_job.due_at, None)])
+
+
+def test_send_still_bad_notifications():
+    now = datetime.utcnow()
+    still_bad_job = Job.create(session, 'foo', 'bar', 'baz')
+    still_bad_job.last_seen = still_bad_job.last_stamp = datetime(1979, 7, 7)
+    still_bad_job.state = 'error'
+    still_bad_job.warn_after = timedelta(seconds=1)
+
+    silent_bad_job = Job.create(session, 'foo', 'bar', 'silent')
+    silent_bad_job.last_seen = silent_bad_job.last_stamp = datetime(1979, 7, 7)
+    silent_bad_job.state = 'error'
+    silent_bad_job.warn_after = None
+
+    recent_bad_job = Job.create(session, 'foo', 'bar', 'recent')
+    recent_bad_job.last_seen = recent_bad_job.last_stamp = now
+    recent_bad_job.state = 'error'
+    recent_bad_job.warn_after = timedelta(seconds=1)
+    session.flush()
+
+    with default_recipient_patch:
+        send_still_bad_notifications(session)
+
+    assert_eq([(n.job_id, n.channel) for n in session.query(Notification)],
+              [(still_bad_job.id, 'mail')])
+    assert still_bad_job.last_stamp >= now
+    assert_eq(silent_bad_job.last_stamp, datetime(1979, 7, 7))
+
+
+def make_job(name, state, due_in):
+    now = datetime.utcnow()
+    job = Job.create(session, 'foo', 'bar', name)
+    job.last_seen = job.last_stamp = now
+    job.warn_after = timedelta(hours=1)
+    job.due_at = now + due_in
+    job.state = state
+    return job
+
+
+def test_lateness_scheduler():
+    late_job = make_job('late', 'ok', timedelta(minutes=-1))
+    later_job = make_job('later', 'ok', timedelta(minutes=10))
+    error_job = make_job('error', 'error', timedelta(minutes=-1))
+    session.flush()
+
+    scheduler = LatenessScheduler()
+    scheduler.load(session)
+    assert_eq(len(scheduler.heap), 2)
+    assert_eq(scheduler.next_deadline(), late_job.due_at)
+
+    assert_eq(scheduler.run_due(session, datetime.utcnow()), [late_job])
+    assert_eq(late_job.state, 'late')
+    assert_eq(late_job.history.first().started, late_job.due_at)
+    assert_eq(error_job.state, 'error')
+    assert_eq(scheduler.next_deadline(), later_job.due_at)
+
+    # Becoming due earlier needs an update.
+    later_job.due_at = datetime.utcnow() - timedelta(seconds=1)
+    session.flush()
+    assert_eq(scheduler.run_due(session, datetime.utcnow()), [])
+    scheduler.update(session, [later_job.id])
+    assert_eq(scheduler.run_due(session, datetime.utcnow()), [later_job])
+
+
+def test_lateness_scheduler_reported_in():
+    job = make_job('late', 'ok', timedelta(minutes=-1))
+    session.flush()
+
+    scheduler = LatenessScheduler()
+    scheduler.load(session)
+
+    # The job reported in after being scheduled.
+    job.due_at = datetime.utcnow() + timedelta(hours=1)
+    session.flush()
+
+    assert_eq(scheduler.run_due(session, datetime.utcnow()), [])
+    assert_eq(job.state, 'ok')
+    assert_eq(scheduler.heap, [(job.due_at, job.id)])
+
+
+def test_run_task_elsewhere():
+    late_job = make_job('late', 'ok', timedelta(minutes=-1))
+    session.flush()
+
+    with patch('proccer.periodic.try_task_lock') as try_task_lock:
+        try_task_lock.return_value = False
+        run_task(send_lateness_notifications)
+    assert_eq(late_job.state, 'ok')
+
+    run_task(send_lateness_notifications)
+    assert_eq(late_job.state, 'late')
+
+
+def test_delete_old_results():
+    job = make_job('job', 'ok', timedelta(hours=1))
+    now = datetime.utcnow()
+    for days in range(5, 10):
+        job.last_seen = now - timedelta(days=days)
+        JobResult.create(job, clock_ms=0, result={}, rusage={}, output='')
+    session.flush()
+
+    with patch('proccer.periodic.RESULT_DELETE_BATCH', 2):
+        delete_old_results(session)
+    assert_eq(sorted((now - r.stamp).days for r in session.query(JobResult)),
+              [5, 6])
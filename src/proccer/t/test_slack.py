@@ -0,0 +1,144 @@
+from __future__ import with_statement
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from datetime import datetime, timedelta
+import jsonlib as json
+from mock import patch
+from multiprocessing.pool import ThreadPool
+from threading import Thread
+from urlparse import parse_qs
+
+from proccer import notifications, outbox
+from proccer.database import Job, Notification, queue_notifications
+from proccer.notifications import post_slack, slack_payload, RetryLater
+from proccer.notifications import parse_retry_after
+from proccer.t.testing import setup_module, assert_eq, assert_raises
+
+
+class StubWebhook(BaseHTTPRequestHandler):
+    'Slack incoming-webhook stand-in, answering with queued responses.'
+
+    protocol_version = 'HTTP/1.1'  # For keep-alive.
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        posts.append((self.client_address,
+                      json.loads(parse_qs(body)['payload'][0])))
+
+        status, headers = responses.pop(0) if responses else (200, {})
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('ok')
+
+    def log_message(self, *args):
+        pass
+
+
+def setup_function():
+    global server, posts, responses, job, patches
+    posts = []
+    responses = []
+    server = HTTPServer(('127.0.0.1', 0), StubWebhook)
+    thread = Thread(target=server.serve_forever,
+                    kwargs={'poll_interval': 0.01})
+    thread.daemon = True
+    thread.start()
+
+    patches = [
+        patch('proccer.notifications.slack_api_url',
+              'http://127.0.0.1:%d/hook' % server.server_address[1]),
+        patch('proccer.notifications.slack_api_token', 'token'),
+        patch('proccer.notifications.slack_coalesce_window', timedelta(0)),
+        patch('proccer.notifications._slack_blocked_until', 0),
+    ]
+    for p in patches:
+        p.start()
+
+    job = Job.create(session, 'snafu.example.com', 'foo', 'bar')
+    job.last_seen = job.last_stamp = datetime(1979, 7, 7)
+    job.state = 'error'
+    session.flush()
+
+
+def teardown_function():
+    for p in patches:
+        p.stop()
+    notifications.slack_session.close()
+    server.shutdown()
+    server.server_close()
+
+
+def test_post_slack():
+    post_slack(slack_payload(job, 'error'))
+    post_slack(slack_payload(job, 'ok'))
+
+    assert_eq([payload['attachments'][0]['color'] for _, payload in posts],
+              ['danger', 'good'])
+    # Both posts were made over the same connection.
+    assert_eq(posts[0][0], posts[1][0])
+
+
+def test_post_slack_retry_after():
+    responses.append((429, {'Retry-After': '7'}))
+    with assert_raises(RetryLater):
+        post_slack(slack_payload(job, 'error'))
+    assert_eq(len(posts), 1)
+
+    # Slack is not bothered again until we have waited.
+    try:
+        post_slack(slack_payload(job, 'error'))
+    except RetryLater, e:
+        assert 6 < e.retry_after <= 7, e.retry_after
+    else:
+        raise AssertionError('RetryLater was not raised')
+    assert_eq(len(posts), 1)
+
+
+def test_parse_retry_after():
+    assert_eq(parse_retry_after('120'), 120)
+    assert_eq(parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0)
+    assert_eq(parse_retry_after(None), 60)
+
+
+def queue_slack(states):
+    for n, state in enumerate(states):
+        job.last_stamp = datetime(1979, 7, 7, 0, 0, n)
+        queue_notifications(session, job, [
+            ('slack', 'key %d' % n, slack_payload(job, state))])
+
+
+def test_outbox_coalesces_slack():
+    queue_slack(['error', 'late', 'still error'])
+
+    pool = ThreadPool(2)
+    try:
+        assert_eq(outbox.deliver_due(pool), 3)
+    finally:
+        pool.close()
+
+    assert_eq(len(posts), 1)
+    attachments = posts[0][1]['attachments']
+    assert_eq([a['color'] for a in attachments],
+              ['danger', 'warning', 'danger'])
+    assert_eq(session.query(Notification)
+                  .filter(Notification.delivered != None).count(), 3)
+
+
+def test_outbox_honors_retry_after():
+    queue_slack(['error'])
+    responses.append((429, {'Retry-After': '30'}))
+
+    pool = ThreadPool(2)
+    try:
+        before = datetime.utcnow()
+        assert_eq(outbox.deliver_due(pool), 1)
+    finally:
+        pool.close()
+
+    notification = session.query(Notification).one()
+    assert_eq(notification.attempts, 0)
+    assert_eq(notification.delivered, None)
+    assert notification.next_attempt >= before + timedelta(seconds=30)
@@ -0,0 +1,152 @@
+from __future__ import with_statement
+
+import errno
+from mock import patch
+import os
+import shutil
+from tempfile import mkdtemp
+import time
+
+from proccer import spool
+from proccer.t.testing import setup_module, assert_eq
+
+
+def setup_function():
+    global spool_dir
+    spool_dir = mkdtemp()
+
+
+def teardown_function():
+    shutil.rmtree(spool_dir)
+
+
+def delivered(results):
+    return [True] * len(results)
+
+
+def test_add():
+    path = spool.add({'name': 'foo'}, spool_dir)
+    assert_eq(spool.pending(spool_dir), [path])
+    assert_eq(os.listdir(os.path.join(spool_dir, 'tmp')), [])
+    assert_eq(open(path).read(), '{"name":"foo"}')
+
+
+def test_pending_in_order():
+    paths = [spool.add({'n': n}, spool_dir) for n in range(3)]
+    assert_eq(spool.pending(spool_dir), paths)
+
+
+def test_pending_no_spool():
+    assert_eq(spool.pending(os.path.join(spool_dir, 'nope')), [])
+
+
+def test_flush_in_batches():
+    for n in range(5):
+        spool.add({'n': n}, spool_dir)
+
+    batches = []
+    def deliver(results):
+        batches.append([r['n'] for r in results])
+        return delivered(results)
+
+    assert_eq(spool.flush(deliver, 2, spool_dir), 0)
+    assert_eq(batches, [[0, 1], [2, 3], [4]])
+    assert_eq(spool.pending(spool_dir), [])
+
+
+def test_flush_stops_at_undelivered():
+    for n in range(5):
+        spool.add({'n': n}, spool_dir)
+
+    batches = []
+    def deliver(results):
+        batches.append([r['n'] for r in results])
+        return [True, False]
+
+    assert_eq(spool.flush(deliver, 2, spool_dir), 4)
+    assert_eq(batches, [[0, 1]])
+
+
+def test_flush_moves_failed_aside():
+    for n in range(2):
+        spool.add({'n': n}, spool_dir)
+
+    batches = []
+    def deliver(results):
+        batches.append([r['n'] for r in results])
+        return [spool.FAILED] + [True] * (len(results) - 1)
+
+    for attempt in range(spool.max_attempts - 1):
+        assert_eq(spool.flush(deliver, 2, spool_dir), 1)
+    assert_eq(spool.flush(deliver, 2, spool_dir), 0)
+    assert_eq(batches, [[0, 1]] + [[0]] * (spool.max_attempts - 1))
+    assert_eq(len(os.listdir(os.path.join(spool_dir, 'failed'))), 1)
+
+
+def test_flush_moves_refused_aside():
+    for n in range(2):
+        spool.add({'n': n}, spool_dir)
+
+    def deliver(results):
+        return [spool.REFUSED] + [True] * (len(results) - 1)
+
+    assert_eq(spool.flush(deliver, 2, spool_dir), 0)
+    assert_eq(len(os.listdir(os.path.join(spool_dir, 'failed'))), 1)
+
+
+def test_flush_deliver_raises():
+    spool.add({'n': 1}, spool_dir)
+
+    def deliver(results):
+        raise IOError('No manager')
+
+    try:
+        spool.flush(deliver, 2, spool_dir)
+    except IOError:
+        pass
+    assert_eq(len(spool.pending(spool_dir)), 1)
+
+
+def test_flush_locked():
+    spool.add({'n': 1}, spool_dir)
+
+    def deliver(results):
+        assert_eq(spool.flush(delivered, 2, spool_dir), None)
+        return delivered(results)
+
+    assert_eq(spool.flush(deliver, 2, spool_dir), 0)
+
+
+def test_expire_too_old():
+    old = spool.add({'n': 1}, spool_dir)
+    new = spool.add({'n': 2}, spool_dir)
+    then = time.time() - spool.max_age - 1
+    os.utime(old, (then, then))
+
+    spool.expire(spool_dir)
+    assert_eq(spool.pending(spool_dir), [new])
+
+
+def test_expire_too_big():
+    paths = [spool.add({'n': n}, spool_dir) for n in range(3)]
+    size = os.stat(paths[0]).st_size
+
+    with patch('proccer.spool.max_bytes', 2 * size):
+        spool.expire(spool_dir)
+    assert_eq(spool.pending(spool_dir), paths[1:])
+
+
+def test_expire_races():
+    spool.add({'n': 1}, spool_dir)
+    open(os.path.join(spool_dir, 'tmp', 'adding'), 'w').close()
+
+    # The reports are gone by the time they are looked at.
+    real_stat = os.stat
+    def stat(path):
+        if os.path.basename(os.path.dirname(path)) in ('new', 'tmp'):
+            raise OSError(errno.ENOENT, 'No such file or directory')
+        return real_stat(path)
+
+    with patch('os.stat', stat):
+        spool.expire(spool_dir)
+    assert_eq(len(spool.pending(spool_dir)), 1)
@@ -6,7 +6,8 @@ from werkzeug.test import Client
 from werkzeug.wrappers import BaseResponse
 
 from proccer.database import Job, JobResult
-from proccer.t.testing import setup_module
+from proccer.signals import jobs_changed, report_received
+from proccer.t.testing import setup_module, assert_eq
 from proccer.t.test_mail import ok_result
 from proccer.app import app
 
@@ -21,6 +22,41 @@ def test_index():
     assert resp.status_code == 200
 
 
+def test_index_summary():
+    for name, state in [('a', 'ok'), ('b', 'ok'), ('c', 'error'),
+                        ('d', 'late')]:
+        job = Job.create(session, 'foo', 'bar', name)
+        job.state = state
+        job.last_stamp = job.last_seen = datetime(1979, 7, 9)
+    job = Job.create(session, 'foo', 'baz', 'e')
+    job.state = 'ok'
+    job.last_stamp = job.last_seen = datetime(1979, 7, 9)
+    session.flush()
+
+    client = Client(app, BaseResponse)
+    resp = client.get('/')
+    assert '2 ok, 1 error, 1 late' in resp.data, resp.data
+    assert '[show 2 ok jobs]' in resp.data
+    # Only the jobs which are not ok are listed.
+    assert_eq(resp.data.count('class="job'), 0)
+    assert_eq(resp.data.count(' job"'), 2)
+
+
+def test_index_toggle_text():
+    for login, state in [('bar', 'ok'), ('baz', 'error')]:
+        job = Job.create(session, 'foo', login, 'job')
+        job.state = state
+        job.last_stamp = job.last_seen = datetime(1979, 7, 9)
+    session.flush()
+
+    client = Client(app, BaseResponse)
+    resp = client.get('/')
+    # Roles without ok jobs get a hidden one, for when they have.
+    assert "<span class=\"toggle-text\">[show 1 ok jobs]</span>" in resp.data
+    assert ("<span class=\"toggle-text\" style=\"display: none\"></span>"
+            in resp.data), resp.data
+
+
 def test_get_job():
     job = Job.create(session, 'foo', 'bar', 'baz')
     job.state = 'ok'
@@ -35,3 +71,88 @@ def test_get_job():
     resp = client.get('/job/%d/' % job.id)
     assert resp.status_code == 200
     assert 'Hello, World!' in resp.data
+
+
+def test_cached_pages():
+    job = Job.create(session, 'foo', 'bar', 'baz')
+    job.state = 'ok'
+    job.last_stamp = job.last_seen = datetime(1979, 7, 9)
+    other = Job.create(session, 'foo', 'bar', 'qux')
+    other.state = 'ok'
+    other.last_stamp = other.last_seen = datetime(1979, 7, 9)
+    session.flush()
+
+    client = Client(app, BaseResponse)
+    pages = ['/', '/job/%d/' % job.id, '/job/%d/' % other.id]
+    for page in pages:
+        assert_eq(client.get(page).status_code, 200)
+
+    # Served from the cache, without the change.
+    job.state = other.state = 'error'
+    session.flush()
+    for page in pages:
+        assert 'error' not in client.get(page).data
+
+    jobs_changed.send(None, job_ids=[job.id])
+    assert '2 error' in client.get('/').data
+    assert 'error' in client.get(pages[1]).data
+    assert 'error' not in client.get(pages[2]).data
+
+
+def test_cached_pages_report():
+    client = Client(app, BaseResponse)
+    assert '1 ok' not in client.get('/').data
+
+    with patch('proccer.notifications.smtplib'):
+        report_received.send(ok_result)
+    assert '1 ok' in client.get('/').data
+
+
+def test_flashed_pages_not_cached():
+    job = Job.create(session, 'foo', 'bar', 'baz')
+    job.state = 'ok'
+    job.last_stamp = job.last_seen = datetime(1979, 7, 9)
+    session.flush()
+
+    client = Client(app, BaseResponse)
+    client.get('/')
+    resp = client.post('/job/%d/delete' % job.id)
+    assert_eq(resp.status_code, 302)
+    assert 'Job deleted' in client.get('/').data
+    assert 'Job deleted' not in client.get('/').data
+
+
+def test_cached_pages_result_events():
+    job = Job.create(session, 'foo', 'bar', 'baz')
+    job.state = 'ok'
+    job.last_stamp = job.last_seen = datetime(1979, 7, 9)
+    session.flush()
+
+    client = Client(app, BaseResponse)
+    pages = ['/', '/job/%d/' % job.id]
+    for page in pages:
+        client.get(page)
+    job.state = 'error'
+    session.flush()
+
+    # Results only drop the job's page, the index patches itself.
+    jobs_changed.send(None, job_ids=[job.id], listings=False)
+    assert 'error' not in client.get(pages[0]).data
+    assert 'error' in client.get(pages[1]).data
+
+    jobs_changed.send(None, job_ids=[job.id])
+    assert '1 error' in client.get(pages[0]).data
+
+
+def test_cached_pages_stale_rendering():
+    from proccer.pagecache import PageCache
+
+    cache = PageCache(10, 60)
+    with cache.rendering(None) as listing:
+        with cache.rendering('1') as job_page:
+            cache.invalidate([1], listings=False)
+            cache.put('/job/1/', job_page, 'job', 'text/html')
+        cache.put('/', listing, 'index', 'text/html')
+    assert_eq(cache.get('/job/1/'), None)
+    assert_eq(cache.get('/'), ('index', 'text/html'))
+    assert_eq(cache.renderings, set())
@@ -6,6 +6,7 @@ from sqlalchemy import create_engine
 import sys
 
 from proccer import database
+from proccer.pagecache import page_cache
 
 __all__ = ['assert_raises', 'assert_eq', 'setup_module', 'setup_hooks']
 
@@ -50,9 +51,12 @@ def setup_hooks(module_name):
 
     def setup_function():
         engine = create_engine('sqlite://')
+        database.setup_sqlite_events(engine)
         database.Base.metadata.create_all(bind=engine)
         module.session = orig_Session(bind=engine)
         database.populate_database(module.session)
+        database.job_id_cache.clear()
+        page_cache.clear()
         # Replace database.Session with a MockSession while in testing, to
         # prevent session_manager from dropping our in-memory database too
         # soon.